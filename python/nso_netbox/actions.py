@@ -2,10 +2,15 @@ import ncs
 from ncs.dp import Action
 
 # from _ncs import decrypt
+from .netbox_snapshots import refresh_snapshot
 from .netbox_utilities import verify_netbox
 
 
 class NetboxServerAction(Action):
+    def init(self, init_args):
+        # Shared NetBox client registry owned by the Main application
+        self.clients = init_args
+
     @Action.action
     def cb_action(self, uinfo, name, kp, action_input, action_output, trans):
         self.log.info("NetboxAction: ", name)
@@ -15,12 +20,47 @@ class NetboxServerAction(Action):
 
         if name == "verify-status":
             self.verify_status(service, root, action_output)
+        if name == "lookup-cache":
+            self.lookup_cache(service, action_input, action_output)
+        if name == "refresh-snapshot":
+            self.refresh_snapshot(service, action_input, action_output)
 
     def verify_status(self, service, root, action_output):
         """Perform a status check that the NetBox server is reachable."""
-        netbox_status = verify_netbox(service)
+        netbox_status = verify_netbox(service, clients=self.clients)
         action_output.success = netbox_status["status"]
         action_output.output = netbox_status["message"]
         self.log.info(
             f'Verification Results: {netbox_status["status"]} {netbox_status["message"]}'
         )
+
+    def lookup_cache(self, service, action_input, action_output):
+        """Report, and optionally clear, the lookup cache for the NetBox server."""
+        stats = self.clients.lookups.stats(str(service.name))
+        action_output.hits = stats["hits"]
+        action_output.misses = stats["misses"]
+        action_output.entries = stats["entries"]
+        if action_input.clear:
+            self.clients.lookups.clear(str(service.name))
+        self.log.info(f"Lookup cache for {service.name}: {stats}")
+
+    def refresh_snapshot(self, service, action_input, action_output):
+        """Update the local snapshot of the NetBox server devices and VMs."""
+        refresh = refresh_snapshot(
+            service, log=self.log, clients=self.clients, full=action_input.full
+        )
+        action_output.success = refresh["status"]
+        if not refresh["status"]:
+            action_output.output = f"Unable to refresh snapshot: {refresh['result']}"
+            return
+
+        result = refresh["result"]
+        kind = "Incremental" if result["incremental"] else "Full"
+        action_output.output = (
+            f"{kind} refresh: {result['merged']} objects read, {result['removed']} removed. "
+            f"Snapshot holds {result['devices']} devices and {result['vms']} VMs."
+        )
+        action_output.devices = result["devices"]
+        action_output.vms = result["vms"]
+        action_output.refreshed = result["refreshed"]
+        self.log.info(f"Snapshot of {service.name}: {action_output.output}")
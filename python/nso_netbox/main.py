@@ -4,6 +4,10 @@ from ncs.application import Service
 from .actions import NetboxServerAction
 from .netbox_inventory import NetboxInventoryServiceCallbacks
 from .netbox_inventory_actions import NetboxInventoryAction
+from .netbox_build_all import NetboxBuildAllAction
+from .netbox_clients import NetboxClientRegistry
+from .netbox_scheduler import InventoryScheduler
+from .netbox_webhooks import WebhookManager, WebhookSubscriber
 
 
 # ------------------------
@@ -62,6 +66,9 @@ class Main(ncs.application.Application):
         # through 'self.log' and is a ncs.log.Log instance.
         self.log.info("Main RUNNING")
 
+        # Keep-alive NetBox clients shared by every action, one per netbox-server
+        self.netbox_clients = NetboxClientRegistry(log=self.log)
+
         # Service callbacks require a registration for a 'service point',
         # as specified in the corresponding data model.
         #
@@ -71,11 +78,58 @@ class Main(ncs.application.Application):
         self.register_service(
             "nso-netbox-inventory-servicepoint", NetboxInventoryServiceCallbacks
         )
-        self.register_action("netbox-verify-status", NetboxServerAction)
-        self.register_action("netbox-inventory-build", NetboxInventoryAction)
-        self.register_action("netbox-inventory-connect", NetboxInventoryAction)
-        self.register_action("netbox-inventory-remove", NetboxInventoryAction)
-        self.register_action("netbox-inventory-verify", NetboxInventoryAction)
+        self.register_action(
+            "netbox-verify-status", NetboxServerAction, init_args=self.netbox_clients
+        )
+        self.register_action(
+            "netbox-lookup-cache", NetboxServerAction, init_args=self.netbox_clients
+        )
+        self.register_action(
+            "netbox-refresh-snapshot",
+            NetboxServerAction,
+            init_args=self.netbox_clients,
+        )
+        self.register_action(
+            "netbox-inventory-build",
+            NetboxInventoryAction,
+            init_args=self.netbox_clients,
+        )
+        self.register_action(
+            "netbox-inventory-connect",
+            NetboxInventoryAction,
+            init_args=self.netbox_clients,
+        )
+        self.register_action(
+            "netbox-inventory-remove",
+            NetboxInventoryAction,
+            init_args=self.netbox_clients,
+        )
+        self.register_action(
+            "netbox-inventory-refresh-cache",
+            NetboxInventoryAction,
+            init_args=self.netbox_clients,
+        )
+        self.register_action(
+            "netbox-inventory-verify",
+            NetboxInventoryAction,
+            init_args=self.netbox_clients,
+        )
+        self.register_action(
+            "netbox-inventories-build-all",
+            NetboxBuildAllAction,
+            init_args=self.netbox_clients,
+        )
+
+        # Listen for NetBox webhooks on the webhook-port of each netbox-server
+        self.webhooks = WebhookManager(self.log, self.netbox_clients)
+        self.webhooks.start()
+        self.webhook_subscriber = WebhookSubscriber(app=self, log=self.log)
+        self.webhook_subscriber.manager = self.webhooks
+        self.webhook_subscriber.start()
+
+        # Verify and build inventories with a schedule in the background
+        self.scheduler = InventoryScheduler(self.log)
+        self.scheduler.start()
 
         # If we registered any callback(s) above, the Application class
         # took care of creating a daemon (related to the service/action point).
@@ -88,4 +142,8 @@ class Main(ncs.application.Application):
         # down, packages were reloaded or some error occurred) this teardown
         # method will be called.
 
+        self.scheduler.stop()
+        self.webhook_subscriber.stop()
+        self.webhooks.stop()
+        self.netbox_clients.close()
         self.log.info("Main FINISHED")
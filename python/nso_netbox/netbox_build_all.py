@@ -0,0 +1,237 @@
+"""Build several netbox-inventories in one pass
+
+Inventories using the same netbox-server share a single NetBox query that
+covers the filters of all of them. Every device and VM is read from NetBox
+once and matched to each inventory in memory, then the consolidated
+"NetBox" device-groups are written once all inventories are built.
+Inventories federated across several NetBox servers are read on their own.
+"""
+
+import ncs
+from ncs.dp import Action
+
+from .netbox_federation import (
+    collision_report,
+    federated,
+    federated_netbox,
+    inventory_servers,
+    verify_servers,
+)
+from .netbox_inventory_actions import NetboxInventoryAction
+from .netbox_inventory_plan import apply_consolidated_groups, consolidated_groups
+from .netbox_metrics import ActionMetrics, phase, save_metrics
+from .netbox_utilities import (
+    inventory_filters,
+    inventory_netbox,
+    merge_filters,
+    verify_netbox,
+)
+from .nso_utilities import get_users_groups
+
+# Prefix of the phases of a NetBox query shared by several inventories
+SHARED_PREFIX = "shared-"
+
+
+class NetboxBuildAllAction(NetboxInventoryAction):
+    @Action.action
+    def cb_action(self, uinfo, name, kp, action_input, action_output, trans):
+        self.log.info("NetboxAction: ", name)
+        node = ncs.maagic.get_node(trans, kp)
+        root = ncs.maagic.get_root(trans)
+        trans.maapi.install_crypto_keys()
+
+        # Find groups user is a member of
+        ugroups = get_users_groups(trans, uinfo)
+        self.log.info("groups = ", ugroups)
+
+        if name == "build-all":
+            self.build_all(
+                uinfo, ugroups, name, node, root, action_input, action_output
+            )
+
+    def build_all(self, uinfo, ugroups, name, node, root, action_input, action_output):
+        """Build the selected inventories, or all, reading NetBox once per server."""
+        selected = action_input.inventory.as_list()
+        unknown = [
+            inventory
+            for inventory in selected
+            if inventory not in root.netbox_inventory
+        ]
+        if unknown:
+            action_output.output = f"Unknown netbox-inventory: {', '.join(unknown)}"
+            action_output.success = False
+            return
+
+        # Inventories sharing a netbox-server share one NetBox query, a
+        # federated inventory queries its own servers
+        servers = {}
+        for netbox_inventory in root.netbox_inventory:
+            if not selected or netbox_inventory.name in selected:
+                key = (
+                    str(netbox_inventory.netbox_server),
+                    netbox_inventory.name if federated(netbox_inventory) else None,
+                )
+                servers.setdefault(key, []).append(netbox_inventory)
+
+        build_status = True
+        output = []
+        planned = {}
+        for (server_name, federated_inventory), inventories in servers.items():
+            netbox_server = root.netbox_server[server_name]
+            shared = ActionMetrics(name)
+            if federated_inventory:
+                label = f"Federated inventory {federated_inventory}"
+                query = self.fetch_federated(
+                    root, netbox_server, inventories[0], shared
+                )
+            else:
+                label = f"NetBox server {server_name}"
+                query = self.fetch_shared(netbox_server, inventories, shared)
+            if query["status"]:
+                output.append(
+                    f"# {label}: {len(query['result'])} devices and VMs read for {len(inventories)} inventories"
+                )
+                output.extend(query.get("collisions", []))
+            else:
+                output.append(f"# {label}: {query['result']}")
+
+            for netbox_inventory in inventories:
+                inventory_output = action_output.inventory.create(netbox_inventory.name)
+                if not query["status"]:
+                    inventory_output.output = query["result"]
+                    inventory_output.success = False
+                    build_status = False
+                    continue
+
+                filters = inventory_filters(netbox_inventory)
+                devices = [
+                    device for device in query["result"] if device.matches(filters)
+                ]
+                metrics = ActionMetrics(name)
+                try:
+                    wanted_groups = self.build_inventory(
+                        uinfo,
+                        ugroups,
+                        name,
+                        netbox_inventory,
+                        root,
+                        netbox_server,
+                        action_input,
+                        inventory_output,
+                        metrics,
+                        devices=devices,
+                        keep=query.get("unchanged", ()),
+                    )
+                    if wanted_groups is not None:
+                        planned[netbox_inventory.name] = [
+                            group for group, members in wanted_groups.items() if members
+                        ]
+                finally:
+                    # The shared NetBox query is marked as shared, as it served
+                    # every inventory of the server and is only made once
+                    for phase_name, counters in shared.phases.items():
+                        metrics.count(f"{SHARED_PREFIX}{phase_name}", **counters)
+                    save_metrics(
+                        uinfo.username,
+                        name,
+                        ugroups,
+                        netbox_inventory._path,
+                        metrics,
+                        log=self.log,
+                    )
+                build_status = build_status and bool(inventory_output.success)
+                output.append(
+                    f"# Inventory {netbox_inventory.name}: "
+                    + ", ".join(
+                        f"{getattr(inventory_output, leaf) or 0} {leaf}"
+                        for leaf in ["created", "updated", "unchanged", "removed"]
+                    )
+                )
+
+        if action_input.commit:
+            with ncs.maapi.single_write_trans(
+                uinfo.username, name, groups=ugroups
+            ) as t:
+                t_root = ncs.maagic.get_root(t)
+                changed = apply_consolidated_groups(
+                    t_root, node._path, consolidated_groups(t_root), log=self.log
+                )
+                t.apply()
+        else:
+            # Show what the plans would change, based on their device-groups
+            with ncs.maapi.single_read_trans(uinfo.username, name, groups=ugroups) as t:
+                t_root = ncs.maagic.get_root(t)
+                changed = apply_consolidated_groups(
+                    t_root,
+                    node._path,
+                    consolidated_groups(t_root, planned),
+                    dry_run=True,
+                )
+        output.append("consolidated-device-groups: ")
+        output.extend([f"- {group}" for group in changed])
+
+        action_output.output = "\n".join(output)
+        action_output.success = build_status
+        self.log.info(action_output.output)
+
+    def fetch_federated(self, root, netbox_server, netbox_inventory, metrics):
+        """Read the devices and VMs of a federated inventory from all its servers"""
+        netbox_servers = inventory_servers(root, netbox_inventory, netbox_server)
+        with phase(metrics, "status-check"):
+            netbox_status = verify_servers(netbox_servers, clients=self.clients)
+        if not netbox_status["status"]:
+            metrics.count("status-check", errors=1)
+            return {"status": False, "result": netbox_status["message"]}
+
+        query = federated_netbox(
+            netbox_inventory,
+            netbox_servers,
+            log=self.log,
+            clients=self.clients,
+            metrics=metrics,
+        )
+        if not query["status"]:
+            return {
+                "status": False,
+                "result": f"Unable to query to netbox servers: {query['result']}",
+            }
+        return {
+            "status": True,
+            "result": query["result"],
+            "collisions": collision_report(netbox_inventory, query["collisions"]),
+            "unchanged": query["unchanged"],
+        }
+
+    def fetch_shared(self, netbox_server, inventories, metrics):
+        """Read the devices and VMs of several inventories with one NetBox query"""
+        with phase(metrics, "status-check"):
+            netbox_status = verify_netbox(netbox_server, clients=self.clients)
+        if not netbox_status["status"]:
+            metrics.count("status-check", errors=1)
+            return {"status": False, "result": netbox_status["message"]}
+
+        filters = merge_filters(
+            [inventory_filters(netbox_inventory) for netbox_inventory in inventories]
+        )
+        query = inventory_netbox(
+            None,
+            netbox_server,
+            log=self.log,
+            clients=self.clients,
+            stream=True,
+            metrics=metrics,
+            filters=filters,
+        )
+        if not query["status"]:
+            return {
+                "status": False,
+                "result": f"Unable to query to netbox server {netbox_server.url}: {query['result']}",
+            }
+        try:
+            return {"status": True, "result": list(query["result"])}
+        except Exception as e:
+            self.log.error(f"Lookup failed: {e}")
+            return {
+                "status": False,
+                "result": f"Unable to query to netbox server {netbox_server.url}: {e}",
+            }
@@ -0,0 +1,321 @@
+"""Shared NetBox API clients for the nso-netbox application
+
+"""
+
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import pynetbox
+import requests
+from requests.adapters import HTTPAdapter
+from _ncs import decrypt
+
+from .netbox_metrics import count_request
+
+# Connection pool sizing for each netbox-server session
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+# Maximum number of name to ID entries kept in the lookup cache
+LOOKUP_CACHE_SIZE = 10000
+
+# Responses that mean NetBox is overloaded or briefly unavailable
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Responses that halve the concurrency limit, NetBox asking for fewer requests
+OVERLOAD_STATUSES = {429, 503}
+
+# Only requests that can safely be sent twice are retried
+RETRY_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# Longest wait between two attempts of a request, in seconds
+MAX_BACKOFF = 30
+
+# Shortest time between two decreases of the concurrency limit, so a burst
+# of failed requests sent together only halves it once
+DECREASE_INTERVAL = 1.0
+
+
+def session_settings(netbox_server):
+    """Timeout, retry and concurrency settings of a netbox-server"""
+    return {
+        "timeout": (
+            int(netbox_server.connect_timeout),
+            int(netbox_server.read_timeout),
+        ),
+        "retries": int(netbox_server.retries),
+        "backoff": float(netbox_server.retry_backoff),
+        "max_requests": int(netbox_server.max_requests),
+    }
+
+
+class AdaptiveLimiter(object):
+    """Client side limit on concurrent requests to a NetBox server.
+
+    The limit grows by about one for every limit successful requests and is
+    halved when NetBox answers 429 or 503, times out or can't be reached
+    (additive increase, multiplicative decrease), staying between 1 and
+    maximum. Other failures leave the limit as it is.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self._active = 0
+        self._decreased = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free request slot"""
+        with self._condition:
+            while self._active >= int(self.limit):
+                self._condition.wait()
+            self._active += 1
+
+    def release(self, overloaded=False):
+        """Free a request slot, adjusting the limit to the request outcome
+
+        overloaded is True to halve the limit, False to grow it and None to
+        leave it unchanged.
+        """
+        with self._condition:
+            self._active -= 1
+            now = time.monotonic()
+            if overloaded:
+                if now - self._decreased >= DECREASE_INTERVAL:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._decreased = now
+            elif overloaded is not None:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+def backoff_delay(backoff, attempt, response=None):
+    """Seconds to wait before retrying, exponential with full jitter
+
+    A Retry-After header in seconds on the response is honoured.
+    """
+    delay = random.uniform(0, min(MAX_BACKOFF, backoff * 2 ** attempt))
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get("Retry-After", 0)))
+        except ValueError:
+            pass
+    return min(delay, MAX_BACKOFF)
+
+
+class NetboxSession(requests.Session):
+    """requests Session with default timeouts, retries and adaptive concurrency.
+
+    Requests without an explicit timeout use the netbox-server connect and
+    read timeouts. GET requests failing with a connection error, a timeout
+    or a 429 or 5xx response are retried up to retries times with jittered
+    exponential backoff, and every request waits for a slot from the
+    AdaptiveLimiter of the server.
+    """
+
+    def __init__(
+        self, timeout=None, retries=0, backoff=0.5, max_requests=None, log=None
+    ):
+        super().__init__()
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = AdaptiveLimiter(max_requests) if max_requests else None
+        self.log = log
+
+    def send_once(self, method, url, **kwargs):
+        """Send a request using a limiter slot, returning (response, error)"""
+        if self.limiter:
+            self.limiter.acquire()
+        overloaded = None
+        try:
+            response = super().request(method, url, **kwargs)
+            if response.status_code in OVERLOAD_STATUSES:
+                overloaded = True
+            elif response.status_code not in RETRY_STATUSES:
+                overloaded = False
+            return response, None
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ) as e:
+            overloaded = True
+            return None, e
+        finally:
+            if self.limiter:
+                self.limiter.release(overloaded)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        retries = self.retries if method.upper() in RETRY_METHODS else 0
+
+        attempt = 0
+        while True:
+            response, error = self.send_once(method, url, **kwargs)
+            failed = error is not None or response.status_code in RETRY_STATUSES
+            if not failed or attempt >= retries:
+                if error is not None:
+                    raise error
+                return response
+
+            delay = backoff_delay(self.backoff, attempt, response)
+            if self.log:
+                reason = error if error is not None else response.status_code
+                self.log.info(
+                    f"NetBox request {method} {url} failed ({reason}), retry {attempt + 1} of {retries} in {delay:.1f}s."
+                )
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+
+def new_session(settings=None, log=None):
+    """Create a keep-alive requests Session with a connection pool
+
+    settings from session_settings add timeouts, retries and adaptive
+    concurrency to the session.
+    """
+    session = NetboxSession(log=log, **(settings or {}))
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Count requests against the phase of the action that made them
+    session.hooks["response"].append(count_request)
+    return session
+
+
+def new_client(netbox_server, log=None):
+    """Create a pynetbox client using a session with the netbox-server settings"""
+    api = pynetbox.api(netbox_server.url, token=decrypt(netbox_server.api_token))
+    api.http_session = new_session(session_settings(netbox_server), log=log)
+    return api
+
+
+class NetboxLookupCache(object):
+    """Thread safe TTL and size bounded cache of NetBox name to ID lookups.
+
+    Entries are keyed by (server, object type, name) and hold every ID
+    NetBox returned for the name. The least recently
+    used entry is evicted once the cache holds maxsize entries. Hit and
+    miss counters are kept per server.
+    """
+
+    def __init__(self, maxsize=LOOKUP_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _count(self, server, counter):
+        counters = self._counters.setdefault(server, {"hits": 0, "misses": 0})
+        counters[counter] += 1
+
+    def get(self, server, object_type, name):
+        """Return the cached IDs for a name, or None if missing or expired"""
+        key = (server, object_type, name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self._count(server, "misses")
+                return None
+            self._entries.move_to_end(key)
+            self._count(server, "hits")
+            return entry[0]
+
+    def put(self, server, object_type, name, object_ids, ttl):
+        """Cache the IDs for a name for ttl seconds"""
+        key = (server, object_type, name)
+        with self._lock:
+            self._entries[key] = (list(object_ids), time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, server):
+        """Remove every cached entry for a server"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == server]:
+                del self._entries[key]
+
+    def stats(self, server):
+        """Hit and miss counters and entry count for a server"""
+        with self._lock:
+            counters = dict(self._counters.get(server, {"hits": 0, "misses": 0}))
+            counters["entries"] = len(
+                [key for key in self._entries if key[0] == server]
+            )
+        return counters
+
+    def clear(self, server):
+        """Remove the entries and reset the counters for a server"""
+        self.invalidate(server)
+        with self._lock:
+            self._counters.pop(server, None)
+
+
+class NetboxClientRegistry(object):
+    """Registry of pynetbox clients, one per netbox-server entry.
+
+    Clients are keyed by the netbox-server name and rebuilt whenever the
+    url, api-token, timeout, retry or concurrency settings for that server
+    change. The registry is owned by the
+    Main application and handed to every action and service through
+    init_args, together with the name to ID lookup cache shared by every
+    netbox-inventory.
+    """
+
+    def __init__(self, log=None):
+        self.log = log
+        self.lookups = NetboxLookupCache()
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, netbox_server):
+        """Return the client for a netbox-server, creating it if needed"""
+        name = str(netbox_server.name)
+        # The encrypted token changes whenever the token is re-configured,
+        # so it can be compared without decrypting it.
+        fingerprint = (
+            str(netbox_server.url),
+            str(netbox_server.api_token),
+            tuple(sorted(session_settings(netbox_server).items())),
+        )
+
+        with self._lock:
+            entry = self._clients.get(name)
+            if entry and entry["fingerprint"] == fingerprint:
+                return entry["api"]
+
+            if entry:
+                if self.log:
+                    self.log.info(
+                        f"NetBox server {name} settings changed, replacing client."
+                    )
+                entry["api"].http_session.close()
+                self.lookups.invalidate(name)
+
+            api = new_client(netbox_server, log=self.log)
+            self._clients[name] = {"fingerprint": fingerprint, "api": api}
+            return api
+
+    def discard(self, name):
+        """Drop the client for a netbox-server"""
+        with self._lock:
+            entry = self._clients.pop(str(name), None)
+        if entry:
+            entry["api"].http_session.close()
+
+    def close(self):
+        """Close all clients and their sessions"""
+        with self._lock:
+            entries = list(self._clients.values())
+            self._clients.clear()
+        for entry in entries:
+            entry["api"].http_session.close()
@@ -0,0 +1,165 @@
+"""NetBox devices cached in oper data for service managed inventories
+
+With device-management service, refresh-cache stores the NetBox devices
+and VMs of an inventory in its device-cache oper data, and the service
+create callback renders the NSO devices and device-groups from that cache
+alone. Re-deploys never query NetBox, and FASTMAP removes the devices and
+groups that are no longer rendered.
+"""
+
+import ncs
+
+from .netbox_devices import DeviceSnapshot
+from .netbox_inventory_plan import (
+    REMOVE_STATUS,
+    STATUS_ADMIN_STATES,
+    apply_device,
+    desired_device,
+    inventory_settings,
+)
+from .nso_utilities import inventory_neds, resolve_ned_types
+
+# DeviceSnapshot fields stored in the device-cache list, besides the name
+CACHE_FIELDS = [
+    "kind",
+    "address",
+    "status",
+    "model",
+    "role",
+    "site",
+    "tenant",
+    "url",
+    "last_updated",
+]
+
+
+def service_managed(netbox_inventory):
+    """Check if the devices of an inventory are created by the service"""
+    return netbox_inventory.device_management.string == "service"
+
+
+def cached_devices(device_cache):
+    """DeviceSnapshots of the entries in an inventory device-cache"""
+    return [
+        DeviceSnapshot(
+            name=entry.name,
+            **{field: getattr(entry, field) for field in CACHE_FIELDS},
+        )
+        for entry in device_cache.device
+    ]
+
+
+def held_admin_states(device_cache):
+    """Admin-states held by the entries of an inventory device-cache"""
+    return {
+        entry.name: entry.admin_state
+        for entry in device_cache.device
+        if entry.admin_state
+    }
+
+
+def write_cache(device_cache, devices, refreshed, keep=(), admin_states=None):
+    """Replace the device-cache entries with devices, only writing what changed
+
+    Entries named in keep are left as they are. An entry whose NetBox
+    status has no admin-state holds the admin-state its NSO device had,
+    from admin_states (NSO device name -> admin-state) when it is first
+    stored with that status, so render_inventory can keep it without
+    reading the NSO devices. Returns the number of entries added, updated
+    and removed.
+    """
+    counts = {"added": 0, "updated": 0, "removed": 0}
+    current = {device.name: device for device in cached_devices(device_cache)}
+    held = held_admin_states(device_cache)
+    admin_states = admin_states or {}
+
+    seen = set(keep)
+    for device in devices:
+        seen.add(device.name)
+        cached = current.get(device.name)
+        admin_state = None
+        if device.status not in STATUS_ADMIN_STATES and device.status != REMOVE_STATUS:
+            admin_state = held.get(device.name) or admin_states.get(device.name)
+        if (
+            cached is not None
+            and held.get(device.name) == admin_state
+            and all(
+                getattr(cached, field) == getattr(device, field)
+                for field in CACHE_FIELDS
+            )
+        ):
+            continue
+        entry = device_cache.device.create(device.name)
+        for field in CACHE_FIELDS:
+            value = getattr(device, field)
+            if value is not None:
+                setattr(entry, field, value)
+            elif cached is not None and getattr(cached, field) is not None:
+                delattr(entry, field)
+        if admin_state:
+            entry.admin_state = admin_state
+        elif device.name in held:
+            del entry.admin_state
+        counts["updated" if cached is not None else "added"] += 1
+
+    for device_name in set(current) - seen:
+        del device_cache.device[device_name]
+        counts["removed"] += 1
+
+    device_cache.refreshed = refreshed
+    return counts
+
+
+def render_inventory(root, service, log=False):
+    """Render the NSO devices and device-groups of an inventory from its cache
+
+    Called from the service create callback, so everything written is
+    owned by the service. The NetBox last_updated time of each entry is
+    used as the source when of its device, so a re-deploy only changes
+    the devices whose entry changed. Devices with status inventory are not rendered, and
+    devices with a status without an admin-state are rendered with the
+    admin-state held by their entry. Returns the number of devices rendered.
+    """
+    settings = inventory_settings(service)
+    neds = inventory_neds(service)
+    ned_types, ned_errors = resolve_ned_types(
+        root, list(neds["device_type"].values()) + list(neds["vm_role"].values())
+    )
+    if ned_errors:
+        raise Exception(" ".join(ned_errors))
+
+    template = ncs.template.Template(service)
+    groups = {}
+    rendered = 0
+    held = held_admin_states(service.device_cache)
+    for device in cached_devices(service.device_cache):
+        # Devices without a primary IP or kept out of NSO by their status
+        if not device.address:
+            continue
+        record = desired_device(settings, device, neds, ned_types)
+        if record["admin_state"] is None:
+            if device.status == REMOVE_STATUS:
+                continue
+            # FASTMAP removes what isn't rendered, so a device with a status
+            # without an admin-state is rendered with the admin-state it had
+            # when refresh-cache stored it, or not created
+            if device.name not in held:
+                continue
+            if log:
+                log.warning(
+                    f"Device {device.name} has NetBox status {device.status} with no admin-state, keeping its admin-state {held[device.name]}."
+                )
+            record["admin_state"] = held[device.name]
+        record["source"]["when"] = (
+            device.last_updated or service.device_cache.refreshed
+        )
+        apply_device(template, settings, record, log=log)
+        for group in record["groups"]:
+            groups.setdefault(group, []).append(record["name"])
+        rendered += 1
+
+    for group, members in sorted(groups.items()):
+        device_group = root.devices.device_group.create(group)
+        device_group.location.name = settings["path"]
+        device_group.device_name = sorted(members)
+    return rendered
@@ -0,0 +1,128 @@
+"""Compact snapshots of NetBox devices and virtual machines
+
+"""
+
+from datetime import datetime, timezone
+from ipaddress import ip_address
+
+
+def updated_time(value):
+    """Parse a NetBox last_updated timestamp into a UTC aware datetime"""
+    value = str(value)
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def latest_updated(*values):
+    """The newest of several NetBox last_updated timestamps, None if none is set
+
+    Timestamps are compared as times, as NetBox leaves out the fraction of
+    a second when it is zero. The newest is returned as it was given.
+    """
+    values = [value for value in values if value]
+    if not values:
+        return None
+    return max(values, key=updated_time)
+
+
+def nested_value(data, field, name_field="name"):
+    """Value of a field of a nested NetBox object, or None if not set"""
+    value = data.get(field)
+    if isinstance(value, dict):
+        return value.get(name_field)
+    return None
+
+
+class DeviceSnapshot(object):
+    """The values of a NetBox device or VM used by the inventory actions.
+
+    Built once from the JSON of a NetBox object, so the actions don't hold
+    pynetbox Records with their nested Records. kind is "device" or "vm",
+    model is only set for devices and address is the parsed primary IP
+    without a prefix length, or None when the object has no primary IP.
+    """
+
+    __slots__ = (
+        "name",
+        "kind",
+        "address",
+        "status",
+        "model",
+        "role",
+        "site",
+        "tenant",
+        "url",
+        "last_updated",
+    )
+
+    def __init__(
+        self,
+        name,
+        kind,
+        address=None,
+        status=None,
+        model=None,
+        role=None,
+        site=None,
+        tenant=None,
+        url=None,
+        last_updated=None,
+    ):
+        self.name = name
+        self.kind = kind
+        self.address = address
+        self.status = status
+        self.model = model
+        self.role = role
+        self.site = site
+        self.tenant = tenant
+        self.url = url
+        self.last_updated = last_updated
+
+    @classmethod
+    def from_netbox(cls, kind, data):
+        """Build a snapshot from the JSON of a NetBox device or VM"""
+        primary_ip = nested_value(data, "primary_ip", "address")
+        status = data.get("status")
+        if isinstance(status, dict):
+            status = status.get("value")
+
+        if kind == "device":
+            # NetBox 3.6 renamed the device_role field of devices to role
+            role = nested_value(data, "device_role") or nested_value(data, "role")
+            model = nested_value(data, "device_type", "model")
+        else:
+            role = nested_value(data, "role")
+            model = None
+
+        return cls(
+            name=data["name"],
+            kind=kind,
+            address=str(ip_address(primary_ip.split("/")[0])) if primary_ip else None,
+            status=status,
+            model=model,
+            role=role,
+            site=nested_value(data, "site"),
+            tenant=nested_value(data, "tenant"),
+            url=data.get("url"),
+            last_updated=data.get("last_updated"),
+        )
+
+    def matches(self, filters):
+        """Check if the device or VM matches the NetBox filters of an inventory"""
+        if filters["site"] and self.site not in filters["site"]:
+            return False
+        if filters["tenant"] and self.tenant not in filters["tenant"]:
+            return False
+        if self.kind == "device":
+            return self.model in filters["device_type"] and (
+                not filters["device_role"] or self.role in filters["device_role"]
+            )
+        return self.role in filters["vm_role"]
+
+    def __repr__(self):
+        return f"<DeviceSnapshot {self.kind} {self.name}>"
@@ -0,0 +1,218 @@
+"""Inventories federated across several NetBox servers
+
+An inventory may list additional-netbox-server entries besides its
+netbox-server. The devices and VMs of every server are read concurrently
+and merged into one result, so a build, verify or connect pass takes about
+as long as the slowest server. A name found on more than one server is
+resolved by the name-collision setting of the inventory. Names skipped
+because of a collision are left unchanged in NSO, never removed.
+"""
+
+from .netbox_utilities import (
+    inventory_filters,
+    inventory_netbox,
+    run_concurrently,
+    verify_netbox,
+)
+
+# netbox-server leaves read by the NetBox queries
+SERVER_LEAVES = [
+    "name",
+    "url",
+    "api_token",
+    "lookup_workers",
+    "lookup_cache_ttl",
+    "page_size",
+    "query_backend",
+    "connect_timeout",
+    "read_timeout",
+    "retries",
+    "retry_backoff",
+    "max_requests",
+]
+
+
+class ServerSettings(object):
+    """The leaves of a netbox-server read into plain values.
+
+    maagic nodes are bound to the action transaction and must not be used
+    from worker threads, so each server is read once before its query runs
+    in a worker.
+    """
+
+    def __init__(self, netbox_server):
+        for leaf in SERVER_LEAVES:
+            setattr(self, leaf, getattr(netbox_server, leaf))
+        self.name = str(self.name)
+
+
+def federated(netbox_inventory):
+    """Check if an inventory reads from more than its netbox-server"""
+    return len(netbox_inventory.additional_netbox_server) > 0
+
+
+def inventory_servers(root, netbox_inventory, netbox_server):
+    """netbox-server nodes of an inventory, its netbox-server node first"""
+    names = [str(netbox_server.name)]
+    servers = [netbox_server]
+    for name in netbox_inventory.additional_netbox_server:
+        if name not in names:
+            names.append(name)
+            servers.append(root.netbox_server[name])
+    return servers
+
+
+def verify_servers(netbox_servers, clients=None):
+    """Verify every NetBox Server of an inventory is reachable, concurrently"""
+    if len(netbox_servers) == 1:
+        return verify_netbox(netbox_servers[0], clients)
+
+    servers = [ServerSettings(netbox_server) for netbox_server in netbox_servers]
+    results = run_concurrently(
+        {
+            server.name: lambda server=server: verify_netbox(server, clients)
+            for server in servers
+        },
+        len(servers),
+    )
+    return {
+        "status": all(result["status"] for result in results.values()),
+        "message": "\n".join(
+            f"{name}: {result['message']}" for name, result in results.items()
+        ),
+    }
+
+
+def merge_devices(results, policy):
+    """Merge the devices of several servers, resolving name collisions
+
+    results is a list of (server name, devices) in server order. With
+    policy first-server the device of the first server listing a name is
+    kept, with skip a name listed by several servers is left out, and with
+    fail the merge fails. Returns the merged devices and a dict of each
+    colliding name to the servers listing it.
+    """
+    servers = {}
+    for server, devices in results:
+        for device in devices:
+            servers.setdefault(device.name, []).append((server, device))
+
+    collisions = {
+        name: [server for server, _ in entries]
+        for name, entries in servers.items()
+        if len(entries) > 1
+    }
+    if collisions and policy == "fail":
+        raise Exception(
+            "Devices found on more than one NetBox server: "
+            + ", ".join(
+                f"{name} ({', '.join(names)})"
+                for name, names in sorted(collisions.items())
+            )
+        )
+
+    merged = [
+        entries[0][1]
+        for name, entries in servers.items()
+        if name not in collisions or policy == "first-server"
+    ]
+    return merged, collisions
+
+
+def collision_report(netbox_inventory, collisions):
+    """Report lines for the name collisions of a federated query"""
+    policy = netbox_inventory.name_collision.string
+    lines = []
+    for name, servers in sorted(collisions.items()):
+        outcome = (
+            f"kept from {servers[0]}"
+            if policy == "first-server"
+            else "left unchanged in NSO"
+        )
+        lines.append(
+            f"# Device {name} is in NetBox servers {', '.join(servers)}, {outcome}."
+        )
+    return lines
+
+
+def federated_netbox(
+    netbox_inventory,
+    netbox_servers,
+    log=False,
+    clients=None,
+    since=None,
+    stream=False,
+    metrics=None,
+):
+    """Retrieve matching devices and Virtual Machines from every NetBox Server of an inventory
+
+    With a single server this is inventory_netbox. Otherwise every server
+    is queried in its own thread, each result is read in full so names
+    can be compared, and the results are merged by merge_devices. The
+    result includes the name collisions found, and in unchanged the names
+    left out by name-collision skip, which must not be removed from NSO.
+    """
+    if len(netbox_servers) == 1:
+        query = inventory_netbox(
+            netbox_inventory,
+            netbox_servers[0],
+            log=log,
+            clients=clients,
+            since=since,
+            stream=stream,
+            metrics=metrics,
+        )
+        query["collisions"] = {}
+        query["unchanged"] = []
+        return query
+
+    filters = inventory_filters(netbox_inventory)
+    policy = netbox_inventory.name_collision.string
+    servers = [ServerSettings(netbox_server) for netbox_server in netbox_servers]
+
+    def fetch(server):
+        query = inventory_netbox(
+            None,
+            server,
+            log=log,
+            clients=clients,
+            since=since,
+            stream=True,
+            metrics=metrics,
+            filters=filters,
+        )
+        if query["status"]:
+            query["result"] = list(query["result"])
+        return query
+
+    try:
+        queries = run_concurrently(
+            {server.name: lambda server=server: fetch(server) for server in servers},
+            len(servers),
+        )
+        failed = [
+            f"{server.name} ({server.url}): {queries[server.name]['result']}"
+            for server in servers
+            if not queries[server.name]["status"]
+        ]
+        if failed:
+            raise Exception(f"Lookup failed on {'; '.join(failed)}")
+
+        devices, collisions = merge_devices(
+            [(server.name, queries[server.name]["result"]) for server in servers],
+            policy,
+        )
+        if log and collisions:
+            log.warning(
+                f"Devices found on more than one NetBox server: {sorted(collisions)}"
+            )
+        return {
+            "status": True,
+            "result": iter(devices) if stream else devices,
+            "collisions": collisions,
+            "unchanged": sorted(collisions) if policy == "skip" else [],
+        }
+    except Exception as e:
+        if log:
+            log.error(f"Lookup failed: {e}")
+        return {"status": False, "result": e, "collisions": {}, "unchanged": []}
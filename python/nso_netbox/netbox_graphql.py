@@ -0,0 +1,137 @@
+"""GraphQL backend for NetBox device and VM queries
+
+With query-backend graphql, the devices and VMs of an inventory are read
+with a single request to the NetBox GraphQL API. The query filters by
+site, tenant, model and role names, so no name to ID lookups are needed,
+and only returns the fields the actions use. The filters follow the
+GraphQL schema of NetBox 4.3 and later.
+"""
+
+from pynetbox.core.query import RequestError
+
+from .netbox_devices import DeviceSnapshot
+
+# Fields of devices and VMs read from GraphQL, the GraphQL counterpart of
+# INVENTORY_FIELDS. NetBox only exposes primary_ip4 and primary_ip6.
+VM_FIELDS = """
+      id
+      name
+      status
+      primary_ip4 { address }
+      primary_ip6 { address }
+      site { name }
+      tenant { name }
+      role { name }
+      last_updated"""
+
+DEVICE_FIELDS = VM_FIELDS + """
+      device_type { model }"""
+
+INVENTORY_QUERY = f"""query Inventory(
+  $devices: DeviceFilter
+  $vms: VirtualMachineFilter
+  $with_devices: Boolean!
+  $with_vms: Boolean!
+) {{
+  device_list(filters: $devices) @include(if: $with_devices) {{{DEVICE_FIELDS}
+  }}
+  virtual_machine_list(filters: $vms) @include(if: $with_vms) {{{VM_FIELDS}
+  }}
+}}"""
+
+# GraphQL list -> snapshot kind and REST path used for the object url
+GRAPHQL_LISTS = {
+    "device_list": ("device", "dcim/devices"),
+    "virtual_machine_list": ("vm", "virtualization/virtual-machines"),
+}
+
+
+def graphql_url(netbox_server):
+    """URL of the GraphQL API of a NetBox Server"""
+    return f"{str(netbox_server.url).rstrip('/')}/graphql/"
+
+
+def graphql_filters(filters, kind, since=None):
+    """GraphQL filter input for the devices or VMs matching inventory filters"""
+
+    def names(field, values):
+        return {field: {"in_list": values}}
+
+    query = {}
+    if filters["site"]:
+        query["site"] = names("name", filters["site"])
+    if filters["tenant"]:
+        query["tenant"] = names("name", filters["tenant"])
+    if kind == "device":
+        query["device_type"] = names("model", filters["device_type"])
+        if filters["device_role"]:
+            query["role"] = names("name", filters["device_role"])
+    else:
+        query["role"] = names("name", filters["vm_role"])
+    if since:
+        query["last_updated"] = {"gte": since}
+    return query
+
+
+def graphql_status(status):
+    """REST status value of a GraphQL status, which may be the enum name"""
+    if status is None:
+        return None
+    status = str(status).lower()
+    if status.startswith("status_"):
+        status = status[len("status_") :]
+    return status
+
+
+def rest_object(kind, path, item, base_url):
+    """Shape a GraphQL device or VM like its REST JSON for DeviceSnapshot"""
+    data = dict(item)
+    # NetBox uses the IPv6 primary address when both are set by default
+    data["primary_ip"] = item.get("primary_ip6") or item.get("primary_ip4")
+    data["status"] = graphql_status(item.get("status"))
+    data["url"] = f"{base_url}/api/{path}/{item['id']}/"
+    return DeviceSnapshot.from_netbox(kind, data)
+
+
+def graphql_netbox(nb, netbox_server, filters, log=False, since=None):
+    """Read the devices and VMs matching inventory filters with one GraphQL query
+
+    Devices are only requested when filters has device types and VMs
+    when it has VM roles. Returns a list of DeviceSnapshots, the devices
+    followed by the VMs.
+    """
+    variables = {
+        "devices": graphql_filters(filters, "device", since),
+        "vms": graphql_filters(filters, "vm", since),
+        "with_devices": bool(filters["device_type"]),
+        "with_vms": bool(filters["vm_role"]),
+    }
+    if not (variables["with_devices"] or variables["with_vms"]):
+        return []
+    if log:
+        log.info(f"Looking up NetBox devices and vms with GraphQL: {variables}")
+
+    headers = {"accept": "application/json"}
+    if nb.token:
+        headers["authorization"] = f"Token {nb.token}"
+    response = nb.http_session.post(
+        graphql_url(netbox_server),
+        json={"query": INVENTORY_QUERY, "variables": variables},
+        headers=headers,
+    )
+    if not response.ok:
+        raise RequestError(response)
+    content = response.json()
+    if content.get("errors"):
+        raise Exception(
+            "GraphQL query failed: "
+            + "; ".join(error.get("message", "") for error in content["errors"])
+        )
+
+    base_url = str(netbox_server.url).rstrip("/")
+    data = content.get("data") or {}
+    return [
+        rest_object(kind, path, item, base_url)
+        for field, (kind, path) in GRAPHQL_LISTS.items()
+        for item in data.get(field) or []
+    ]
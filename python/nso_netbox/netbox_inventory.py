@@ -2,6 +2,7 @@
 import ncs
 from ncs.application import Service
 from .netbox_utilities import verify_netbox, devicelist_netbox
+from .netbox_device_cache import render_inventory, service_managed
 from ipaddress import ip_address
 
 
@@ -24,6 +25,13 @@ class NetboxInventoryServiceCallbacks(Service):
             )
             return
 
+        # Service managed inventories render their devices from the device-cache
+        if service_managed(service):
+            rendered = render_inventory(root, service, log=self.log)
+            self.log.info(
+                f"NSO Inventory {service.name} rendered {rendered} devices from the device-cache refreshed {service.device_cache.refreshed}."
+            )
+
     # The pre_modification() and post_modification() callbacks are optional,
     # and are invoked outside FASTMAP. pre_modification() is invoked before
     # create, update, or delete of the service, as indicated by the enum
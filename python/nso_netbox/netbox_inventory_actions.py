@@ -3,32 +3,57 @@ from ncs.dp import Action
 
 # from _ncs import decrypt
 import ncs.maapi as maapi
-import _ncs.maapi as _maapi
-from .netbox_utilities import verify_netbox, devicelist_netbox, vmlist_netbox
-from ipaddress import ip_address
+from .netbox_utilities import (
+    inventory_filters,
+    abandoned_workers,
+    inventory_fingerprint,
+    read_stream,
+    run_with_deadlines,
+)
 from datetime import datetime
-import json
-from _ncs.error import Error
-import pynetbox
-
-# TODO: Move to utilities file
-def get_users_groups(trans, uinfo):
-    # Get the maapi socket
-    s = trans.maapi.msock
-    auth = _maapi.get_authorization_info(s, uinfo.usid)
-    return list(auth.groups)
-
-
-# Constancs and Values for use
-PROTOCOL_PORTS = {
-    "ssh": 22,
-    "telnet": 23,
-    "http": 80,
-    "https": 443,
-}
+import time
+from .netbox_metrics import ActionMetrics, phase, save_metrics
+from .netbox_plan_store import discard_plan, load_plan, store_plan
+from .netbox_device_cache import service_managed, write_cache
+from .netbox_devices import latest_updated
+from .netbox_federation import (
+    collision_report,
+    federated,
+    federated_netbox,
+    inventory_servers,
+    merge_devices,
+    verify_servers,
+)
+from .netbox_reports import InventoryReport
+from .netbox_snapshots import InventorySnapshot
+from .nso_utilities import (
+    get_users_groups,
+    inventory_neds,
+    read_devices,
+    resolve_ned_types,
+)
+from .netbox_inventory_plan import (
+    PROTOCOL_PORTS,
+    apply_device,
+    apply_groups,
+    batches,
+    device_messages,
+    group_changes,
+    inventory_groups,
+    inventory_settings,
+    normalize_address,
+    plan_groups,
+    plan_inventory,
+    plan_removals,
+    remove_device,
+)
 
 
 class NetboxInventoryAction(Action):
+    def init(self, init_args):
+        # Shared NetBox client registry owned by the Main application
+        self.clients = init_args
+
     @Action.action
     def cb_action(self, uinfo, name, kp, action_input, action_output, trans):
         self.log.info("NetboxAction: ", name)
@@ -41,32 +66,71 @@ class NetboxInventoryAction(Action):
         ugroups = get_users_groups(trans, uinfo)
         self.log.info("groups = ", ugroups)
 
-        if name == "verify-inventory":
-            self.verify_inventory(
-                name, service, root, netbox_server, action_input, action_output
-            )
-        if name == "build-inventory":
-            self.build_inventory(
-                uinfo,
-                ugroups,
-                name,
-                service,
-                root,
-                netbox_server,
-                action_input,
-                action_output,
-            )
-        if name == "connect-inventory":
-            self.connect_inventory(
-                uinfo,
-                ugroups,
-                name,
-                service,
-                root,
-                netbox_server,
-                action_input,
-                action_output,
-            )
+        # Time each phase of the action, kept in the inventory oper data
+        metrics = ActionMetrics(name)
+        try:
+            if name == "verify-inventory":
+                self.verify_inventory(
+                    name,
+                    service,
+                    root,
+                    netbox_server,
+                    action_input,
+                    action_output,
+                    metrics,
+                )
+            if name == "build-inventory":
+                self.build_inventory(
+                    uinfo,
+                    ugroups,
+                    name,
+                    service,
+                    root,
+                    netbox_server,
+                    action_input,
+                    action_output,
+                    metrics,
+                )
+            if name == "refresh-cache":
+                self.refresh_cache(
+                    uinfo,
+                    ugroups,
+                    name,
+                    service,
+                    netbox_server,
+                    action_input,
+                    action_output,
+                    metrics,
+                )
+            if name == "remove-inventory":
+                self.remove_inventory(
+                    uinfo,
+                    ugroups,
+                    name,
+                    service,
+                    root,
+                    netbox_server,
+                    action_input,
+                    action_output,
+                    metrics,
+                )
+            if name == "connect-inventory":
+                self.connect_inventory(
+                    uinfo,
+                    ugroups,
+                    name,
+                    service,
+                    root,
+                    netbox_server,
+                    action_input,
+                    action_output,
+                    metrics,
+                )
+        finally:
+            if metrics.phases:
+                save_metrics(
+                    uinfo.username, name, ugroups, service._path, metrics, log=self.log
+                )
 
     def build_inventory(
         self,
@@ -78,293 +142,670 @@ class NetboxInventoryAction(Action):
         netbox_server,
         action_input,
         action_output,
+        metrics=None,
+        devices=None,
+        keep=(),
     ):
-        """Add NetBox Devices for the Inventory to NSO as Devices."""
+        """Add NetBox Devices for the Inventory to NSO as Devices.
+
+        devices are the NetBox devices and VMs of the inventory when they
+        were already read from NetBox, which skips the status check and the
+        NetBox query and always runs a full build, and a dry run doesn't
+        store its plan. keep names the devices to leave unchanged, such as
+        those skipped by name-collision. Returns the device-groups the plan
+        wants, with their members, or None when no plan was made. A dry run stores its plan,
+        and a plan-id applies that stored plan without querying NetBox.
+        """
 
         build_status = True
-        build_messages = []
+        report = InventoryReport(service.name, name, to_file=action_input.report_file)
+        netbox_servers = inventory_servers(root, service, netbox_server)
 
         # See if the inventory service is configured to allow updating NSO Devices
         # TODO: Consider allowing a "dry-run" of building config even if false
         if not service.update_nso_devices:
-            build_messages.append(
+            report.add_summary(
                 f"NSO Inventory {service.name} has update-nso-devices set to {service.update_nso_devices}. No NSO <devices> will be created."
             )
             build_status = False
+        if service_managed(service):
+            report.add_summary(
+                f"NSO Inventory {service.name} has device-management service. Use refresh-cache to update its devices."
+            )
+            build_status = False
+
+        # A reviewed plan from an earlier dry run is applied as it was stored
+        stored = None
+        shared_query = devices is not None
+        plan_id = action_input.plan_id if not shared_query else None
+        if plan_id:
+            loaded = load_plan(service.name, plan_id, inventory_fingerprint(service))
+            if loaded["status"]:
+                stored = loaded["result"]
+            else:
+                report.add_summary(loaded["result"])
+                build_status = False
 
         # Check if NetBox Server reachable
-        netbox_status = verify_netbox(netbox_server)
-        if not netbox_status["status"]:
-            build_messages.append(netbox_status["message"])
+        if devices is None and stored is None:
+            with phase(metrics, "status-check"):
+                netbox_status = verify_servers(netbox_servers, clients=self.clients)
+            if not netbox_status["status"]:
+                if metrics:
+                    metrics.count("status-check", errors=1)
+                report.add_summary(netbox_status["message"])
+                build_status = False
+
+        # Resolve the type of every NED used by the inventory once
+        neds = inventory_neds(service)
+        with phase(metrics, "ned-resolution"):
+            ned_types, ned_errors = resolve_ned_types(
+                root,
+                list(neds["device_type"].values()) + list(neds["vm_role"].values()),
+            )
+        if ned_errors:
+            if metrics:
+                metrics.count("ned-resolution", errors=len(ned_errors))
+            for error in ned_errors:
+                report.add_summary(error)
             build_status = False
 
         # Check if should proceed with building
         if not build_status:
-            self.log.info("\n".join(build_messages))
+            self.log.info(report.text())
             action_output.success = build_status
-            action_output.output = "\n".join(build_messages)
+            report.write_output(action_output)
             return
 
+        # Incremental builds only ask NetBox for objects changed since the last build
+        since = None
+        if stored:
+            since = stored["since"]
+        elif devices is None and action_input.incremental:
+            since = self.incremental_since(service)
+            if since is None:
+                self.log.info(f"Full build of inventory {service.name} is due.")
+
         # Create an output message that will be nice YAML friendly
-        build_messages.append("# Adding Devices to NSO from NetBox inventory.")
-        build_messages.append("devices: ")
+        if stored:
+            report.append(f"# Applying stored plan {plan_id}.")
+        if since:
+            report.append(
+                f"# Adding Devices to NSO from NetBox inventory updated since {since}."
+            )
+        else:
+            report.append("# Adding Devices to NSO from NetBox inventory.")
+        report.append("devices: ")
+        watermark = since
+        stream_errors = []
 
         # Things good to build the inventory
+        # Lookup the devices and VMs for the inventory
+        if devices is None and stored is None:
+            query = federated_netbox(
+                service,
+                netbox_servers,
+                log=self.log,
+                clients=self.clients,
+                since=since,
+                stream=True,
+                metrics=metrics,
+            )
+            if not query["status"]:
+                report.add_summary(
+                    f"Unable to query to netbox server {netbox_server.url}"
+                )
+                report.add_summary(str(query["result"]))
+                build_status = False
+                self.log.error(report.text())
+                action_output.success = build_status
+                report.write_output(action_output)
+                return
+            devices = query["result"]
+            keep = query["unchanged"]
+            report.extend(collision_report(service, query["collisions"]))
+
         # Start a new Transaction Session
         with ncs.maapi.Maapi() as m:
             with ncs.maapi.Session(
                 m, user=uinfo.username, context=name, groups=ugroups
             ):
-                with m.start_write_trans() as t:
+                # Compare NetBox with NSO and only touch devices that differ
+                settings = inventory_settings(service)
+                with m.start_read_trans() as t:
+                    t_root = ncs.maagic.get_root(t)
+                    if stored:
+                        plan = stored["plan"]
+                    else:
+                        with phase(metrics, "plan"):
+                            plan = plan_inventory(
+                                t_root,
+                                settings,
+                                read_stream(devices, stream_errors),
+                                neds,
+                                ned_types,
+                                full=since is None,
+                                log=self.log,
+                                keep=keep,
+                            )
 
-                    # Create new service object from a writeable transaction
-                    writeable_service = ncs.maagic.get_node(t, service._path)
-                    template = ncs.template.Template(writeable_service)
+                    # Track the newest change seen for the next incremental build
+                    watermark = latest_updated(watermark, plan["last_updated"])
+
+                    # Device-group membership for the whole inventory
+                    groups = inventory_groups(t_root, settings["path"])
+                    if stored:
+                        wanted_groups = stored["wanted_groups"]
+                    else:
+                        wanted_groups = plan_groups(plan, groups, full=since is None)
+                    changed_groups = group_changes(wanted_groups, groups)
+
+                # A plan from a partial NetBox result would remove devices
+                if stream_errors:
+                    report.add_summary(
+                        f"Unable to query to netbox server {netbox_server.url}"
+                    )
+                    report.add_summary(str(stream_errors[0]))
+                    self.log.error(report.text())
+                    action_output.success = False
+                    report.write_output(action_output)
+                    return
+
+                for device_name in plan["skipped"]:
+                    if device_name in plan["kept"]:
+                        report.append(
+                            f"# Device {device_name} is missing the mandatory field primary_ip. Leaving device unchanged in NSO."
+                        )
+                    else:
+                        report.append(
+                            f"# Device {device_name} is missing the mandatory field primary_ip. Skipping device."
+                        )
+                    report.device(device_name, "skipped", "missing primary_ip")
+                for device_name, status in plan.get("unknown_status", []):
+                    report.append(
+                        f"# Device {device_name} has NetBox status {status} with no NSO admin-state. Leaving device unchanged."
+                    )
+                    report.device(device_name, "skipped", f"unknown status {status}")
+                for record in plan["create"]:
+                    report.extend(device_messages(record))
+                    report.device(record["name"], "created")
+                for record in plan["update"]:
+                    report.extend(device_messages(record))
+                    report.device(
+                        record["name"],
+                        "updated",
+                        f"changes: {', '.join(record['changes'])}",
+                    )
+                for record in plan["unchanged"]:
+                    report.device(record["name"], "unchanged")
 
-                    devices = []
+                report.append("removed: ")
+                for device_name in plan["remove"]:
+                    report.append(f"- {device_name}")
+                    report.device(device_name, "removed")
 
-                    # Only lookup devices if device_types provided
-                    if service.device_type:
-                        query = devicelist_netbox(service, netbox_server, log=self.log)
-                        if query["status"]:
-                            devices += query["result"]
-                        else:
-                            build_messages.append(
-                                f"Unable to query to netbox server {netbox_server.url}"
-                            )
-                            build_messages.append(query["result"])
-                            build_status = False
-                            self.log.error("\n".join(build_messages))
-                            action_output.success = build_status
-                            action_output.output = "\n".join(build_messages)
-                            return
-
-                    # Lookup VMs if used in inventory
-                    if service.vm_role:
-                        vms_query = vmlist_netbox(service, netbox_server, log=self.log)
-
-                        if vms_query["status"]:
-                            # devices.append(vms_query["result"])
-                            devices += vms_query["result"]
-                        else:
-                            action_output.output = vms_query["result"]
-                            action_output.success = vms_query["status"]
-                            return
-
-                    for device in devices:
-                        self.log.info(f"Processing device {device.name}")
-
-                        # Verify mandatory attributes for devices are available
-                        if not device.primary_ip: 
-                            build_messages.append(f"# Device {device.name} is missing the mandatory field primary_ip. Skipping device.")
-                            continue
-
-
-                        # NetBox Status Field will affect results
-                        #   Active          > Add / unlocked
-                        #   Staged          > Add / unlocked
-                        #   Offline         > Add / locked
-                        #   Failed          > Add / locked
-                        #   Decommissioning > Add / locked
-                        #   Planned         > Add / southbound-locked
-                        #   Inventory       > Remove
-                        #
-                        # If the service.admin_state is set, this overrides settings based on status
-                        vars = ncs.template.Variables()
-                        device_admin_state = None
-                        if service.admin_state:
-                            self.log.info(
-                                f"Admin State configured to be {service.admin_state}, overriding status from NetBox"
+                report.append("device-groups: ")
+                report.extend([f"- {group}" for group in changed_groups])
+
+                if action_input.commit:
+                    try:
+                        commit_messages = self.commit_plan(
+                            m,
+                            uinfo,
+                            ugroups,
+                            name,
+                            service,
+                            settings,
+                            plan,
+                            wanted_groups,
+                            groups,
+                            action_input.batch_size,
+                            bool(stored) and action_input.resume,
+                            metrics,
+                        )
+                        for line in commit_messages:
+                            report.add_summary(line)
+                        if stored:
+                            discard_plan(service.name)
+                    except Exception as e:
+                        self.log.error(f"Build of inventory {service.name} failed: {e}")
+                        report.add_summary(f"# Commit failed: {e}")
+                        if stored:
+                            report.add_summary(
+                                f"# Committed batches are kept, run build-inventory with plan-id {action_input.plan_id} resume true to continue."
                             )
-                            device_admin_state = service.admin_state
                         else:
-                            if device.status.value in ["active", "staged"]:
-                                device_admin_state = "unlocked"
-                            elif device.status.value in [
-                                "offline",
-                                "failed",
-                                "decommissioning",
-                            ]:
-                                device_admin_state = "locked"
-                            elif device.status.value in ["planned"]:
-                                device_admin_state = "southbound-locked"
-                            elif device.status.value in ["inventory"]:
-                                self.log.info(
-                                    f"NetBox status is {device.status}, removing device from NSO devices if found"
-                                )
-                                # TODO: Write removal code
-                                continue
-
-                            self.log.info(
-                                f"NetBox status is {device.status}, setting Admin State to match"
+                            report.add_summary(
+                                "# Committed batches are kept, run build-inventory again to continue."
                             )
+                        action_output.success = False
+                        report.write_output(action_output)
+                        return
+                else:
+                    report.add_summary(
+                        f"\n\n# Action input commit: {action_input.commit}. Devices will NOT be added to NSO."
+                    )
+                    build_status = False
+                    # build-all dry runs must not replace a plan under review
+                    if not stored and not shared_query:
+                        plan_id, expires = store_plan(
+                            service.name,
+                            plan,
+                            wanted_groups,
+                            since,
+                            inventory_fingerprint(service),
+                            int(service.plan_ttl),
+                        )
+                        report.add_summary(
+                            f"# Plan {plan_id} stored until {expires} UTC. Apply it with build-inventory commit true plan-id {plan_id}"
+                        )
 
-                        # TODO: Create NSO Device Groups for Types/Models/Tenants that consolidate the groups from any NetBox Inventory Instance
-                        # What NSO Device Groups to add device
-                        nso_groups = [
-                            f"NetBoxInventory {service.name}",
-                        ]
+                report.add_summary(
+                    f"# Summary: {len(plan['create'])} created, {len(plan['update'])} updated, {len(plan['unchanged'])} unchanged, {len(plan['remove'])} removed, {len(changed_groups)} device-groups updated"
+                )
+                action_output.created = len(plan["create"])
+                action_output.updated = len(plan["update"])
+                action_output.unchanged = len(plan["unchanged"])
+                action_output.removed = len(plan["remove"])
+                if plan_id:
+                    action_output.plan_id = plan_id
+
+        if action_input.commit:
+            self.save_build_state(
+                uinfo, ugroups, name, service, watermark, full_build=since is None
+            )
 
-                        # Device vs VM differences
-                        if isinstance(device, pynetbox.models.dcim.Devices): 
-                            role = device.device_role
-                            ned = service.device_type[device.device_type.model].ned
-                            nso_groups.append(
-                                f"NetBoxInventory {service.name} {device.device_type.model}"
-                            )
-                        elif isinstance(device, pynetbox.models.virtualization.VirtualMachines): 
-                            role = device.role
-                            ned = service.vm_role[device.role.name].ned
+        action_output.success = build_status
+        report.write_output(action_output)
+        return wanted_groups
 
-                        # Add role based group
-                        nso_groups.append(
-                            f"NetBoxInventory {service.name} {role.name}",
+    def commit_plan(
+        self,
+        m,
+        uinfo,
+        ugroups,
+        name,
+        service,
+        settings,
+        plan,
+        wanted_groups,
+        groups,
+        batch_size,
+        resume,
+        metrics=None,
+    ):
+        """Commit a build plan in batches, recording progress in oper data.
+
+        resume is only set for a stored plan, which still lists the devices
+        committed before a failure. A new plan compares with NSO and already
+        leaves them out.
+        """
+        messages = []
+
+        # Group only changes are covered by the group updates
+        records = sorted(
+            [
+                record
+                for record in plan["create"] + plan["update"]
+                if record.get("changes") != ["groups"]
+            ],
+            key=lambda record: record["name"],
+        )
+
+        # Skip the devices of a stored plan committed by a run that failed part way
+        resume_after = service.build_state.last_committed_device
+        if resume and resume_after:
+            messages.append(f"# Resuming after device {resume_after}")
+            records = [record for record in records if record["name"] > resume_after]
+
+        for number, batch in enumerate(batches(records, batch_size), start=1):
+            started = time.monotonic()
+            with m.start_write_trans() as t:
+                writeable_service = ncs.maagic.get_node(t, service._path)
+                template = ncs.template.Template(writeable_service)
+                with phase(metrics, "template-apply", devices=len(batch)):
+                    for record in batch:
+                        self.log.info(
+                            f"Applying templates to add device {record['name']} to NSO."
                         )
+                        apply_device(template, settings, record, log=self.log)
+                with phase(metrics, "commit", devices=len(batch)):
+                    t.apply()
+            elapsed = time.monotonic() - started
+            self.save_build_progress(uinfo, ugroups, name, service, batch[-1]["name"])
+            messages.append(
+                f"# Batch {number}: {len(batch)} devices committed in {elapsed:.2f} seconds"
+            )
 
-                        # Add role based on tenant 
-                        if device.tenant: 
-                            nso_groups.append(
-                                f"NetBoxInventory {service.name} {device.tenant.name}"                                
-                            )
+        messages += self.commit_removals(m, plan["remove"], groups, batch_size, metrics)
+
+        started = time.monotonic()
+        with m.start_write_trans() as t:
+            with phase(metrics, "groups"):
+                apply_groups(
+                    ncs.maagic.get_root(t),
+                    settings,
+                    wanted_groups,
+                    groups,
+                    log=self.log,
+                )
+            with phase(metrics, "commit"):
+                t.apply()
+        elapsed = time.monotonic() - started
+        messages.append(f"# Device-groups committed in {elapsed:.2f} seconds")
+
+        self.save_build_progress(uinfo, ugroups, name, service, None)
+        return messages
+
+    def commit_removals(self, m, device_names, groups, batch_size, metrics=None):
+        """Delete devices from NSO in batches, one transaction per batch."""
+        messages = []
+
+        # Removed devices leave their groups in the same batch they are deleted in
+        for number, batch in enumerate(batches(device_names, batch_size), start=1):
+            started = time.monotonic()
+            with m.start_write_trans() as t:
+                t_root = ncs.maagic.get_root(t)
+                with phase(metrics, "remove", devices=len(batch)):
+                    for device_name in batch:
+                        self.log.info(f"Removing device {device_name} from NSO.")
+                        remove_device(t_root, device_name, groups)
+                with phase(metrics, "commit", devices=len(batch)):
+                    t.apply()
+            elapsed = time.monotonic() - started
+            messages.append(
+                f"# Removal batch {number}: {len(batch)} devices removed in {elapsed:.2f} seconds"
+            )
+        return messages
+
+    def save_build_progress(self, uinfo, ugroups, name, service, device_name):
+        """Record the last device committed by a batched build in CDB oper data."""
+        with ncs.maapi.single_write_trans(
+            uinfo.username, name, groups=ugroups, db=ncs.OPERATIONAL
+        ) as t:
+            state = ncs.maagic.get_node(t, service._path).build_state
+            if device_name:
+                state.last_committed_device = device_name
+            elif state.last_committed_device:
+                del state.last_committed_device
+            t.apply()
+
+    def incremental_since(self, service):
+        """Return the last_updated watermark to build from, or None when a full build is due."""
+        state = service.build_state
+        if not state.last_updated or not state.last_full_build:
+            return None
+
+        # last_updated of different NetBox servers can't share one watermark
+        if federated(service):
+            self.log.info(
+                f"Inventory {service.name} uses several NetBox servers, always building in full."
+            )
+            return None
 
-                        # Set Metadata on device for source of inventory info
-                        source = {
-                            "context": None,
-                            "when": datetime.utcnow().isoformat(timespec="seconds"),
-                            "source": service._path,
-                        }
-
-                        # If a URL address for device returned, apply it
-                        # TODO: Add logic to construct address for older NetBox servers
-                        if device.url: 
-                            source["context"] = {
-                                "web": device.url.replace("/api", ""),
-                                "api": device.url,
-                            }
-
-                        # Populate Variables for creating device
-                        vars.add("DEVICE_NAME", device.name)
-                        vars.add(
-                            "DEVICE_ADDRESS",
-                            ip_address(device.primary_ip.address.split("/")[0]),
-                        )
-                        vars.add("DEVICE_DESCRIPTION", role.name)
-                        vars.add("AUTH_GROUP", service.auth_group)
-
-                        # Determine if this NED is a "cli" or "generic"
-                        device_package = root.packages.package[ned]
-                        for component in device_package.component:
-                            # Find the component that ties to the NED name
-                            # Note: The cisco-iosxr ned uses cisco-ios-xr as the component name. Pulling out "-"'s for this test
-                            if component.name.replace("-", "") in ned.replace("-", ""):
-                                # TODO: There is likely a better way to do this, but component.ned.cli is an ncs.maagic.Container, and can't figure out how to see if "empty" in Python
-                                # Is it a CLI ned?
-                                try:
-                                    component.ned.cli.ned_id
-                                    ned_type = "cli"
-                                except Error:
-                                    pass
-                                # Is it a Generic NED
-                                try:
-                                    component.ned.generic.ned_id
-                                    ned_type = "generic"
-                                except Error:
-                                    pass
-
-                        # Port/Protocol Conversion Logic
-                        if service.connection_protocol.string in PROTOCOL_PORTS.keys():
-                            connection_port = PROTOCOL_PORTS[
-                                service.connection_protocol.string
-                            ]
-                        else:
-                            connection_port = ""
-
-                        # Remaining Variables for template
-                        vars.add("NED_ID", ned)
-                        vars.add("NED_TYPE", ned_type)
-                        vars.add("PROTOCOL", service.connection_protocol)
-                        vars.add("PORT", connection_port)
-                        vars.add("ADMIN_STATE", device_admin_state)
-                        vars.add("SOURCE_CONTEXT", json.dumps(source["context"]))
-                        vars.add("SOURCE_SOURCE", source["source"])
-                        vars.add("SOURCE_WHEN", source["when"])
-                        vars.add(
-                            "BYPASS_CERT_VERIFY",
-                            service.bypass_certificate_verification,
-                        )
+        # Filter changes and the periodic full sweep both need every device
+        if state.fingerprint != inventory_fingerprint(service):
+            self.log.info(
+                f"Inventory {service.name} definition changed since last build."
+            )
+            return None
+        last_full_build = datetime.fromisoformat(state.last_full_build)
+        if (
+            datetime.utcnow() - last_full_build
+        ).total_seconds() >= service.full_build_interval:
+            return None
+
+        return state.last_updated
+
+    def save_build_state(self, uinfo, ugroups, name, service, watermark, full_build):
+        """Record the build watermark for an inventory in CDB oper data."""
+        with ncs.maapi.single_write_trans(
+            uinfo.username, name, groups=ugroups, db=ncs.OPERATIONAL
+        ) as t:
+            state = ncs.maagic.get_node(t, service._path).build_state
+            if watermark:
+                state.last_updated = watermark
+            if full_build:
+                state.last_full_build = datetime.utcnow().isoformat(timespec="seconds")
+                state.fingerprint = inventory_fingerprint(service)
+            t.apply()
+
+    def refresh_cache(
+        self,
+        uinfo,
+        ugroups,
+        name,
+        service,
+        netbox_server,
+        action_input,
+        action_output,
+        metrics=None,
+    ):
+        """Store the NetBox Devices for the Inventory in its device-cache and re-deploy it."""
+        output = []
+        action_output.success = False
+        if not service_managed(service):
+            action_output.output = f"NSO Inventory {service.name} has device-management action. Use build-inventory to update its devices."
+            self.log.info(action_output.output)
+            return
 
-                        # Create output message for user
-                        build_messages.append(f"- device: {device.name}")
-                        build_messages.append(
-                            f"  address: {ip_address(device.primary_ip.address.split('/')[0])}"
-                        )
-                        build_messages.append(f"  port: {connection_port}")
-                        build_messages.append(f"  description: {role.name}")
-                        build_messages.append(f"  auth-group: {service.auth_group}")
-
-                        build_messages.append("  device-type: ")
-                        build_messages.append(f"    {ned_type}:")
-                        build_messages.append(f"      ned-id: {ned}")
-                        build_messages.append(
-                            f"      protocol: {service.connection_protocol}"
-                        )
+        netbox_servers = inventory_servers(
+            ncs.maagic.get_root(service), service, netbox_server
+        )
+
+        with phase(metrics, "status-check"):
+            netbox_status = verify_servers(netbox_servers, clients=self.clients)
+        if not netbox_status["status"]:
+            if metrics:
+                metrics.count("status-check", errors=1)
+            action_output.output = netbox_status["message"]
+            return
+
+        query = federated_netbox(
+            service,
+            netbox_servers,
+            log=self.log,
+            clients=self.clients,
+            stream=True,
+            metrics=metrics,
+        )
+        if not query["status"]:
+            action_output.output = (
+                f"Unable to query to netbox server {netbox_server.url}\n{query['result']}"
+            )
+            return
+        output.extend(collision_report(service, query["collisions"]))
+
+        # Admin-states held for devices whose NetBox status has none
+        with ncs.maapi.single_read_trans(uinfo.username, name, groups=ugroups) as t:
+            admin_states = {
+                device_name: device["admin_state"]
+                for device_name, device in read_devices(t).items()
+            }
+
+        refreshed = datetime.utcnow().isoformat(timespec="seconds")
+        stream_errors = []
+        with ncs.maapi.single_write_trans(
+            uinfo.username, name, groups=ugroups, db=ncs.OPERATIONAL
+        ) as t:
+            device_cache = ncs.maagic.get_node(t, service._path).device_cache
+            with phase(metrics, "cache-write"):
+                counts = write_cache(
+                    device_cache,
+                    read_stream(query["result"], stream_errors),
+                    refreshed,
+                    keep=query["unchanged"],
+                    admin_states=admin_states,
+                )
+            # Leave the cache as it was rather than store a partial result
+            if stream_errors:
+                output.append(
+                    f"Unable to query to netbox server {netbox_server.url}\n{stream_errors[0]}"
+                )
+                action_output.output = "\n".join(output)
+                self.log.error(action_output.output)
+                return
+            devices = len(device_cache.device)
+            t.apply()
+        output.append(
+            f"# Cached {devices} devices at {refreshed} UTC: {counts['added']} added, {counts['updated']} updated, {counts['removed']} removed"
+        )
+        action_output.devices = devices
+        action_output.added = counts["added"]
+        action_output.updated = counts["updated"]
+        action_output.removed = counts["removed"]
+
+        # The service renders the devices, a re-deploy applies the new cache
+        changed = counts["added"] + counts["updated"] + counts["removed"]
+        if action_input.re_deploy and changed:
+            with ncs.maapi.single_read_trans(
+                uinfo.username, name, groups=ugroups
+            ) as t:
+                with phase(metrics, "re-deploy"):
+                    ncs.maagic.get_node(t, service._path).re_deploy()
+            output.append(f"# Re-deployed inventory {service.name}")
+            action_output.re_deployed = True
+
+        action_output.output = "\n".join(output)
+        action_output.success = True
+        self.log.info(action_output.output)
+
+    def remove_inventory(
+        self,
+        uinfo,
+        ugroups,
+        name,
+        service,
+        root,
+        netbox_server,
+        action_input,
+        action_output,
+        metrics=None,
+    ):
+        """Remove NSO Devices of the Inventory that NetBox no longer lists for it."""
+
+        remove_status = True
+        report = InventoryReport(service.name, name, to_file=action_input.report_file)
+        netbox_servers = inventory_servers(root, service, netbox_server)
+
+        # See if the inventory service is configured to allow updating NSO Devices
+        if not service.update_nso_devices:
+            report.add_summary(
+                f"NSO Inventory {service.name} has update-nso-devices set to {service.update_nso_devices}. No NSO <devices> will be removed."
+            )
+            remove_status = False
+        if service_managed(service):
+            report.add_summary(
+                f"NSO Inventory {service.name} has device-management service. Devices it no longer renders are removed by refresh-cache."
+            )
+            remove_status = False
+
+        # Check if NetBox Server reachable
+        with phase(metrics, "status-check"):
+            netbox_status = verify_servers(netbox_servers, clients=self.clients)
+        if not netbox_status["status"]:
+            if metrics:
+                metrics.count("status-check", errors=1)
+            report.add_summary(netbox_status["message"])
+            remove_status = False
+
+        if not remove_status:
+            self.log.info(report.text())
+            action_output.success = remove_status
+            report.write_output(action_output)
+            return
 
-                        build_messages.append(f"    state: {device_admin_state}")
-                        build_messages.append("    source:")
-                        build_messages.append(
-                            f"      context: {json.dumps(source['context'])}"
+        # The full NetBox result is needed to tell which devices are gone
+        query = federated_netbox(
+            service,
+            netbox_servers,
+            log=self.log,
+            clients=self.clients,
+            stream=True,
+            metrics=metrics,
+        )
+        if not query["status"]:
+            report.add_summary(f"Unable to query to netbox server {netbox_server.url}")
+            report.add_summary(str(query["result"]))
+            self.log.error(report.text())
+            action_output.success = False
+            report.write_output(action_output)
+            return
+        report.extend(collision_report(service, query["collisions"]))
+
+        report.append("# Removing Devices from NSO no longer in NetBox inventory.")
+        report.append("removed: ")
+        stream_errors = []
+        with ncs.maapi.Maapi() as m:
+            with ncs.maapi.Session(
+                m, user=uinfo.username, context=name, groups=ugroups
+            ):
+                settings = inventory_settings(service)
+                with m.start_read_trans() as t:
+                    t_root = ncs.maagic.get_root(t)
+                    with phase(metrics, "plan"):
+                        removals = plan_removals(
+                            t_root,
+                            settings,
+                            read_stream(query["result"], stream_errors),
+                            log=self.log,
+                            keep=query["unchanged"],
                         )
-                        build_messages.append(f"      when: {source['when']}")
-                        build_messages.append(f"      source: {source['source']}")
-
-                        # Add devices to NSO Device-Groups
-                        self.log.info(f"Device will be added to groups: {nso_groups}")
-                        group_vars = ncs.template.Variables()
-                        group_vars.add("DEVICE_NAME", device.name)
-                        group_vars.add("DEVICE_GROUP_LOCATION", service._path)
-                        build_messages.append("  device-groups: ")
-                        for group in nso_groups:
-                            group_vars.add("DEVICE_GROUP_NAME", group)
-                            build_messages.append(f"  - {group}")
-
-                            self.log.info(
-                                f"Device {device.name} Group {group}: {group_vars}"
-                            )
+                    groups = inventory_groups(t_root, settings["path"])
 
-                            if action_input.commit:
-                                self.log.info(
-                                    "Applying template to add device to device-groups."
-                                )
-                                template.apply("add-device-group", group_vars)
-
-                        self.log.info(f"Device {device.name}: {vars}")
-
-                        # TODO: Look at using NSO "dry-run" feature
-                        if action_input.commit:
-                            self.log.info("Applying template to add device to NSO.")
-                            template.apply("add-device", vars)
-
-                            # Device/NED specific configuratons
-                            if "cisco-fmc" in ned:
-                                self.log.info(
-                                    f"Device {device.name} uses ned {ned}. Applying Cisco FMC specific configurations."
-                                )
-                                template.apply("add-cisco-fmc", vars)
-                            elif "vmware-vsphere" in ned:
-                                self.log.info(
-                                    f"Device {device.name} uses ned {ned}. Applying VMware specific configurations."
-                                )
-                                template.apply("add-vmware-vsphere-gen", vars)
-                        else:
-                            build_messages.append(
-                                f"\n\n# Action input commit: {action_input.commit}. Devices will NOT be added to NSO."
-                            )
-                            build_status = False
+                # Devices not read from NetBox would be removed
+                if stream_errors:
+                    report.add_summary(
+                        f"Unable to query to netbox server {netbox_server.url}"
+                    )
+                    report.add_summary(str(stream_errors[0]))
+                    self.log.error(report.text())
+                    action_output.success = False
+                    report.write_output(action_output)
+                    return
 
-                    t.apply()
+                for device_name in removals:
+                    report.append(f"- {device_name}")
+                    report.device(device_name, "removed")
 
-        action_output.output = "\n".join(build_messages)
-        action_output.success = build_status
+                if action_input.commit:
+                    try:
+                        for line in self.commit_removals(
+                            m, removals, groups, action_input.batch_size, metrics
+                        ):
+                            report.add_summary(line)
+
+                        # Drop the inventory device-groups left without members
+                        empty = [
+                            group for group, members in groups.items() if not members
+                        ]
+                        if empty:
+                            with m.start_write_trans() as t:
+                                t_root = ncs.maagic.get_root(t)
+                                for group in empty:
+                                    del t_root.devices.device_group[group]
+                                t.apply()
+                            report.add_summary(
+                                f"# Removed empty device-groups: {', '.join(empty)}"
+                            )
+                    except Exception as e:
+                        self.log.error(
+                            f"Removal from inventory {service.name} failed: {e}"
+                        )
+                        report.add_summary(f"# Commit failed: {e}")
+                        action_output.success = False
+                        report.write_output(action_output)
+                        return
+                else:
+                    report.add_summary(
+                        f"\n\n# Action input commit: {action_input.commit}. Devices will NOT be removed from NSO."
+                    )
+                    remove_status = False
+
+        report.add_summary(f"# Summary: {len(removals)} removed")
+        action_output.removed = len(removals)
+        action_output.success = remove_status
+        report.write_output(action_output)
 
     def connect_inventory(
         self,
@@ -376,263 +817,427 @@ class NetboxInventoryAction(Action):
         netbox_server,
         action_input,
         action_output,
+        metrics=None,
     ):
         """Perform connection to devices in inventory. Include fetching ssh keys and optional sync-from."""
 
         connect_status = True
-        connect_messages = []
+        report = InventoryReport(service.name, name, to_file=action_input.report_file)
+        netbox_servers = inventory_servers(root, service, netbox_server)
 
-        connect_messages.append(f"Connecting to devices from inventory {service.name}")
+        report.append(f"Connecting to devices from inventory {service.name}")
 
         # See if the inventory service is configured to allow updating NSO Devices
         if not service.update_nso_devices:
-            connect_messages.append(
+            report.add_summary(
                 f"NSO Inventory {service.name} has update-nso-devices set to {service.update_nso_devices}. No NSO <devices> will be created."
             )
             connect_status = False
 
         # Check if NetBox Server reachable
-        netbox_status = verify_netbox(netbox_server)
+        with phase(metrics, "status-check"):
+            netbox_status = verify_servers(netbox_servers, clients=self.clients)
         if not netbox_status["status"]:
-            connect_messages.append(netbox_status["message"])
+            if metrics:
+                metrics.count("status-check", errors=1)
+            report.add_summary(netbox_status["message"])
             connect_status = False
 
-        devices = []
-
-        # Only lookup devices if device_types provided
-        if service.device_type:
-            query = devicelist_netbox(service, netbox_server, log=self.log)
-            if query["status"]:
-                devices = query["result"]
-            else:
-                connect_messages.append(
-                    f"Unable to query to netbox server {netbox_server.url}"
+        # Lookup the devices and VMs for the inventory
+        query = federated_netbox(
+            service,
+            netbox_servers,
+            log=self.log,
+            clients=self.clients,
+            stream=True,
+            metrics=metrics,
+        )
+        if not query["status"]:
+            report.add_summary(
+                f"Unable to query to netbox server {netbox_server.url}"
+            )
+            report.add_summary(str(query["result"]))
+            connect_status = False
+            self.log.error(report.text())
+            action_output.success = connect_status
+            report.write_output(action_output)
+            return
+        devices = query["result"]
+        report.extend(collision_report(service, query["collisions"]))
+
+        # Verify mandatory attributes for devices are available
+        device_names = []
+        stream_errors = []
+        for device in read_stream(devices, stream_errors):
+            if not device.address:
+                report.append(
+                    f"# Device {device.name} is missing the mandatory field primary_ip. Skipping device."
                 )
-                connect_messages.append(query["result"])
-                connect_status = False
-                self.log.error("\n".join(connect_messages))
-                action_output.success = connect_status
-                action_output.output = "\n".join(connect_messages)
-                return
-
-        # Lookup VMs if used in inventory
-        if service.vm_role:
-            vms_query = vmlist_netbox(service, netbox_server, log=self.log)
-
-            if vms_query["status"]:
-                devices += vms_query["result"]
-            else:
-                action_output.output = vms_query["result"]
-                action_output.success = vms_query["status"]
-                return
-
-        for device in devices:
-            self.log.info(f"Processing device {device.name}")
-
-            # Verify mandatory attributes for devices are available
-            if not device.primary_ip: 
-                connect_messages.append(f"# Device {device.name} is missing the mandatory field primary_ip. Skipping device.")
+                report.device(device.name, "skipped", "missing primary_ip")
                 continue
+            device_names.append(device.name)
+        if stream_errors:
+            report.add_summary(f"Unable to query to netbox server {netbox_server.url}")
+            report.add_summary(str(stream_errors[0]))
+            self.log.error(report.text())
+            action_output.success = False
+            report.write_output(action_output)
+            return
 
+        # Connect to the devices in parallel, each from its own MAAPI session
+        workers = action_input.workers
+        device_timeout = action_input.device_timeout
+        fetch_host_keys = service.connection_protocol.string == "ssh"
+        sync_from = action_input.sync_from
+        self.log.info(
+            f"Connecting to {len(device_names)} devices with {workers} workers and a {device_timeout} second timeout per device"
+        )
+        results = run_with_deadlines(
+            device_names,
+            lambda device_name: self.connect_device(
+                uinfo, ugroups, name, device_name, fetch_host_keys, sync_from, metrics
+            ),
+            workers=workers,
+            timeout=device_timeout,
+            log=self.log,
+            key=netbox_server.name,
+        )
+
+        connected, failed, timed_out = 0, 0, 0
+        for device_name in device_names:
+            outcome, result = results[device_name]
+            report.append(f"Connecting to device {device_name}")
+            if outcome == "done":
+                report.extend(result["messages"])
+                if result["connected"]:
+                    report.device(device_name, "connected")
+                    connected += 1
+                else:
+                    report.device(device_name, "failed", result["info"])
+                    failed += 1
+            elif outcome == "timeout":
+                report.append(f"  - Timed out after {device_timeout} seconds")
+                if metrics:
+                    metrics.count("connect", errors=1)
+                report.device(
+                    device_name, "timed-out", f"no result after {device_timeout} seconds"
+                )
+                self.log.error(
+                    f"{device_name} timed out after {device_timeout} seconds"
+                )
+                timed_out += 1
+            else:
+                report.append(f"  - Error: {result}")
+                report.device(device_name, "failed", str(result))
+                self.log.error(f"{device_name} connect error: {result}")
+                failed += 1
+
+        report.add_summary(
+            f"Summary: {connected} connected, {failed} failed, {timed_out} timed out"
+        )
+        abandoned = abandoned_workers(netbox_server.name)
+        if abandoned:
+            report.add_summary(
+                f"# {abandoned} workers of timed out devices of netbox-server {netbox_server.name} are still running and hold worker slots until they finish."
+            )
+        if failed or timed_out:
+            connect_status = False
 
-            # TODO: Verify device in NSO first
-
-            connect_messages.append(f"Connecting to device {device.name}")
+        action_output.connected = connected
+        action_output.failed = failed
+        action_output.timed_out = timed_out
+        action_output.success = connect_status
+        report.write_output(action_output)
 
-            if service.connection_protocol.string == "ssh":
-                connect_messages.append("  - Fetching SSH Host-Keys")
-                ssh_fetch = root.devices.device[device.name].ssh.fetch_host_keys()
-                connect_messages.append(
-                    f"    result: {ssh_fetch.result} {ssh_fetch.info}"
-                )
+    def connect_device(
+        self,
+        uinfo,
+        ugroups,
+        name,
+        device_name,
+        fetch_host_keys,
+        sync_from,
+        metrics=None,
+    ):
+        """Fetch ssh host keys, connect and optionally sync-from a single device."""
+
+        messages = []
+        with ncs.maapi.single_read_trans(uinfo.username, name, groups=ugroups) as t:
+            nso_device = ncs.maagic.get_root(t).devices.device[device_name]
+
+            if fetch_host_keys:
+                messages.append("  - Fetching SSH Host-Keys")
+                with phase(metrics, "fetch-host-keys", devices=1):
+                    ssh_fetch = nso_device.ssh.fetch_host_keys()
+                if metrics and ssh_fetch.result == "failed":
+                    metrics.count("fetch-host-keys", errors=1)
+                messages.append(f"    result: {ssh_fetch.result} {ssh_fetch.info}")
                 self.log.info(
-                    f"{device.name} fetch ssh host key result: {ssh_fetch.result} {ssh_fetch.info}"
+                    f"{device_name} fetch ssh host key result: {ssh_fetch.result} {ssh_fetch.info}"
                 )
 
-            connect_messages.append("  - Testing Connecting to Device")
-            connect = root.devices.device[device.name].connect()
-            connect_messages.append(f"    result: {connect.result} {connect.info}")
+            messages.append("  - Testing Connecting to Device")
+            with phase(metrics, "connect", devices=1):
+                connect = nso_device.connect()
+            if metrics and not connect.result:
+                metrics.count("connect", errors=1)
+            messages.append(f"    result: {connect.result} {connect.info}")
             self.log.info(
-                f"{device.name} connect result: {connect.result} {connect.info}"
+                f"{device_name} connect result: {connect.result} {connect.info}"
             )
 
-            if action_input.sync_from and connect.result:
-                connect_messages.append("  - Performing sync-from")
-                syncfrom = root.devices.device[device.name].sync_from()
-                connect_messages.append(
-                    f"    result: {syncfrom.result} {syncfrom.info}"
-                )
+            if sync_from and connect.result:
+                messages.append("  - Performing sync-from")
+                with phase(metrics, "sync-from", devices=1):
+                    syncfrom = nso_device.sync_from()
+                if metrics and not syncfrom.result:
+                    metrics.count("sync-from", errors=1)
+                messages.append(f"    result: {syncfrom.result} {syncfrom.info}")
                 self.log.info(
-                    f"{device.name} sync-from result: {syncfrom.result} {syncfrom.info}"
+                    f"{device_name} sync-from result: {syncfrom.result} {syncfrom.info}"
                 )
 
-        action_output.output = "\n".join(connect_messages)
-        action_output.success = connect_status
+        return {
+            "connected": bool(connect.result),
+            "info": str(connect.info),
+            "messages": messages,
+        }
 
     def verify_inventory(
-        self, name, service, root, netbox_server, action_input, action_output
+        self,
+        name,
+        service,
+        root,
+        netbox_server,
+        action_input,
+        action_output,
+        metrics=None,
     ):
         """Verify that the NetBox Devices for the Inventory are present in NSO as Devices."""
-        netbox_status = verify_netbox(netbox_server)
-        if not netbox_status["status"]:
-            action_output.success = netbox_status["status"]
-            action_output.output = netbox_status["message"]
-            return
-
-        devices = []
-
-        # Only lookup devices if device_types provided
-        if service.device_type:
-            query = devicelist_netbox(service, netbox_server, log=self.log)
-
-            if query["status"]:
-                devices += query["result"]
-            else:
-                action_output.output = query["result"]
-                action_output.success = query["status"]
+        report = InventoryReport(service.name, name, to_file=action_input.report_file)
+        netbox_servers = inventory_servers(root, service, netbox_server)
+
+        # A snapshot verify never contacts NetBox
+        snapshots = []
+        if action_input.snapshot:
+            for server in netbox_servers:
+                snapshot = InventorySnapshot.load(str(server.name))
+                if snapshot is None:
+                    report.add_summary(
+                        f"No snapshot of NetBox server {server.name}, run refresh-snapshot first."
+                    )
+                    action_output.success = False
+                    report.write_output(action_output)
+                    return
+                age = snapshot.age()
+                report.add_summary(
+                    f"# Verifying against the snapshot of NetBox server {server.name} refreshed {snapshot.refreshed} UTC, {age} seconds ago."
+                )
+                snapshots.append(snapshot)
+            action_output.snapshot_age = max(snapshot.age() for snapshot in snapshots)
+        else:
+            with phase(metrics, "status-check"):
+                netbox_status = verify_servers(netbox_servers, clients=self.clients)
+            if not netbox_status["status"]:
+                if metrics:
+                    metrics.count("status-check", errors=1)
+                report.add_summary(netbox_status["message"])
+                action_output.success = netbox_status["status"]
+                report.write_output(action_output)
                 return
 
-        # Lookup VMs if used in inventory
-        if service.vm_role:
-            vms_query = vmlist_netbox(service, netbox_server, log=self.log)
+        # Resolve the type of every NED used by the inventory once
+        neds = inventory_neds(service)
+        with phase(metrics, "ned-resolution"):
+            ned_types, ned_errors = resolve_ned_types(
+                root,
+                list(neds["device_type"].values()) + list(neds["vm_role"].values()),
+            )
+        if ned_errors:
+            if metrics:
+                metrics.count("ned-resolution", errors=len(ned_errors))
+            for error in ned_errors:
+                report.add_summary(error)
+            action_output.success = False
+            report.write_output(action_output)
+            return
 
-            if vms_query["status"]:
-                devices += vms_query["result"]
-            else:
-                action_output.output = vms_query["result"]
-                action_output.success = vms_query["status"]
+        # Lookup the devices and VMs for the inventory
+        if len(snapshots) == 1:
+            devices = snapshots[0].devices(inventory_filters(service))
+        elif snapshots:
+            filters = inventory_filters(service)
+            try:
+                devices, collisions = merge_devices(
+                    [
+                        (snapshot.server, snapshot.devices(filters))
+                        for snapshot in snapshots
+                    ],
+                    service.name_collision.string,
+                )
+            except Exception as e:
+                report.add_summary(str(e))
+                action_output.success = False
+                report.write_output(action_output)
+                return
+            for line in collision_report(service, collisions):
+                report.add_summary(line)
+        else:
+            query = federated_netbox(
+                service,
+                netbox_servers,
+                log=self.log,
+                clients=self.clients,
+                stream=True,
+                metrics=metrics,
+            )
+            if not query["status"]:
+                report.add_summary(str(query["result"]))
+                action_output.success = query["status"]
+                report.write_output(action_output)
                 return
+            devices = query["result"]
+            for line in collision_report(service, query["collisions"]):
+                report.add_summary(line)
+
+        # Read every NSO device in one pass, NetBox devices are streamed below
+        with phase(metrics, "nso-read"):
+            nso_devices = read_devices(ncs.maagic.get_trans(root))
+        if metrics:
+            metrics.count("nso-read", devices=len(nso_devices))
+        service_admin_state = (
+            service.admin_state.string if service.admin_state else None
+        )
+        protocol = service.connection_protocol.string
+        port = PROTOCOL_PORTS[protocol]
 
         # Look for each NetBox device in the inventory
         verify_status = True
-        verify_messages = []
+        drift, missing = 0, 0
+        stream_errors = []
 
         # if service.device_type:
-        for device in devices:
+        for device in read_stream(devices, stream_errors):
             self.log.info(f"Testing device {device.name}")
 
             # Verify mandatory attributes for devices are available
-            if not device.primary_ip: 
-                verify_messages.append(f"# Device {device.name} is missing the mandatory field primary_ip. Skipping device.")
+            if not device.address: 
+                report.append(f"# Device {device.name} is missing the mandatory field primary_ip. Skipping device.")
+                report.device(device.name, "skipped", "missing primary_ip")
                 continue
 
             # Does the device exist
-            try:
-                nso_device = root.devices.device[device.name]
-            except KeyError:
+            nso_device = nso_devices.get(device.name)
+            if nso_device is None:
                 # If NetBox lists device as "inventory" it shouldn't be found
-                if device.status.value in ["inventory"]:
-                    verify_messages.append(
-                        f"Device {device.name} has a NetBox Status of {device.status.value}, it is not in NSO."
+                if device.status in ["inventory"]:
+                    report.append(
+                        f"Device {device.name} has a NetBox Status of {device.status}, it is not in NSO."
                     )
+                    report.device(device.name, "ok", "not in NSO as expected")
                 else:
-                    verify_messages.append(
-                        f"Device {device.name} not found in NSO <devices>."
-                    )
+                    report.append(f"Device {device.name} not found in NSO <devices>.")
+                    report.device(device.name, "missing")
+                    missing += 1
                     verify_status = False
                 continue
 
+            # Differences found for this device
+            problems = []
+
             # If NetBox lists device as "inventory" it shouldn't be found
-            if device.status.value in ["inventory"]:
-                verify_messages.append(
-                    f"Device {device.name} has a NetBox Status of {device.status.value}, it should NOT be in NSO but it is."
+            if device.status in ["inventory"]:
+                problems.append(
+                    f"Device {device.name} has a NetBox Status of {device.status}, it should NOT be in NSO but it is."
                 )
                 verify_status = False
 
             # Verify admin-state status of devices match NetBox status
-            if (
-                service.admin_state
-                and nso_device.state.admin_state != service.admin_state
-            ):
-                verify_messages.append(
-                    f"Device {device.name} has an admin_state of {nso_device.state.admin_state} which differs from service admin-state of {service.admin_state}"
+            admin_state = nso_device["admin_state"]
+            if service_admin_state and admin_state != service_admin_state:
+                problems.append(
+                    f"Device {device.name} has an admin_state of {admin_state} which differs from service admin-state of {service_admin_state}"
                 )
                 verify_status = False
             else:
                 if (
                     (
-                        device.status.value in ["active", "staged"]
-                        and nso_device.state.admin_state != "unlocked"
+                        device.status in ["active", "staged"]
+                        and admin_state != "unlocked"
                     )
                     or (
-                        device.status.value in ["offline", "failed", "decommissioning"]
-                        and nso_device.state.admin_state != "locked"
+                        device.status in ["offline", "failed", "decommissioning"]
+                        and admin_state != "locked"
                     )
                     or (
-                        device.status.value in ["planned"]
-                        and nso_device.state.admin_state != "southbound-locked"
+                        device.status in ["planned"]
+                        and admin_state != "southbound-locked"
                     )
                 ):
-                    verify_messages.append(
-                        f"Device {device.name} has an admin_state of {nso_device.state.admin_state} which differs from NetBox status of {device.status.value}"
+                    problems.append(
+                        f"Device {device.name} has an admin_state of {admin_state} which differs from NetBox status of {device.status}"
                     )
                     verify_status = False
 
             # Verify Address of device
-            if ip_address(device.primary_ip.address.split("/")[0]) != ip_address(
-                nso_device.address
-            ):
-                verify_messages.append(
-                    f"Device {device.name} has a NetBox Primary IP of {device.primary_ip.address.split('/')[0]}, NSO device is configured for address {nso_device.address}"
+            if device.address != normalize_address(nso_device["address"]):
+                problems.append(
+                    f"Device {device.name} has a NetBox Primary IP of {device.address}, NSO device is configured for address {nso_device['address']}"
                 )
                 verify_status = False
 
             # Device vs VM differences
-            if isinstance(device, pynetbox.models.dcim.Devices): 
-                role = device.device_role
-                ned = service.device_type[device.device_type.model].ned
-            elif isinstance(device, pynetbox.models.virtualization.VirtualMachines): 
-                role = device.role
-                ned = service.vm_role[device.role.name].ned
+            if device.kind == "device":
+                ned = neds["device_type"][device.model]
+            else:
+                ned = neds["vm_role"][device.role]
 
             # Verify Description of Device
-            if role.name != nso_device.description:
-                verify_messages.append(
-                    f"Device {device.name} has a NetBox Role of {role.name}, which doesn't match NSO description of {nso_device.description}"
+            if device.role != nso_device["description"]:
+                problems.append(
+                    f"Device {device.name} has a NetBox Role of {device.role}, which doesn't match NSO description of {nso_device['description']}"
                 )
                 verify_status = False
 
-            # Determine if this NED is a "cli" or "generic"
-            device_package = root.packages.package[ned]
-            for component in device_package.component:
-                # Find the component that ties to the NED name
-                if component.name.replace("-", "") in ned.replace("-", ""):
-                    # TODO: There is likely a better way to do this, but component.ned.cli is an ncs.maagic.Container, and can't figure out how to see if "empty" in Python
-                    # Is it a CLI ned?
-                    try:
-                        component.ned.cli.ned_id
-                        ned_type = "cli"
-                    except Error:
-                        pass
-                    # Is it a Generic NED
-                    try:
-                        component.ned.generic.ned_id
-                        ned_type = "generic"
-                    except Error:
-                        pass
+            ned_type = ned_types[ned]["type"]
 
             # Verify NED_ID
-            if ned != nso_device.device_type[ned_type].ned_id.split(":")[1]:
-                verify_messages.append(
-                    f"Device {device.name} has a NetBox Device Type of {device.device_type.model} which should use NED {service.device_type[device.device_type.model].ned}, but is configured for NSO NED {nso_device.device_type.cli.ned_id.split(':')[1]}"
+            if ned_type != nso_device["ned_type"] or ned != nso_device["ned"]:
+                problems.append(
+                    f"Device {device.name} has a NetBox Device Type of {device.model or device.role} which should use NED {ned}, but is configured for NSO NED {nso_device['ned']}"
                 )
                 verify_status = False
 
             # Verify Protocol
-            if ned_type == "cli" and str(service.connection_protocol) != str(
-                nso_device.device_type.cli.protocol
-            ):
-                verify_messages.append(
-                    f"Device {device.name} should use a connection protocol of {service.connection_protocol}, but is configured for {nso_device.device_type.cli.protocol}"
+            if ned_type == "cli" and protocol != nso_device["protocol"]:
+                problems.append(
+                    f"Device {device.name} should use a connection protocol of {protocol}, but is configured for {nso_device['protocol']}"
                 )
                 verify_status = False
 
             # Verify Port
-            if nso_device.port != PROTOCOL_PORTS[service.connection_protocol.string]:
-                verify_messages.append(
-                    f"Device {device.name} should use a port of {PROTOCOL_PORTS[service.connection_protocol.string]}, but is configured for {nso_device.port}"
+            if nso_device["port"] != port:
+                problems.append(
+                    f"Device {device.name} should use a port of {port}, but is configured for {nso_device['port']}"
                 )
                 verify_status = False
 
-        action_output.output = "\n".join(verify_messages)
+            report.extend(problems)
+            if problems:
+                report.device(device.name, "drift", "; ".join(problems))
+                drift += 1
+            else:
+                report.device(device.name, "ok")
+
+        # Devices after a failed NetBox page were never verified
+        if stream_errors:
+            report.add_summary(f"Unable to query to netbox server {netbox_server.url}")
+            report.add_summary(str(stream_errors[0]))
+            self.log.error(report.text())
+            action_output.success = False
+            report.write_output(action_output)
+            return
+
+        report.add_summary(f"Summary: {drift} with drift, {missing} missing")
         action_output.success = verify_status
+        report.write_output(action_output)
@@ -0,0 +1,558 @@
+"""Plan the NSO device changes for a NetBox inventory
+
+A plan compares the device records wanted by NetBox with the current
+/devices/device entries so only created, changed or removed devices are
+written to NSO.
+"""
+
+import json
+from datetime import datetime
+from ipaddress import ip_address
+
+import ncs
+
+from .netbox_devices import latest_updated
+from .nso_utilities import read_devices
+
+# Constancs and Values for use
+PROTOCOL_PORTS = {
+    "ssh": 22,
+    "telnet": 23,
+    "http": 80,
+    "https": 443,
+}
+
+# NetBox Status Field will affect results
+#   Active          > Add / unlocked
+#   Staged          > Add / unlocked
+#   Offline         > Add / locked
+#   Failed          > Add / locked
+#   Decommissioning > Add / locked
+#   Planned         > Add / southbound-locked
+#   Inventory       > Remove
+#   Anything else   > Left as it is in NSO
+STATUS_ADMIN_STATES = {
+    "active": "unlocked",
+    "staged": "unlocked",
+    "offline": "locked",
+    "failed": "locked",
+    "decommissioning": "locked",
+    "planned": "southbound-locked",
+}
+
+# NetBox status of devices that don't belong in NSO
+REMOVE_STATUS = "inventory"
+
+# Device record fields compared against the NSO device
+COMPARED_FIELDS = [
+    "address",
+    "port",
+    "description",
+    "authgroup",
+    "ned",
+    "ned_type",
+    "protocol",
+    "admin_state",
+    "groups",
+    "context",
+    "source",
+    "bypass_certificate_verification",
+]
+
+# NEDs whose settings template applies bypass-certificate-verification
+BYPASS_CERT_NEDS = ["cisco-fmc"]
+
+
+def inventory_settings(netbox_inventory):
+    """Read the NSO device settings of an inventory into plain Python values"""
+    protocol = netbox_inventory.connection_protocol.string
+    return {
+        "name": str(netbox_inventory.name),
+        "path": netbox_inventory._path,
+        "auth_group": str(netbox_inventory.auth_group),
+        "protocol": protocol,
+        "port": PROTOCOL_PORTS.get(protocol, ""),
+        "admin_state": (
+            netbox_inventory.admin_state.string
+            if netbox_inventory.admin_state
+            else None
+        ),
+        "bypass_certificate_verification": bool(
+            netbox_inventory.bypass_certificate_verification
+        ),
+    }
+
+
+def desired_device(settings, device, neds, ned_types):
+    """Build the NSO device record wanted for a NetBox device or VM snapshot"""
+
+    # If the service.admin_state is set, this overrides settings based on status
+    admin_state = settings["admin_state"] or STATUS_ADMIN_STATES.get(device.status)
+
+    # What NSO Device Groups to add device
+    groups = [f"NetBoxInventory {settings['name']}"]
+
+    # Device vs VM differences
+    if device.kind == "device":
+        ned = neds["device_type"][device.model]
+        groups.append(f"NetBoxInventory {settings['name']} {device.model}")
+    else:
+        ned = neds["vm_role"][device.role]
+
+    # Add role and tenant based groups
+    groups.append(f"NetBoxInventory {settings['name']} {device.role}")
+    if device.tenant:
+        groups.append(f"NetBoxInventory {settings['name']} {device.tenant}")
+
+    # Set Metadata on device for source of inventory info
+    # TODO: Add logic to construct address for older NetBox servers
+    context = None
+    if device.url:
+        context = {"web": device.url.replace("/api", ""), "api": device.url}
+
+    ned_type = ned_types[ned]["type"]
+    bypass = None
+    if any(name in ned for name in BYPASS_CERT_NEDS):
+        bypass = settings["bypass_certificate_verification"]
+    return {
+        "name": device.name,
+        "status": device.status,
+        "address": device.address,
+        "port": settings["port"],
+        "description": device.role,
+        "authgroup": settings["auth_group"],
+        "ned": ned,
+        "ned_type": ned_type,
+        "protocol": settings["protocol"] if ned_type == "cli" else None,
+        "admin_state": admin_state,
+        "groups": sorted(groups),
+        "bypass_certificate_verification": bypass,
+        "source": {
+            "context": context,
+            "when": datetime.utcnow().isoformat(timespec="seconds"),
+            "source": settings["path"],
+        },
+    }
+
+
+def normalize_address(address):
+    """Normalize an IP address string for comparison, leaving hostnames as is"""
+    try:
+        return str(ip_address(str(address)))
+    except ValueError:
+        return str(address)
+
+
+def current_device(root, nso_device, groups, bypass=None):
+    """The fields of an NSO device that a device record is compared to
+
+    nso_device is the read_devices entry of the device. The certificate
+    setting of the NED is only read, with maagic, when the desired record
+    sets one.
+    """
+    current = dict(nso_device)
+    current["address"] = normalize_address(nso_device["address"])
+    current["groups"] = sorted(groups)
+    current["bypass_certificate_verification"] = None
+    if bypass is not None:
+        current["bypass_certificate_verification"] = bypass_cert_verify(
+            root.devices.device[nso_device["name"]]
+        )
+    return current
+
+
+def bypass_cert_verify(nso_device):
+    """The accept-any certificate setting of a cisco-fmc device, False if unset"""
+    try:
+        accept_any = (
+            nso_device.ned_settings.cisco_fmc.cisco_fmc_connection.ssl.accept_any
+        )
+    except (AttributeError, KeyError):
+        return False
+    return bool(accept_any)
+
+
+def compared_value(record, field):
+    """Value of a device record field as read back from NSO"""
+    if field == "context":
+        return json.dumps(record["source"]["context"])
+    if field == "source":
+        return record["source"]["source"]
+    return record[field]
+
+
+def device_changes(desired, current):
+    """List the fields where the NSO device differs from the desired record"""
+    return [
+        field
+        for field in COMPARED_FIELDS
+        if compared_value(desired, field) is not None
+        and compared_value(desired, field) != current[field]
+    ]
+
+
+def inventory_groups(root, path):
+    """Device-groups created for an inventory, with their device members"""
+    groups = {}
+    for group in root.devices.device_group:
+        if group.location.name == path:
+            groups[group.name] = set(group.device_name.as_list())
+    return groups
+
+
+def plan_inventory(
+    root, settings, devices, neds, ned_types, full=True, log=False, keep=()
+):
+    """Compare NetBox devices with NSO and plan the devices to create, update and remove
+
+    Removal of devices missing from NetBox is only planned for full
+    plans, as an incremental NetBox query doesn't return every device.
+    Only devices whose source is this inventory are ever removed. Devices
+    with a NetBox status that has no admin-state, other than inventory,
+    are listed in unknown_status and kept, leaving them as they are in NSO.
+    Devices named in keep, such as names skipped by name-collision, are
+    kept the same way without being planned, as are NSO devices that lost
+    their primary IP in NetBox, which are also listed in skipped.
+
+    NSO devices are read with read_devices, only those NetBox returned for
+    an incremental plan. devices may be any iterable and is only read once. The newest
+    last_updated time seen is returned as last_updated.
+    """
+    plan = {
+        "create": [],
+        "update": [],
+        "unchanged": [],
+        "remove": [],
+        "skipped": [],
+        "unknown_status": [],
+        "kept": [],
+        "last_updated": None,
+    }
+    groups = inventory_groups(root, settings["path"])
+    if full:
+        nso_devices = read_devices(ncs.maagic.get_trans(root))
+    else:
+        # An incremental plan only needs the NSO devices NetBox returned
+        devices = list(devices)
+        nso_devices = read_devices(
+            ncs.maagic.get_trans(root), [device.name for device in devices]
+        )
+    seen = set(keep)
+    plan["kept"].extend(sorted(keep))
+
+    for device in devices:
+        if log:
+            log.info(f"Planning device {device.name}")
+        seen.add(device.name)
+        plan["last_updated"] = latest_updated(
+            plan["last_updated"], device.last_updated
+        )
+
+        # Verify mandatory attributes for devices are available
+        if not device.address:
+            plan["skipped"].append(device.name)
+            if device.name in nso_devices:
+                plan["kept"].append(device.name)
+            continue
+
+        desired = desired_device(settings, device, neds, ned_types)
+        exists = device.name in nso_devices
+
+        # NetBox devices with a status of inventory should not be in NSO
+        if desired["admin_state"] is None:
+            if device.status == REMOVE_STATUS:
+                if exists:
+                    plan["remove"].append(device.name)
+            else:
+                if log:
+                    log.warning(
+                        f"Device {device.name} has NetBox status {device.status} with no admin-state, leaving it unchanged."
+                    )
+                plan["unknown_status"].append([device.name, device.status])
+                plan["kept"].append(device.name)
+            continue
+
+        if not exists:
+            plan["create"].append(desired)
+            continue
+
+        member_of = [
+            group for group, members in groups.items() if device.name in members
+        ]
+        current = current_device(
+            root,
+            nso_devices[device.name],
+            member_of,
+            desired["bypass_certificate_verification"],
+        )
+        desired["changes"] = device_changes(desired, current)
+        if desired["changes"]:
+            plan["update"].append(desired)
+        else:
+            plan["unchanged"].append(desired)
+
+    if full:
+        members = set()
+        for group_members in groups.values():
+            members |= group_members
+        for device_name in sorted(members - seen):
+            if device_name in nso_devices:
+                plan["remove"].append(device_name)
+
+    plan["remove"] = owned_devices(nso_devices, settings, plan["remove"])
+    return plan
+
+
+def owned_devices(nso_devices, settings, device_names):
+    """Keep the devices added to NSO by this inventory
+
+    nso_devices are the read_devices entries. Devices that another source
+    added to NSO are never removed.
+    """
+    return [
+        device_name
+        for device_name in device_names
+        if nso_devices[device_name]["source"] == settings["path"]
+    ]
+
+
+def plan_removals(root, settings, devices, log=False, keep=()):
+    """Plan the NSO devices to remove for an inventory, without building the others
+
+    These are the members of the inventory device-groups that NetBox no
+    longer returns for the inventory, and the devices whose NetBox status
+    is inventory, unless the inventory admin-state overrides it. devices
+    must be the full NetBox result for the inventory and may be any iterable.
+    Devices named in keep are never removed.
+    """
+    groups = inventory_groups(root, settings["path"])
+    members = set()
+    for group_members in groups.values():
+        members |= group_members
+
+    remove = set()
+    seen = set(keep)
+    for device in devices:
+        seen.add(device.name)
+        if settings["admin_state"]:
+            continue
+        if device.status == REMOVE_STATUS:
+            remove.add(device.name)
+        elif device.status not in STATUS_ADMIN_STATES and log:
+            log.warning(
+                f"Device {device.name} has NetBox status {device.status} with no admin-state, leaving it unchanged."
+            )
+    remove |= members - seen
+
+    nso_devices = read_devices(ncs.maagic.get_trans(root), remove)
+    remove = [device_name for device_name in sorted(remove) if device_name in nso_devices]
+    if log:
+        log.info(f"Planned removal of {len(remove)} devices")
+    return owned_devices(nso_devices, settings, remove)
+
+
+def device_variables(settings, record):
+    """Template variables for adding a device record to NSO"""
+    vars = ncs.template.Variables()
+    vars.add("DEVICE_NAME", record["name"])
+    vars.add("DEVICE_ADDRESS", record["address"])
+    vars.add("DEVICE_DESCRIPTION", record["description"])
+    vars.add("AUTH_GROUP", record["authgroup"])
+    vars.add("NED_ID", record["ned"])
+    vars.add("NED_TYPE", record["ned_type"])
+    vars.add("PROTOCOL", settings["protocol"])
+    vars.add("PORT", record["port"])
+    vars.add("ADMIN_STATE", record["admin_state"])
+    vars.add("SOURCE_CONTEXT", json.dumps(record["source"]["context"]))
+    vars.add("SOURCE_SOURCE", record["source"]["source"])
+    vars.add("SOURCE_WHEN", record["source"]["when"])
+    vars.add("BYPASS_CERT_VERIFY", settings["bypass_certificate_verification"])
+    return vars
+
+
+def apply_device(template, settings, record, log=False):
+    """Apply the templates that add or update a device record in NSO"""
+    vars = device_variables(settings, record)
+    if log:
+        log.info(f"Device {record['name']}: {vars}")
+    template.apply("add-device", vars)
+
+    # Device/NED specific configuratons
+    ned = record["ned"]
+    if "cisco-fmc" in ned:
+        if log:
+            log.info(
+                f"Device {record['name']} uses ned {ned}. Applying Cisco FMC specific configurations."
+            )
+        template.apply("add-cisco-fmc", vars)
+    elif "vmware-vsphere" in ned:
+        if log:
+            log.info(
+                f"Device {record['name']} uses ned {ned}. Applying VMware specific configurations."
+            )
+        template.apply("add-vmware-vsphere-gen", vars)
+
+
+def plan_groups(plan, groups, full=True):
+    """Work out the members wanted for every inventory device-group
+
+    Membership is collected from every planned device record. A full plan
+    rebuilds each group from scratch so stale members are pruned, while an
+    incremental plan only moves the devices it saw between groups. Devices
+    the plan keeps stay in the groups they are in.
+    """
+    records = plan["create"] + plan["update"] + plan["unchanged"]
+    if full:
+        kept = set(plan.get("kept", []))
+        wanted = {group: members & kept for group, members in groups.items()}
+    else:
+        wanted = {group: set(members) for group, members in groups.items()}
+        moved = set(record["name"] for record in records) | set(plan["remove"])
+        for members in wanted.values():
+            members -= moved
+
+    for record in records:
+        for group in record["groups"]:
+            wanted.setdefault(group, set()).add(record["name"])
+    return wanted
+
+
+def group_changes(wanted, groups):
+    """Names of the inventory device-groups whose members need to change"""
+    return [
+        group
+        for group, members in sorted(wanted.items())
+        if members != groups.get(group)
+    ]
+
+
+def apply_groups(root, settings, wanted, groups, log=False):
+    """Write each changed inventory device-group membership as one leaf-list update
+
+    Groups left without members are deleted. Returns the names of the
+    groups that were written.
+    """
+    changed = group_changes(wanted, groups)
+    for group in changed:
+        members = wanted[group]
+        groups[group] = set(members)
+
+        if not members:
+            if log:
+                log.info(f"Removing empty device-group {group}")
+            del root.devices.device_group[group]
+            continue
+
+        if log:
+            log.info(f"Setting device-group {group} to {len(members)} devices")
+        device_group = root.devices.device_group.create(group)
+        device_group.location.name = settings["path"]
+        device_group.device_name = sorted(members)
+
+    return changed
+
+
+def batches(items, size):
+    """Split items into lists of at most size items, or one list if size is 0"""
+    items = list(items)
+    if not size:
+        return [items] if items else []
+    return [items[start : start + size] for start in range(0, len(items), size)]
+
+
+def remove_device(root, device_name, groups):
+    """Remove a device from NSO along with its inventory device-group memberships"""
+    for group, members in groups.items():
+        if device_name in members:
+            root.devices.device_group[group].device_name.remove(device_name)
+            members.discard(device_name)
+    del root.devices.device[device_name]
+
+
+def device_messages(record):
+    """YAML friendly output lines describing a planned device record"""
+    messages = [
+        f"- device: {record['name']}",
+        f"  address: {record['address']}",
+        f"  port: {record['port']}",
+        f"  description: {record['description']}",
+        f"  auth-group: {record['authgroup']}",
+        "  device-type: ",
+        f"    {record['ned_type']}:",
+        f"      ned-id: {record['ned']}",
+    ]
+    if record["protocol"]:
+        messages.append(f"      protocol: {record['protocol']}")
+    messages += [
+        f"    state: {record['admin_state']}",
+        "    source:",
+        f"      context: {json.dumps(record['source']['context'])}",
+        f"      when: {record['source']['when']}",
+        f"      source: {record['source']['source']}",
+    ]
+    if record.get("changes"):
+        messages.append(f"  changes: {', '.join(record['changes'])}")
+    messages.append("  device-groups: ")
+    messages += [f"  - {group}" for group in record["groups"]]
+    return messages
+
+
+def consolidated_groups(root, planned=None):
+    """Work out the device-groups that combine the groups of every inventory
+
+    Each inventory has groups named "NetBoxInventory <inventory> <value>"
+    for its device types, roles and tenants. The consolidated group
+    "NetBox <value>" holds the matching group of every inventory, and
+    "NetBox All" holds the group of each whole inventory. planned maps
+    inventory names to the group names of a plan not yet committed, used
+    instead of the groups in NSO.
+    """
+    planned = planned or {}
+    wanted = {}
+    for netbox_inventory in root.netbox_inventory:
+        prefix = f"NetBoxInventory {netbox_inventory.name}"
+        groups = planned.get(netbox_inventory.name)
+        if groups is None:
+            groups = inventory_groups(root, netbox_inventory._path)
+        for group in groups:
+            value = group[len(prefix) :].strip()
+            consolidated = f"NetBox {value}" if value else "NetBox All"
+            wanted.setdefault(consolidated, set()).add(group)
+    return wanted
+
+
+def apply_consolidated_groups(root, path, wanted, log=False, dry_run=False):
+    """Write the consolidated device-groups as nested groups of inventory groups
+
+    Consolidated groups left without inventory groups are deleted.
+    Returns the names of the groups that were written, or with dry_run
+    that would be, without writing them.
+    """
+    current = {}
+    for group in root.devices.device_group:
+        if group.location.name == path:
+            current[group.name] = set(group.device_group.as_list())
+
+    changed = []
+    for group in sorted(set(current) | set(wanted)):
+        members = wanted.get(group, set())
+        if members == current.get(group):
+            continue
+        changed.append(group)
+        if dry_run:
+            continue
+        if not members:
+            if log:
+                log.info(f"Removing empty consolidated device-group {group}")
+            del root.devices.device_group[group]
+            continue
+
+        if log:
+            log.info(
+                f"Setting consolidated device-group {group} to {len(members)} groups"
+            )
+        device_group = root.devices.device_group.create(group)
+        device_group.location.name = path
+        device_group.device_group = sorted(members)
+
+    return changed
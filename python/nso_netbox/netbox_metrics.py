@@ -0,0 +1,230 @@
+"""Per-phase timing and counters for NetBox inventory actions"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+import ncs
+
+# Phases currently running in each thread, innermost last
+_active = threading.local()
+
+
+def active_phases():
+    """The (metrics, phase) stack of the current thread"""
+    if not hasattr(_active, "phases"):
+        _active.phases = []
+    return _active.phases
+
+
+def nested_durations():
+    """The [metrics, seconds of nested phases] stack of the current thread"""
+    if not hasattr(_active, "nested"):
+        _active.nested = []
+    return _active.nested
+
+
+def current_phase():
+    """The innermost (metrics, phase) running in this thread, or None"""
+    phases = active_phases()
+    return phases[-1] if phases else None
+
+
+def count_request(response, *args, **kwargs):
+    """requests response hook counting NetBox requests against the current phase"""
+    phase = current_phase()
+    if phase:
+        metrics, name = phase
+        metrics.count(name, requests=1)
+
+
+def within(phase, call):
+    """Wrap a callable so it runs as part of phase in whichever thread calls it"""
+    if phase is None:
+        return call
+
+    def run(*args, **kwargs):
+        phases = active_phases()
+        phases.append(phase)
+        try:
+            return call(*args, **kwargs)
+        finally:
+            phases.pop()
+
+    return run
+
+
+class ActionMetrics(object):
+    """Duration, request, device and error counts for each phase of an action run.
+
+    Phases may be entered from several threads and more than once, their
+    counters are added together. The time of a phase entered inside
+    another in the same thread, such as the device-fetch of a stream read
+    while planning, is only counted in the inner phase.
+    """
+
+    def __init__(self, action):
+        self.action = action
+        self.started = datetime.utcnow().isoformat(timespec="seconds")
+        self.phases = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, name, duration=0, requests=0, devices=0, errors=0):
+        """Add to the counters of a phase"""
+        with self._lock:
+            phase = self.phases.setdefault(
+                name, {"duration": 0.0, "requests": 0, "devices": 0, "errors": 0}
+            )
+            phase["duration"] += duration
+            phase["requests"] += requests
+            phase["devices"] += devices
+            phase["errors"] += errors
+
+    @contextmanager
+    def phase(self, name, devices=0):
+        """Time a block of work as a phase, counting an error if it raises"""
+        phases = active_phases()
+        phases.append((self, name))
+        nested = nested_durations()
+        nested.append([self, 0.0])
+        started = time.monotonic()
+        errors = 0
+        try:
+            yield self
+        except Exception:
+            errors = 1
+            raise
+        finally:
+            phases.pop()
+            duration = time.monotonic() - started
+            _, inner = nested.pop()
+            if nested and nested[-1][0] is self:
+                nested[-1][1] += duration
+            self.count(
+                name,
+                duration=duration - inner,
+                devices=devices,
+                errors=errors,
+            )
+
+    def iterate(self, name, items):
+        """Yield from items, timing each step as the phase and counting devices"""
+        iterator = iter(items)
+        while True:
+            with self.phase(name) as metrics:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                metrics.count(name, devices=1)
+            yield item
+
+
+def phase(metrics, name, devices=0):
+    """metrics.phase, or a context doing nothing when metrics is None"""
+    if metrics is None:
+        return nullcontext()
+    return metrics.phase(name, devices)
+
+
+def iterate(metrics, name, items):
+    """metrics.iterate, or items unchanged when metrics is None"""
+    if metrics is None:
+        return items
+    return metrics.iterate(name, items)
+
+
+def label_value(value):
+    """Escape a Prometheus label value"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(root):
+    """Prometheus text exposition of the last metrics of every inventory"""
+    gauges = [
+        ("duration", "seconds", "Seconds spent in the phase"),
+        ("requests", "", "NetBox requests made during the phase"),
+        ("devices", "", "Devices processed in the phase"),
+        ("errors", "", "Errors raised or reported in the phase"),
+    ]
+    lines = []
+    for leaf, unit, description in gauges:
+        metric = f"nso_netbox_phase_{leaf}" + (f"_{unit}" if unit else "")
+        lines.append(f"# HELP {metric} {description} during the last action run.")
+        lines.append(f"# TYPE {metric} gauge")
+        for netbox_inventory in root.netbox_inventory:
+            for entry in netbox_inventory.metrics.phase:
+                labels = ",".join(
+                    f'{label}="{label_value(value)}"'
+                    for label, value in [
+                        ("inventory", netbox_inventory.name),
+                        ("action", entry.action),
+                        ("phase", entry.name),
+                    ]
+                )
+                lines.append(f"{metric}{{{labels}}} {getattr(entry, leaf)}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_file(path, text):
+    """Replace a Prometheus text file in one step so scrapes never see part of it"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as metrics_file:
+        metrics_file.write(text)
+    os.replace(temporary, path)
+
+
+def save_metrics(user, context, groups, inventory_path, metrics, log=None):
+    """Store the metrics of an action run in the inventory oper data
+
+    The phases of the previous run of the same action are replaced. When
+    netbox-metrics prometheus-file is set, the file is rewritten with the
+    metrics of every inventory. Called once the action is done, so errors
+    are logged rather than raised over the result or error of the action.
+    """
+    try:
+        write_metrics(user, context, groups, inventory_path, metrics, log=log)
+    except Exception as e:
+        if log:
+            log.error(f"Unable to save metrics of {metrics.action}: {e}")
+
+
+def write_metrics(user, context, groups, inventory_path, metrics, log=None):
+    """Write the metrics of an action run and the prometheus-file, see save_metrics"""
+    with ncs.maapi.single_write_trans(
+        user, context, groups=groups, db=ncs.OPERATIONAL
+    ) as t:
+        root = ncs.maagic.get_root(t)
+        phases = ncs.maagic.get_node(t, inventory_path).metrics.phase
+        previous = [
+            (entry.action, entry.name)
+            for entry in phases
+            if entry.action == metrics.action
+        ]
+        for key in previous:
+            del phases[key]
+        for name, counters in metrics.phases.items():
+            entry = phases.create(metrics.action, name)
+            entry.last_run = metrics.started
+            entry.duration = f"{counters['duration']:.3f}"
+            entry.requests = counters["requests"]
+            entry.devices = counters["devices"]
+            entry.errors = counters["errors"]
+
+        prometheus_file = str(root.netbox_metrics.prometheus_file or "")
+        if prometheus_file:
+            text = prometheus_text(root)
+        t.apply()
+
+    if prometheus_file:
+        try:
+            write_prometheus_file(prometheus_file, text)
+        except OSError as e:
+            if log:
+                log.error(f"Unable to write metrics to {prometheus_file}: {e}")
@@ -0,0 +1,102 @@
+"""Stored build-inventory plans
+
+A dry run of build-inventory stores its plan so a later run with commit
+true and the plan-id can apply exactly the reviewed changes without
+querying NetBox again. Each inventory keeps only its latest plan, which
+is identified by a hash of its content and expires after plan-ttl seconds.
+The hash is checked again before a plan is applied, so a plan file edited
+after the review is refused.
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+from .nso_utilities import safe_file_name
+
+# Directory under the NSO run directory where plans are kept
+PLAN_DIRECTORY = "netbox-plans"
+
+
+def plan_path(inventory):
+    """Path of the stored plan for an inventory"""
+    run_dir = os.environ.get("NCS_RUN_DIR", os.getcwd())
+    return os.path.join(run_dir, PLAN_DIRECTORY, f"{safe_file_name(inventory)}.json")
+
+
+def plan_digest(content):
+    """Plan id of a stored plan, the hash of its plan, groups, since and fingerprint"""
+    digest = {
+        key: content[key] for key in ["plan", "wanted_groups", "since", "fingerprint"]
+    }
+    encoded = json.dumps(digest, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def store_plan(inventory, plan, wanted_groups, since, fingerprint, ttl):
+    """Store the plan of a dry run, returning its plan id and expiry time"""
+    content = {
+        "plan": plan,
+        "wanted_groups": {
+            group: sorted(members) for group, members in wanted_groups.items()
+        },
+        "since": since,
+        "fingerprint": fingerprint,
+    }
+    plan_id = plan_digest(content)
+    expires = (datetime.utcnow() + timedelta(seconds=ttl)).isoformat(
+        timespec="seconds"
+    )
+    content.update({"plan_id": plan_id, "expires": expires})
+
+    path = plan_path(inventory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as plan_file:
+        json.dump(content, plan_file)
+    os.replace(temporary, path)
+    return plan_id, expires
+
+
+def load_plan(inventory, plan_id, fingerprint):
+    """Read a stored plan to apply, refusing missing, replaced or expired plans"""
+    path = plan_path(inventory)
+    if not os.path.exists(path):
+        return {"status": False, "result": f"No stored plan for inventory {inventory}."}
+    with open(path) as plan_file:
+        content = json.load(plan_file)
+
+    if content["plan_id"] != plan_id:
+        return {
+            "status": False,
+            "result": f"Plan {plan_id} is not the latest plan for inventory {inventory}, which is {content['plan_id']}.",
+        }
+    if plan_digest(content) != plan_id:
+        return {
+            "status": False,
+            "result": f"Stored plan {plan_id} for inventory {inventory} was modified after it was made, run build-inventory again to review a new plan.",
+        }
+    if datetime.utcnow() >= datetime.fromisoformat(content["expires"]):
+        return {
+            "status": False,
+            "result": f"Plan {plan_id} expired at {content['expires']} UTC, run build-inventory again to review a new plan.",
+        }
+    if content["fingerprint"] != fingerprint:
+        return {
+            "status": False,
+            "result": f"Inventory {inventory} changed since plan {plan_id} was made, run build-inventory again to review a new plan.",
+        }
+
+    content["wanted_groups"] = {
+        group: set(members) for group, members in content["wanted_groups"].items()
+    }
+    return {"status": True, "result": content}
+
+
+def discard_plan(inventory):
+    """Remove the stored plan of an inventory once it has been applied"""
+    try:
+        os.remove(plan_path(inventory))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,80 @@
+"""Output reports for NetBox inventory actions
+
+"""
+
+import os
+from datetime import datetime
+
+from .nso_utilities import safe_file_name
+
+# Directory under the NSO run directory where full reports are written
+REPORT_DIRECTORY = "netbox-reports"
+
+
+def report_path(inventory, action):
+    """Path of a new report file for an inventory action"""
+    run_dir = os.environ.get("NCS_RUN_DIR", os.getcwd())
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    file_name = f"{safe_file_name(inventory)}-{action}-{stamp}.txt"
+    return os.path.join(run_dir, REPORT_DIRECTORY, file_name)
+
+
+class InventoryReport(object):
+    """Output of an inventory action, kept in memory or streamed to a file.
+
+    By default every line is returned in the output leaf along with a
+    structured result for each device. When a report file is requested the
+    lines are written to the file as they are produced and only the summary
+    lines are returned.
+    """
+
+    def __init__(self, inventory, action, to_file=False):
+        self.path = None
+        self.summary = []
+        self.devices = []
+        self._lines = []
+        self._file = None
+        if to_file:
+            self.path = report_path(inventory, action)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, "w")
+
+    def append(self, line):
+        """Add a line to the report"""
+        if self._file:
+            self._file.write(f"{line}\n")
+        else:
+            self._lines.append(line)
+
+    def extend(self, lines):
+        """Add several lines to the report"""
+        for line in lines:
+            self.append(line)
+
+    def add_summary(self, line):
+        """Add a line that is always returned in the output leaf"""
+        self.summary.append(line)
+        self.append(line)
+
+    def device(self, name, result, message=None):
+        """Record the result for a single device"""
+        if not self._file:
+            self.devices.append((name, result, message))
+
+    def text(self):
+        """Text for the output leaf"""
+        if self._file:
+            return "\n".join(self.summary + [f"# Full report written to {self.path}"])
+        return "\n".join(self._lines)
+
+    def write_output(self, action_output):
+        """Close the report and fill in the action output"""
+        if self._file:
+            self._file.close()
+            action_output.report_file = self.path
+        action_output.output = self.text()
+        for name, result, message in self.devices:
+            entry = action_output.device.create(name)
+            entry.result = result
+            if message:
+                entry.message = message
@@ -0,0 +1,190 @@
+"""Background reconciliation of netbox-inventories
+
+Inventories with a schedule interval are verified, and optionally built,
+by a background worker in the application component. Runs are spread out
+with random jitter and the number of inventories running at once is
+limited by netbox-scheduler max-concurrent. Runs use the netbox-background
+user and groups, and are paused while they aren't configured.
+"""
+
+import random
+import threading
+import time
+from datetime import datetime
+
+import ncs
+
+from .netbox_device_cache import service_managed
+from .nso_utilities import BACKGROUND_CONTEXT, BackgroundUserError, background_user
+
+# Seconds between checks for inventories that are due to run
+TICK_SECONDS = 10
+
+
+def device_results(action_output):
+    """Count the device results returned by an inventory action"""
+    counts = {}
+    for device in action_output.device:
+        counts[device.result] = counts.get(device.result, 0) + 1
+    return counts
+
+
+class InventoryScheduler(object):
+    """Worker running verify-inventory and build-inventory on a schedule.
+
+    The first run of each inventory is placed at a random point within its
+    interval, and every later run is interval plus up to jitter seconds
+    after the previous one finished, so runs don't line up.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self._next_run = {}
+        self._running = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._paused = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopping.wait(TICK_SECONDS):
+            try:
+                self.tick()
+                self._paused = False
+            except BackgroundUserError as e:
+                # Only log when the scheduler becomes paused, not every tick
+                if not self._paused:
+                    self.log.error(f"NetBox inventory scheduler paused: {e}")
+                self._paused = True
+            except Exception as e:
+                self.log.error(f"NetBox inventory scheduler failed: {e}")
+
+    def tick(self):
+        """Start the inventories that are due, up to the concurrency limit"""
+        session = background_user()
+        with ncs.maapi.single_read_trans(
+            session[0], BACKGROUND_CONTEXT, groups=session[1]
+        ) as t:
+            root = ncs.maagic.get_root(t)
+            max_concurrent = root.netbox_scheduler.max_concurrent
+            schedules = {
+                str(service.name): (
+                    service.schedule.interval,
+                    service.schedule.jitter,
+                    bool(service.schedule.build),
+                )
+                for service in root.netbox_inventory
+                if service.schedule.interval
+            }
+
+        now = time.monotonic()
+        with self._lock:
+            # Forget inventories whose schedule was removed
+            for name in list(self._next_run):
+                if name not in schedules:
+                    del self._next_run[name]
+
+            for name, (interval, jitter, build) in sorted(schedules.items()):
+                if name not in self._next_run:
+                    self._next_run[name] = now + random.uniform(0, interval)
+                if (
+                    name in self._running
+                    or self._next_run[name] > now
+                    or len(self._running) >= max_concurrent
+                ):
+                    continue
+                self._running.add(name)
+                threading.Thread(
+                    target=self.reconcile,
+                    args=(name, interval, jitter, build, session),
+                    daemon=True,
+                ).start()
+
+    def reconcile(self, name, interval, jitter, build, session):
+        """Verify and optionally build one inventory, recording the result
+
+        session is the (user, groups) the run uses.
+        """
+        started = time.monotonic()
+        # Counters of the previous run are cleared, a run only reports its own
+        state = {
+            "last_run": datetime.utcnow().isoformat(timespec="seconds"),
+            "drift": 0,
+            "missing": 0,
+            "created": 0,
+            "updated": 0,
+            "removed": 0,
+        }
+        try:
+            with ncs.maapi.single_read_trans(
+                session[0], BACKGROUND_CONTEXT, groups=session[1]
+            ) as t:
+                service = ncs.maagic.get_root(t).netbox_inventory[name]
+
+                self.log.info(f"Scheduled verify of inventory {name}")
+                verify = service.verify_inventory()
+                counts = device_results(verify)
+                state["drift"] = counts.get("drift", 0)
+                state["missing"] = counts.get("missing", 0)
+                state["success"] = bool(verify.success)
+
+                if (
+                    build
+                    and (state["drift"] or state["missing"])
+                    and service_managed(service)
+                ):
+                    # The service renders the devices from its cache
+                    self.log.info(f"Scheduled cache refresh of inventory {name}")
+                    refresh = service.refresh_cache()
+                    state["created"] = refresh.added
+                    state["updated"] = refresh.updated
+                    state["removed"] = refresh.removed
+                    state["success"] = bool(refresh.success)
+                elif build and (state["drift"] or state["missing"]):
+                    self.log.info(f"Scheduled build of inventory {name}")
+                    build_input = service.build_inventory.get_input()
+                    build_input.commit = True
+                    # Only a full build repairs devices changed or deleted in NSO
+                    build_input.incremental = False
+                    build_output = service.build_inventory(build_input)
+                    state["created"] = build_output.created
+                    state["updated"] = build_output.updated
+                    state["removed"] = build_output.removed
+                    state["success"] = bool(build_output.success)
+        except Exception as e:
+            self.log.error(f"Scheduled run of inventory {name} failed: {e}")
+            state["success"] = False
+        finally:
+            state["duration"] = int(time.monotonic() - started)
+            with self._lock:
+                self._running.discard(name)
+                self._next_run[name] = (
+                    time.monotonic() + interval + random.uniform(0, jitter)
+                )
+
+        self.save_state(name, state, session)
+
+    def save_state(self, name, state, session):
+        """Record the result of a scheduled run in CDB oper data"""
+        with ncs.maapi.single_write_trans(
+            session[0],
+            BACKGROUND_CONTEXT,
+            groups=session[1],
+            db=ncs.OPERATIONAL,
+        ) as t:
+            root = ncs.maagic.get_root(t)
+            if name not in root.netbox_inventory:
+                return
+            schedule_state = root.netbox_inventory[name].schedule_state
+            for leaf, value in state.items():
+                setattr(schedule_state, leaf, value)
+            t.apply()
@@ -0,0 +1,195 @@
+"""Local snapshots of the devices and VMs of a NetBox server
+
+A snapshot holds a DeviceSnapshot for every NetBox device and virtual
+machine of a netbox-server in a gzip compressed JSON file, so
+verify-inventory can run without querying NetBox. Refreshes only ask
+NetBox for objects changed since the newest last_updated in the snapshot,
+and only list every object when the counts show something was deleted.
+"""
+
+import gzip
+import json
+import os
+import threading
+from datetime import datetime
+
+from .netbox_devices import DeviceSnapshot, latest_updated
+from .netbox_utilities import INVENTORY_FIELDS, netbox_api, page_size, stream_netbox
+
+# Directory under the NSO run directory where snapshots are kept
+SNAPSHOT_DIRECTORY = "netbox-snapshots"
+
+# Snapshot kind -> NetBox endpoint
+SNAPSHOT_ENDPOINTS = {
+    "device": ("dcim", "devices"),
+    "vm": ("virtualization", "virtual_machines"),
+}
+
+# Refreshes of the same netbox-server run one at a time
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def snapshot_path(server):
+    """Path of the snapshot file for a netbox-server"""
+    run_dir = os.environ.get("NCS_RUN_DIR", os.getcwd())
+    return os.path.join(run_dir, SNAPSHOT_DIRECTORY, f"{server}.json.gz")
+
+
+def server_lock(server):
+    """Lock held while the snapshot of a netbox-server is refreshed"""
+    with _locks_lock:
+        return _locks.setdefault(server, threading.Lock())
+
+
+class InventorySnapshot(object):
+    """Devices and VMs of a NetBox server, keyed by their NetBox url.
+
+    refreshed is the UTC time of the last refresh and last_updated the
+    newest last_updated of any object, used for the next refresh.
+    """
+
+    def __init__(self, server, url, refreshed=None, last_updated=None, objects=None):
+        self.server = server
+        self.url = url
+        self.refreshed = refreshed
+        self.last_updated = last_updated
+        self.objects = objects if objects is not None else {}
+
+    def age(self):
+        """Seconds since the snapshot was refreshed"""
+        refreshed = datetime.fromisoformat(self.refreshed)
+        return int((datetime.utcnow() - refreshed).total_seconds())
+
+    def devices(self, filters=None):
+        """DeviceSnapshots of the snapshot, only those matching filters if given"""
+        for device in self.objects.values():
+            if filters is None or device.matches(filters):
+                yield device
+
+    def count(self, kind):
+        return len([device for device in self.objects.values() if device.kind == kind])
+
+    def merge(self, devices):
+        """Add or replace devices, returning how many were merged"""
+        merged = 0
+        for device in devices:
+            self.objects[device.url] = device
+            self.last_updated = latest_updated(self.last_updated, device.last_updated)
+            merged += 1
+        return merged
+
+    def prune(self, kind, urls):
+        """Remove the devices of a kind not in urls, returning how many were removed"""
+        stale = [
+            url
+            for url, device in self.objects.items()
+            if device.kind == kind and url not in urls
+        ]
+        for url in stale:
+            del self.objects[url]
+        return len(stale)
+
+    def save(self):
+        """Write the snapshot in one step so readers never see part of it"""
+        path = snapshot_path(self.server)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = {
+            "server": self.server,
+            "url": self.url,
+            "refreshed": self.refreshed,
+            "last_updated": self.last_updated,
+            "fields": list(DeviceSnapshot.__slots__),
+            "objects": [
+                [getattr(device, field) for field in DeviceSnapshot.__slots__]
+                for device in self.objects.values()
+            ],
+        }
+        temporary = f"{path}.tmp"
+        with gzip.open(temporary, "wt") as snapshot_file:
+            json.dump(data, snapshot_file, separators=(",", ":"))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, server):
+        """Read the snapshot of a netbox-server, or None if there isn't one"""
+        path = snapshot_path(server)
+        if not os.path.exists(path):
+            return None
+        with gzip.open(path, "rt") as snapshot_file:
+            data = json.load(snapshot_file)
+        objects = {}
+        for values in data["objects"]:
+            device = DeviceSnapshot(**dict(zip(data["fields"], values)))
+            objects[device.url] = device
+        return cls(
+            data["server"],
+            data["url"],
+            data["refreshed"],
+            data["last_updated"],
+            objects,
+        )
+
+
+def refresh_snapshot(netbox_server, log=False, clients=None, full=False):
+    """Bring the snapshot of a netbox-server up to date with NetBox
+
+    Without full, only objects with a last_updated at or after the newest
+    one already in the snapshot are requested. The objects of a kind are
+    only all listed, as brief results, when NetBox reports a different
+    count than the snapshot holds after merging, meaning some were
+    deleted. A new snapshot, a changed url or full always read every
+    object.
+    """
+    server = str(netbox_server.name)
+    try:
+        with server_lock(server):
+            nb = netbox_api(netbox_server, clients)
+            size = page_size(netbox_server)
+            snapshot = None if full else InventorySnapshot.load(server)
+            if snapshot is None or snapshot.url != str(netbox_server.url):
+                snapshot = InventorySnapshot(server, str(netbox_server.url))
+            since = snapshot.last_updated
+
+            counts = {"merged": 0, "removed": 0}
+            for kind, (app, model) in SNAPSHOT_ENDPOINTS.items():
+                endpoint = getattr(getattr(nb, app), model)
+                query = {"last_updated__gte": since} if since else {}
+                counts["merged"] += snapshot.merge(
+                    stream_netbox(
+                        endpoint,
+                        log,
+                        size,
+                        INVENTORY_FIELDS,
+                        lambda item, kind=kind: DeviceSnapshot.from_netbox(kind, item),
+                        **query,
+                    )
+                )
+                if since and endpoint.count() != snapshot.count(kind):
+                    urls = set(
+                        stream_netbox(
+                            endpoint,
+                            log,
+                            size,
+                            record=lambda item: item["url"],
+                            brief=1,
+                        )
+                    )
+                    counts["removed"] += snapshot.prune(kind, urls)
+
+            snapshot.refreshed = datetime.utcnow().isoformat(timespec="seconds")
+            snapshot.save()
+
+        counts.update(
+            {
+                "devices": snapshot.count("device"),
+                "vms": snapshot.count("vm"),
+                "incremental": since is not None,
+                "refreshed": snapshot.refreshed,
+            }
+        )
+        return {"status": True, "result": counts}
+    except Exception as e:
+        if log:
+            log.error(f"Snapshot refresh failed: {e}")
+        return {"status": False, "result": e}
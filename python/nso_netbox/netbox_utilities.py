@@ -2,15 +2,49 @@
 
 """
 
-import pynetbox
+import hashlib
+import itertools
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from requests import exceptions
-from _ncs import decrypt
 from pynetbox.core.query import RequestError
 
+from .netbox_clients import new_client
+from .netbox_devices import DeviceSnapshot
+from .netbox_graphql import graphql_netbox
+from .netbox_metrics import current_phase, iterate, phase, within
+
+# Fields of devices and VMs used by the inventory actions. NetBox 4.0 and
+# later only return these when asked, older releases ignore the parameter.
+INVENTORY_FIELDS = [
+    "id",
+    "url",
+    "name",
+    "status",
+    "primary_ip",
+    "site",
+    "tenant",
+    "device_type",
+    "device_role",
+    "role",
+    "last_updated",
+]
+
+
+def netbox_api(netbox_server, clients=None):
+    """Return a pynetbox client for a NetBox Server, from the registry if provided"""
+    if clients is not None:
+        return clients.get(netbox_server)
+    return new_client(netbox_server)
 
-def verify_netbox(netbox_server):
+
+def verify_netbox(netbox_server, clients=None):
     """Verify a NetBox Server is reachable"""
-    nb = pynetbox.api(netbox_server.url, token=decrypt(netbox_server.api_token))
+    nb = netbox_api(netbox_server, clients)
     try:
         status = nb.status()
     except RequestError as e: 
@@ -25,6 +59,11 @@ def verify_netbox(netbox_server):
             "status": False,
             "message": f"Error connecting to NetBox Server at url {netbox_server.url}.",
         }
+    except exceptions.Timeout:
+        return {
+            "status": False,
+            "message": f"Timed out waiting for NetBox Server at url {netbox_server.url}.",
+        }
 
     status_message = f"NetBox Version: {status['netbox-version']}, Python Version: {status['python-version']}, Plugins: {status['plugins']}, Workers Running: {status['rq-workers-running']}"
     return {"status": True, "message": status_message}
@@ -39,59 +78,389 @@ def query_netbox(object, log=False, **query):
     return results
 
 
-def devicelist_netbox(netbox_inventory, netbox_server, log=False):
-    """Retrieve matching devices from NetBox for an inventory"""
+def netbox_page(endpoint, url, params=None):
+    """Request one page of a NetBox list view"""
+    headers = {"accept": "application/json;"}
+    if endpoint.token:
+        headers["authorization"] = f"Token {endpoint.token}"
+    response = endpoint.api.http_session.get(url, headers=headers, params=params)
+    if not response.ok:
+        raise RequestError(response)
+    return response.json()
+
+
+def stream_netbox(
+    endpoint, log=False, page_size=250, fields=None, record=None, **query
+):
+    """Send a filter query to NetBox and yield the records one page at a time
+
+    Only one page of results is held in memory. Each result is turned into
+    a pynetbox Record, or by record when given. The first page is
+    requested straight away so connection and query errors are raised
+    here rather than part way through the records.
+    """
+    params = dict(query)
+    params["limit"] = page_size
+    if fields:
+        params["fields"] = ",".join(fields)
+    if log:
+        log.info(f"  Streaming {endpoint.name} in pages of {page_size}")
+    page = netbox_page(endpoint, f"{endpoint.url}/", params)
+
+    def records(page):
+        while True:
+            for item in page["results"]:
+                if record:
+                    yield record(item)
+                else:
+                    yield endpoint.return_obj(item, endpoint.api, endpoint)
+            if not page.get("next"):
+                return
+            page = netbox_page(endpoint, page["next"])
+
+    return records(page)
+
 
+def read_stream(devices, errors):
+    """Yield the devices of a streamed NetBox result, stopping at an error
+
+    Only the first page of a stream is requested by the query, so a later
+    page can still fail. Its error is added to errors instead of being
+    raised part way through an action, which must check errors before
+    acting on the devices it read.
+    """
     try:
-        nb = pynetbox.api(netbox_server.url, token=decrypt(netbox_server.api_token))
+        for device in devices:
+            yield device
+    except Exception as e:
+        errors.append(e)
 
-        # Build the device query from the provided attributes to the inventory instance
-        device_query = {}
-        if netbox_inventory.site:
-            if log:
-                log.info("Looking up NetBox Sites to Filter.")
-            sites = query_netbox(
-                nb.dcim.sites, log, name=[site for site in netbox_inventory.site]
-            )
-            device_query["site_id"] = [site.id for site in sites]
-
-        if netbox_inventory.tenant:
-            if log:
-                log.info("Looking up NetBox Tenants to Filter.")
-            tenants = query_netbox(
-                object=nb.tenancy.tenants,
-                log=log,
-                name=[tenant for tenant in netbox_inventory.tenant],
-            )
-            device_query["tenant_id"] = [tenant.id for tenant in tenants]
-
-        if netbox_inventory.device_type:
-            if log:
-                log.info("Looking up NetBox Device-Types to Filter.")
-            device_types = query_netbox(
-                object=nb.dcim.device_types,
-                log=log,
-                model=[
-                    device_type.model for device_type in netbox_inventory.device_type
-                ],
-            )
-            device_query["device_type_id"] = [
-                device_type.id for device_type in device_types
-            ]
 
-        if netbox_inventory.device_role:
-            if log:
-                log.info("Looking up NetBox Device-Roles to Filter.")
-            device_roles = query_netbox(
-                object=nb.dcim.device_roles,
-                log=log,
-                name=[device_role for device_role in netbox_inventory.device_role],
+def inventory_filters(netbox_inventory):
+    """Read the NetBox filters of an inventory into plain Python values
+
+    maagic nodes are bound to the action transaction and must not be used
+    from worker threads, so filters are read once up front.
+    """
+    return {
+        "site": [site for site in netbox_inventory.site],
+        "tenant": [tenant for tenant in netbox_inventory.tenant],
+        "device_type": [
+            device_type.model for device_type in netbox_inventory.device_type
+        ],
+        "device_role": [device_role for device_role in netbox_inventory.device_role],
+        "vm_role": [vm_role.role for vm_role in netbox_inventory.vm_role],
+    }
+
+
+def merge_filters(filters):
+    """Combine the filters of several inventories into one covering them all
+
+    Device types and VM roles are joined. A site, tenant or device role
+    filter is only kept when every inventory sets one, as an inventory
+    without it matches any value.
+    """
+    merged = {}
+    for key in ["site", "tenant", "device_type", "device_role", "vm_role"]:
+        values = [inventory[key] for inventory in filters]
+        if key in ["site", "tenant", "device_role"] and not all(values):
+            merged[key] = []
+        else:
+            merged[key] = sorted(set(itertools.chain.from_iterable(values)))
+    return merged
+
+
+def inventory_fingerprint(netbox_inventory):
+    """Hash of the NetBox server, filters, NEDs and device settings of an inventory
+
+    Covers every inventory leaf that shapes the NSO device records, so a
+    change to any of them forces a full build.
+    """
+    definition = inventory_filters(netbox_inventory)
+    definition["netbox_server"] = str(netbox_inventory.netbox_server)
+    if len(netbox_inventory.additional_netbox_server):
+        definition["additional_netbox_server"] = list(
+            netbox_inventory.additional_netbox_server
+        )
+        definition["name_collision"] = netbox_inventory.name_collision.string
+    definition["ned"] = sorted(
+        [
+            f"{device_type.model}={device_type.ned}"
+            for device_type in netbox_inventory.device_type
+        ]
+        + [f"{vm_role.role}={vm_role.ned}" for vm_role in netbox_inventory.vm_role]
+    )
+    definition["device"] = {
+        "auth_group": str(netbox_inventory.auth_group),
+        "admin_state": (
+            netbox_inventory.admin_state.string
+            if netbox_inventory.admin_state
+            else None
+        ),
+        "connection_protocol": netbox_inventory.connection_protocol.string,
+        "bypass_certificate_verification": bool(
+            netbox_inventory.bypass_certificate_verification
+        ),
+    }
+    return hashlib.sha1(json.dumps(definition, sort_keys=True).encode()).hexdigest()
+
+
+def lookup_workers(netbox_server):
+    """Number of concurrent lookups allowed against a NetBox Server"""
+    return int(netbox_server.lookup_workers)
+
+
+def page_size(netbox_server):
+    """Number of devices or VMs requested per page from a NetBox Server"""
+    return int(netbox_server.page_size)
+
+
+def use_graphql(netbox_server):
+    """Check if device and VM queries use the GraphQL API of a NetBox Server"""
+    return netbox_server.query_backend.string == "graphql"
+
+
+def run_concurrently(calls, workers=1):
+    """Run a dict of callables, in a bounded thread pool when workers > 1"""
+    if workers <= 1 or len(calls) <= 1:
+        return {key: call() for key, call in calls.items()}
+
+    # Work done in the pool counts towards the caller's metrics phase
+    caller_phase = current_phase()
+    with ThreadPoolExecutor(max_workers=min(workers, len(calls))) as pool:
+        futures = {
+            key: pool.submit(within(caller_phase, call)) for key, call in calls.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
+
+
+# Worker threads of timed-out items that are still running, across runs,
+# for each key passed to run_with_deadlines
+_abandoned = {}
+_abandoned_lock = threading.Lock()
+
+# Seconds between checks for finished abandoned workers while items wait
+ABANDONED_POLL = 1.0
+
+
+def abandoned_workers(key=None):
+    """Number of workers abandoned by run_with_deadlines for key that are still running"""
+    with _abandoned_lock:
+        threads = _abandoned.get(key, set())
+        for thread in [thread for thread in threads if not thread.is_alive()]:
+            threads.discard(thread)
+        if not threads:
+            _abandoned.pop(key, None)
+        return len(threads)
+
+
+def run_with_deadlines(items, call, workers=1, timeout=None, log=False, key=None):
+    """Run call(item) for each item with bounded workers and a per-item deadline
+
+    Returns a dict of item -> (outcome, value) where outcome is "done",
+    "error" or "timeout". Work that misses its deadline is abandoned on a
+    daemon thread so the remaining items keep their worker slots. The
+    abandoned workers still running from this or earlier runs with the
+    same key count against workers, leaving at least one slot, so threads
+    stuck on unresponsive devices can't pile up. Their slots are given
+    back as they finish.
+    """
+    results = {}
+    pending = list(items)
+    pending.reverse()
+    running = {}
+    finished = queue.Queue()
+
+    def worker(item):
+        try:
+            finished.put((item, "done", call(item)))
+        except Exception as e:
+            finished.put((item, "error", e))
+
+    while pending or running:
+        abandoned = abandoned_workers(key)
+        slots = max(1, workers - abandoned)
+        while pending and len(running) < slots:
+            item = pending.pop()
+            thread = threading.Thread(target=worker, args=(item,), daemon=True)
+            running[item] = (time.monotonic(), thread)
+            thread.start()
+
+        wait = None
+        if timeout:
+            oldest = min(started for started, _ in running.values())
+            wait = max(0, oldest + timeout - time.monotonic())
+        if abandoned and pending:
+            wait = ABANDONED_POLL if wait is None else min(wait, ABANDONED_POLL)
+        try:
+            item, outcome, value = finished.get(timeout=wait)
+            if item in running:
+                del running[item]
+                results[item] = (outcome, value)
+        except queue.Empty:
+            pass
+
+        if timeout:
+            now = time.monotonic()
+            for item, (started, thread) in list(running.items()):
+                if now - started >= timeout:
+                    del running[item]
+                    results[item] = ("timeout", None)
+                    with _abandoned_lock:
+                        _abandoned.setdefault(key, set()).add(thread)
+                    if log:
+                        log.warning(
+                            f"Abandoned the worker of {item} after {timeout} seconds, {abandoned_workers(key)} abandoned workers still running"
+                        )
+
+    return results
+
+
+# Inventory filter -> (query parameter, NetBox endpoint, name field, extra filters)
+ID_LOOKUPS = {
+    "site": ("site_id", "dcim.sites", "name", {}),
+    "tenant": ("tenant_id", "tenancy.tenants", "name", {}),
+    "device_type": ("device_type_id", "dcim.device_types", "model", {}),
+    "device_role": ("role_id", "dcim.device_roles", "name", {}),
+    "vm_role": ("vm_role_id", "dcim.device_roles", "name", {"vm_role": True}),
+}
+
+
+def lookup_ids(nb, object_type, names, log=False, cache=None, server=None, ttl=0):
+    """Resolve names of one NetBox object type to IDs, using the lookup cache"""
+    param, endpoint, field, extra = ID_LOOKUPS[object_type]
+    use_cache = cache is not None and ttl > 0
+
+    ids = []
+    missing = []
+    for name in names:
+        object_ids = cache.get(server, object_type, name) if use_cache else None
+        if object_ids is None:
+            missing.append(name)
+        else:
+            ids.extend(object_ids)
+
+    if missing:
+        app, model = endpoint.split(".")
+        query = dict(extra)
+        query[field] = missing
+        # A name may match several objects, such as models of two manufacturers
+        found = {}
+        for item in query_netbox(getattr(getattr(nb, app), model), log, **query):
+            ids.append(item.id)
+            found.setdefault(getattr(item, field), []).append(item.id)
+        if use_cache:
+            for name, object_ids in found.items():
+                cache.put(server, object_type, name, object_ids, ttl)
+
+    return ids
+
+
+def resolve_filter_ids(
+    nb, filters, log=False, workers=1, cache=None, server=None, ttl=0
+):
+    """Resolve the names used in inventory filters to NetBox object IDs"""
+    lookups = {}
+    for object_type, names in filters.items():
+        if names:
+            lookups[ID_LOOKUPS[object_type][0]] = (
+                lambda object_type=object_type, names=names: lookup_ids(
+                    nb, object_type, names, log, cache, server, ttl
+                )
             )
-            device_query["role_id"] = [device_role.id for device_role in device_roles]
 
-        if log:
-            log.info(f"Looking up NetBox Devices for Filter: {device_query}")
-        devices = query_netbox(object=nb.dcim.devices, log=log, **device_query)
+    if log:
+        log.info(f"Looking up NetBox IDs to Filter: {list(lookups.keys())}")
+
+    return run_concurrently(lookups, workers)
+
+
+def lookup_cache(netbox_server, clients=None):
+    """Keyword arguments enabling the shared lookup cache for a NetBox Server"""
+    if clients is None:
+        return {}
+    return {
+        "cache": clients.lookups,
+        "server": str(netbox_server.name),
+        "ttl": int(netbox_server.lookup_cache_ttl),
+    }
+
+
+def fetch_devices(nb, filter_ids, log=False, since=None, page_size=None):
+    """Query NetBox devices using resolved filter IDs
+
+    When page_size is given the devices are streamed as DeviceSnapshots.
+    """
+    device_query = {
+        key: filter_ids[key]
+        for key in ["site_id", "tenant_id", "device_type_id", "role_id"]
+        if key in filter_ids
+    }
+    if since:
+        device_query["last_updated__gte"] = since
+    if log:
+        log.info(f"Looking up NetBox Devices for Filter: {device_query}")
+    if page_size:
+        return stream_netbox(
+            nb.dcim.devices,
+            log,
+            page_size,
+            INVENTORY_FIELDS,
+            lambda item: DeviceSnapshot.from_netbox("device", item),
+            **device_query,
+        )
+    return query_netbox(object=nb.dcim.devices, log=log, **device_query)
+
+
+def fetch_vms(nb, filter_ids, log=False, since=None, page_size=None):
+    """Query NetBox virtual machines using resolved filter IDs
+
+    When page_size is given the VMs are streamed as DeviceSnapshots.
+    """
+    vm_query = {
+        key: filter_ids[key] for key in ["site_id", "tenant_id"] if key in filter_ids
+    }
+    if "vm_role_id" in filter_ids:
+        vm_query["role_id"] = filter_ids["vm_role_id"]
+    if since:
+        vm_query["last_updated__gte"] = since
+    if log:
+        log.info(f"Looking up NetBox vms for Filter: {vm_query}")
+    if page_size:
+        return stream_netbox(
+            nb.virtualization.virtual_machines,
+            log,
+            page_size,
+            INVENTORY_FIELDS,
+            lambda item: DeviceSnapshot.from_netbox("vm", item),
+            **vm_query,
+        )
+    return query_netbox(object=nb.virtualization.virtual_machines, log=log, **vm_query)
+
+
+def devicelist_netbox(netbox_inventory, netbox_server, log=False, clients=None):
+    """Retrieve matching devices from NetBox for an inventory as DeviceSnapshots"""
+
+    try:
+        nb = netbox_api(netbox_server, clients)
+
+        # Build the device query from the provided attributes to the inventory instance
+        filters = inventory_filters(netbox_inventory)
+        filters["vm_role"] = []
+        if use_graphql(netbox_server):
+            devices = graphql_netbox(nb, netbox_server, filters, log)
+            return {"status": True, "result": devices}
+        filter_ids = resolve_filter_ids(
+            nb,
+            filters,
+            log,
+            workers=lookup_workers(netbox_server),
+            **lookup_cache(netbox_server, clients),
+        )
+        devices = [
+            DeviceSnapshot.from_netbox("device", dict(record))
+            for record in fetch_devices(nb, filter_ids, log)
+        ]
 
         return {"status": True, "result": devices}
     except Exception as e:
@@ -100,48 +469,121 @@ def devicelist_netbox(netbox_inventory, netbox_server, log=False):
         return {"status": False, "result": e}
 
 
-def vmlist_netbox(netbox_inventory, netbox_server, log=False):
-    """Retrieve matching Virtual Machines from NetBox for an inventory"""
+def vmlist_netbox(netbox_inventory, netbox_server, log=False, clients=None):
+    """Retrieve matching Virtual Machines from NetBox for an inventory as DeviceSnapshots"""
 
     try:
-        nb = pynetbox.api(netbox_server.url, token=decrypt(netbox_server.api_token))
+        nb = netbox_api(netbox_server, clients)
 
         # Build the VM query from the provided attributes to the inventory instance
-        vm_query = {}
-        if netbox_inventory.site:
-            if log:
-                log.info("Looking up NetBox Sites to Filter.")
-            sites = query_netbox(
-                nb.dcim.sites, log, name=[site for site in netbox_inventory.site]
+        filters = inventory_filters(netbox_inventory)
+        filters["device_type"] = []
+        filters["device_role"] = []
+        if use_graphql(netbox_server):
+            vms = graphql_netbox(nb, netbox_server, filters, log)
+            return {"status": True, "result": vms}
+        filter_ids = resolve_filter_ids(
+            nb,
+            filters,
+            log,
+            workers=lookup_workers(netbox_server),
+            **lookup_cache(netbox_server, clients),
+        )
+        vms = [
+            DeviceSnapshot.from_netbox("vm", dict(record))
+            for record in fetch_vms(nb, filter_ids, log)
+        ]
+
+        return {"status": True, "result": vms}
+    except Exception as e:
+        if log:
+            log.error(f"Lookup failed: {e}")
+        return {"status": False, "result": e}
+
+
+def inventory_netbox(
+    netbox_inventory,
+    netbox_server,
+    log=False,
+    clients=None,
+    since=None,
+    stream=False,
+    metrics=None,
+    filters=None,
+):
+    """Retrieve matching devices and Virtual Machines from NetBox for an inventory
+
+    Site and tenant names are resolved once for both queries, the ID
+    lookups run concurrently and the device and VM queries overlap when
+    the inventory has both device-type and vm-role entries. When since is
+    given only objects with a newer last_updated are returned.
+
+    The devices and VMs are returned as DeviceSnapshots. With stream set,
+    the result is an iterator that requests them page by page with only
+    the fields the actions use, instead of a list. Only the first pages
+    are requested here, and overlap, so errors of later pages are raised
+    while the result is read, see read_stream. The id-resolution,
+    device-fetch and vm-fetch phases are recorded in metrics when given.
+    filters replaces the filters of netbox_inventory, such as the merged
+    filters of several inventories.
+
+    With the graphql query-backend a single GraphQL query, recorded as
+    the graphql-fetch phase, replaces the ID lookups and both fetches.
+    """
+
+    try:
+        nb = netbox_api(netbox_server, clients)
+        workers = lookup_workers(netbox_server)
+        size = page_size(netbox_server) if stream else None
+
+        if filters is None:
+            filters = inventory_filters(netbox_inventory)
+        if use_graphql(netbox_server):
+            with phase(metrics, "graphql-fetch"):
+                devices = graphql_netbox(nb, netbox_server, filters, log, since)
+            if metrics:
+                metrics.count("graphql-fetch", devices=len(devices))
+            return {"status": True, "result": iter(devices) if stream else devices}
+        with phase(metrics, "id-resolution"):
+            filter_ids = resolve_filter_ids(
+                nb,
+                filters,
+                log,
+                workers=workers,
+                **lookup_cache(netbox_server, clients),
             )
-            vm_query["site_id"] = [site.id for site in sites]
-
-        if netbox_inventory.tenant:
-            if log:
-                log.info("Looking up NetBox Tenants to Filter.")
-            tenants = query_netbox(
-                object=nb.tenancy.tenants,
-                log=log,
-                name=[tenant for tenant in netbox_inventory.tenant],
+
+        def fetch(name, call):
+            with phase(metrics, name):
+                return call()
+
+        fetches = {}
+        if filters["device_type"]:
+            fetches["devices"] = lambda: fetch(
+                "device-fetch",
+                lambda: fetch_devices(nb, filter_ids, log, since, size),
             )
-            vm_query["tenant_id"] = [tenant.id for tenant in tenants]
-
-        if netbox_inventory.vm_role:
-            if log:
-                log.info("Looking up NetBox Virtual Machine Roles to Filter.")
-            vm_roles = query_netbox(
-                object=nb.dcim.device_roles,
-                log=log,
-                name=[vm_role.role for vm_role in netbox_inventory.vm_role],
-                vm_role=True,
+        if filters["vm_role"]:
+            fetches["vms"] = lambda: fetch(
+                "vm-fetch", lambda: fetch_vms(nb, filter_ids, log, since, size)
             )
-            vm_query["role_id"] = [vm_role.id for vm_role in vm_roles]
+        results = run_concurrently(fetches, workers)
 
-        if log:
-            log.info(f"Looking up NetBox vms for Filter: {vm_query}")
-        vms = query_netbox(object=nb.virtualization.virtual_machines, log=log, **vm_query)
-
-        return {"status": True, "result": vms}
+        if stream:
+            devices = itertools.chain(
+                iterate(metrics, "device-fetch", results.get("devices", [])),
+                iterate(metrics, "vm-fetch", results.get("vms", [])),
+            )
+        else:
+            devices = [
+                DeviceSnapshot.from_netbox(kind, dict(record))
+                for kind, key in [("device", "devices"), ("vm", "vms")]
+                for record in results.get(key, [])
+            ]
+            if metrics:
+                metrics.count("device-fetch", devices=len(results.get("devices", [])))
+                metrics.count("vm-fetch", devices=len(results.get("vms", [])))
+        return {"status": True, "result": devices}
     except Exception as e:
         if log:
             log.error(f"Lookup failed: {e}")
@@ -0,0 +1,448 @@
+"""NetBox webhook receiver for the nso-netbox application
+
+NetBox webhooks for devices and virtual machines are received on the
+webhook-port of a netbox-server, matched against the filters of every
+netbox-inventory using that server and queued as single device updates.
+Events for the same device that arrive close together are coalesced
+into one update.
+
+Listeners only run for servers with a webhook-secret, and the payload of
+a webhook is never trusted to remove a device: every queued device is
+read again from NetBox before it is created, updated or removed.
+"""
+
+import hashlib
+import hmac
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ncs
+from ncs.cdb import Subscriber
+from _ncs import decrypt
+
+from .netbox_device_cache import service_managed
+from .netbox_devices import DeviceSnapshot, nested_value
+from .netbox_federation import federated
+from .netbox_inventory_plan import (
+    apply_device,
+    apply_groups,
+    inventory_groups,
+    inventory_settings,
+    plan_groups,
+    plan_inventory,
+    remove_device,
+)
+from .netbox_utilities import inventory_filters, netbox_api
+from .nso_utilities import (
+    BACKGROUND_CONTEXT,
+    BACKGROUND_PATH,
+    BackgroundUserError,
+    background_user,
+    inventory_neds,
+    resolve_ned_types,
+)
+
+# Seconds to wait for more events before applying queued updates
+COALESCE_SECONDS = 2
+
+# NetBox webhook model -> (NetBox API endpoint, DeviceSnapshot kind)
+WEBHOOK_MODELS = {
+    "device": ("dcim.devices", "device"),
+    "virtualmachine": ("virtualization.virtual_machines", "vm"),
+}
+
+
+def matches_inventory(filters, model, data):
+    """Check if serialized NetBox device or VM data matches inventory filters"""
+    if filters["site"] and nested_value(data, "site") not in filters["site"]:
+        return False
+    if filters["tenant"] and nested_value(data, "tenant") not in filters["tenant"]:
+        return False
+
+    if model == "device":
+        if nested_value(data, "device_type", "model") not in filters["device_type"]:
+            return False
+        # NetBox 3.6 renamed the device_role field of devices to role
+        role = nested_value(data, "device_role") or nested_value(data, "role")
+        return not filters["device_role"] or role in filters["device_role"]
+
+    if model == "virtualmachine":
+        return nested_value(data, "role") in filters["vm_role"]
+
+    return False
+
+
+def verify_signature(secret, body, signature):
+    """Check the X-Hook-Signature NetBox sends when a webhook secret is set"""
+    expected = hmac.new(secret.encode(), body, hashlib.sha512).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+
+def fetch_object(nb, model, object_id):
+    """Read the JSON of a single NetBox device or VM, or None if it no longer exists"""
+    app, endpoint = WEBHOOK_MODELS[model][0].split(".")
+    record = getattr(getattr(nb, app), endpoint).get(object_id)
+    return dict(record) if record else None
+
+
+class WebhookQueue(object):
+    """Coalescing queue of single device updates for netbox-inventories.
+
+    Operations are keyed by (inventory, model, NetBox ID), so a newer event
+    for a device replaces the one still waiting. Names the device had
+    before a rename are kept so the stale NSO device is removed.
+    """
+
+    def __init__(self, log, clients):
+        self.log = log
+        self.clients = clients
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def put(self, inventory, model, object_id, name, old_name=None):
+        """Queue a device of an inventory to be brought in line with NetBox"""
+        key = (inventory, model, object_id)
+        with self._condition:
+            stale_names = set()
+            previous = self._pending.pop(key, None)
+            if previous:
+                stale_names = previous["stale_names"] | {previous["name"]}
+            if old_name:
+                stale_names.add(old_name)
+            stale_names.discard(name)
+            self._pending[key] = {
+                "inventory": inventory,
+                "model": model,
+                "id": object_id,
+                "name": name,
+                "stale_names": stale_names,
+            }
+            self._condition.notify()
+
+    def start(self):
+        """Start the worker thread applying queued updates"""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the worker thread, dropping any queued updates"""
+        self._stopping.set()
+        with self._condition:
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            with self._condition:
+                while not self._pending and not self._stopping.is_set():
+                    self._condition.wait()
+            # Give related events a moment to arrive before applying
+            if self._stopping.wait(COALESCE_SECONDS):
+                return
+
+            with self._condition:
+                operations = list(self._pending.values())
+                self._pending.clear()
+
+            by_inventory = OrderedDict()
+            for operation in operations:
+                by_inventory.setdefault(operation["inventory"], []).append(operation)
+            for inventory, inventory_operations in by_inventory.items():
+                try:
+                    self.apply(inventory, inventory_operations)
+                except Exception as e:
+                    self.log.error(
+                        f"Webhook update of inventory {inventory} failed: {e}"
+                    )
+
+    def apply(self, inventory, operations):
+        """Apply the queued device updates for one inventory in a single transaction"""
+        user, groups = background_user()
+        with ncs.maapi.Maapi() as m:
+            with ncs.maapi.Session(m, user, BACKGROUND_CONTEXT, groups):
+                m.install_crypto_keys()
+                with m.start_read_trans() as t:
+                    root = ncs.maagic.get_root(t)
+                    if inventory not in root.netbox_inventory:
+                        return
+                    service = root.netbox_inventory[inventory]
+                    netbox_server = root.netbox_server[service.netbox_server]
+                    path = service._path
+
+                    settings = inventory_settings(service)
+                    neds = inventory_neds(service)
+                    ned_types, ned_errors = resolve_ned_types(
+                        root,
+                        list(neds["device_type"].values())
+                        + list(neds["vm_role"].values()),
+                    )
+                    if ned_errors:
+                        self.log.error("\n".join(ned_errors))
+                        return
+                    filters = inventory_filters(service)
+                    nb = netbox_api(netbox_server, self.clients)
+
+                    # NetBox decides, a device is only removed once NetBox
+                    # confirms it is gone or no longer matches the inventory
+                    devices = []
+                    removed = set()
+                    for operation in operations:
+                        data = fetch_object(nb, operation["model"], operation["id"])
+                        if data and matches_inventory(
+                            filters, operation["model"], data
+                        ):
+                            devices.append(
+                                DeviceSnapshot.from_netbox(
+                                    WEBHOOK_MODELS[operation["model"]][1], data
+                                )
+                            )
+                            removed |= operation["stale_names"] - {data["name"]}
+                            continue
+                        removed |= operation["stale_names"] | {operation["name"]}
+
+                    plan = plan_inventory(
+                        root, settings, devices, neds, ned_types, full=False
+                    )
+                    # Only remove devices this inventory added to NSO
+                    removed -= set(device.name for device in devices)
+                    for device_name in sorted(removed):
+                        if (
+                            device_name in root.devices.device
+                            and root.devices.device[device_name].source.source
+                            == settings["path"]
+                            and device_name not in plan["remove"]
+                        ):
+                            plan["remove"].append(device_name)
+                    groups = inventory_groups(root, settings["path"])
+                    wanted_groups = plan_groups(plan, groups, full=False)
+
+                records = [
+                    record
+                    for record in plan["create"] + plan["update"]
+                    if record.get("changes") != ["groups"]
+                ]
+                with m.start_write_trans() as t:
+                    t_root = ncs.maagic.get_root(t)
+                    template = ncs.template.Template(ncs.maagic.get_node(t, path))
+                    for record in records:
+                        apply_device(template, settings, record, log=self.log)
+                    for device_name in plan["remove"]:
+                        remove_device(t_root, device_name, groups)
+                    apply_groups(t_root, settings, wanted_groups, groups, log=self.log)
+                    t.apply()
+
+        self.log.info(
+            f"Webhook update of inventory {inventory}: {len(plan['create'])} created, {len(plan['update'])} updated, {len(plan['remove'])} removed"
+        )
+
+
+class WebhookListener(object):
+    """HTTP listener receiving NetBox webhooks for one netbox-server"""
+
+    def __init__(self, log, server_name, address, port, queue):
+        self.log = log
+        self.server_name = server_name
+        self.address = address
+        self.port = port
+        self.queue = queue
+        listener = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(
+                    listener.receive(body, self.headers.get("X-Hook-Signature"))
+                )
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                listener.log.debug(f"Webhook {listener.server_name}: {format % args}")
+
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self.log.info(
+            f"Listening for NetBox webhooks from {self.server_name} on {self.address} port {self.port}"
+        )
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def receive(self, body, signature):
+        """Queue the device updates for a webhook and return the HTTP status"""
+        try:
+            user, groups = background_user()
+        except BackgroundUserError as e:
+            self.log.error(f"Webhook from {self.server_name} refused: {e}")
+            return 503
+        with ncs.maapi.single_read_trans(user, BACKGROUND_CONTEXT, groups=groups) as t:
+            root = ncs.maagic.get_root(t)
+            if self.server_name not in root.netbox_server:
+                return 404
+            netbox_server = root.netbox_server[self.server_name]
+            if not netbox_server.webhook_secret:
+                self.log.error(
+                    f"Webhook from {self.server_name} refused, no webhook-secret is set."
+                )
+                return 401
+            t.maapi.install_crypto_keys()
+            if not verify_signature(
+                decrypt(netbox_server.webhook_secret), body, signature
+            ):
+                self.log.error(
+                    f"Webhook from {self.server_name} has an invalid signature."
+                )
+                return 401
+
+            try:
+                event = json.loads(body)
+                model = event["model"]
+                data = event["data"]
+            except (ValueError, KeyError, TypeError):
+                return 400
+            if model not in WEBHOOK_MODELS:
+                return 204
+
+            # NetBox 3.x includes the object before the change, used for renames
+            prechange = (event.get("snapshots") or {}).get("prechange") or {}
+            old_name = prechange.get("name")
+            deleted = event.get("event") == "deleted"
+
+            for service in root.netbox_inventory:
+                # Service managed inventories are updated by refresh-cache and
+                # federated ones need every server to resolve name collisions
+                if (
+                    service.netbox_server != self.server_name
+                    or not service.update_nso_devices
+                    or service_managed(service)
+                    or federated(service)
+                ):
+                    continue
+                if not deleted and matches_inventory(
+                    inventory_filters(service), model, data
+                ):
+                    self.queue.put(
+                        service.name, model, data["id"], data["name"], old_name
+                    )
+                    continue
+                # Devices leaving the inventory are removed if this inventory added them
+                for device_name in set([data.get("name"), old_name]) - {None}:
+                    if (
+                        device_name in root.devices.device
+                        and root.devices.device[device_name].source.source
+                        == service._path
+                    ):
+                        self.queue.put(service.name, model, data["id"], device_name)
+        return 204
+
+
+class WebhookManager(object):
+    """Start and stop webhook listeners to follow the netbox-server config"""
+
+    def __init__(self, log, clients):
+        self.log = log
+        self.clients = clients
+        self.queue = WebhookQueue(log, clients)
+        self._listeners = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.queue.start()
+        self.refresh()
+
+    def refresh(self):
+        """Start listeners for new webhook-ports and stop removed ones"""
+        wanted = {}
+        try:
+            user, groups = background_user()
+        except BackgroundUserError as e:
+            # Without a user the webhooks couldn't be applied, so none are taken
+            self.log.error(f"Not listening for webhooks: {e}")
+            servers = []
+        else:
+            with ncs.maapi.single_read_trans(
+                user, BACKGROUND_CONTEXT, groups=groups
+            ) as t:
+                servers = [
+                    (
+                        str(netbox_server.name),
+                        str(netbox_server.webhook_address),
+                        netbox_server.webhook_port,
+                        bool(netbox_server.webhook_secret),
+                    )
+                    for netbox_server in ncs.maagic.get_root(t).netbox_server
+                ]
+
+        for server_name, address, port, secret in servers:
+            if not port:
+                continue
+            # Unsigned webhooks could change NSO devices, never accept them
+            if not secret:
+                self.log.error(
+                    f"Not listening for webhooks from {server_name}, webhook-port needs a webhook-secret."
+                )
+                continue
+            wanted[server_name] = (address, int(port))
+
+        with self._lock:
+            for server_name, listener in list(self._listeners.items()):
+                if wanted.get(server_name) != (listener.address, listener.port):
+                    listener.stop()
+                    del self._listeners[server_name]
+            for server_name, (address, port) in wanted.items():
+                if server_name in self._listeners:
+                    continue
+                try:
+                    listener = WebhookListener(
+                        self.log, server_name, address, port, self.queue
+                    )
+                except OSError as e:
+                    self.log.error(
+                        f"Unable to listen for webhooks from {server_name} on {address} port {port}: {e}"
+                    )
+                    continue
+                listener.start()
+                self._listeners[server_name] = listener
+
+    def stop(self):
+        with self._lock:
+            for listener in self._listeners.values():
+                listener.stop()
+            self._listeners.clear()
+        self.queue.stop()
+
+
+class WebhookSubscriber(Subscriber):
+    """CDB subscriber refreshing the webhook listeners when netbox-server or netbox-background changes
+
+    The NetBox clients of deleted netbox-servers are discarded.
+    """
+
+    def init(self):
+        self.register("/nso-netbox:netbox-server", priority=100)
+        self.register(BACKGROUND_PATH, priority=100)
+
+    def pre_iterate(self):
+        return []
+
+    def iterate(self, kp, op, oldv, newv, state):
+        # A deleted netbox-server entry, /nso-netbox:netbox-server{name}
+        if op == ncs.MOP_DELETED and len(kp) == 2 and "netbox-server" in str(kp):
+            state.append(str(kp[0][0]))
+        return ncs.ITER_CONTINUE
+
+    def should_post_iterate(self, state):
+        return True
+
+    def post_iterate(self, state):
+        for server_name in state:
+            self.manager.clients.discard(server_name)
+        self.manager.refresh()
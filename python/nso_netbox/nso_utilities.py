@@ -0,0 +1,224 @@
+"""Set of reusable functions for working with NSO
+
+"""
+
+import socket
+from urllib.parse import quote
+
+import _ncs
+import _ncs.cdb as _cdb
+import _ncs.maapi as _maapi
+from _ncs import QUERY_STRING
+from _ncs.error import Error
+
+# Context used by background workers to read and write NSO, and the config
+# holding the user and groups they run as
+BACKGROUND_CONTEXT = "system"
+BACKGROUND_PATH = "/nso-netbox:netbox-background"
+
+
+class BackgroundUserError(Exception):
+    """No user or groups are configured for background work"""
+
+
+def background_user():
+    """Return the (user, groups) configured for background workers
+
+    The config is read with the CDB API, which NACM doesn't apply to, as
+    the user is needed before a MAAPI session can be started. Everything
+    else the workers do is subject to the NACM rules of that user.
+    """
+    sock = socket.socket()
+    try:
+        _cdb.connect(sock, _cdb.READ_SOCKET, _ncs.ADDR, _ncs.PORT)
+        _cdb.start_session(sock, _cdb.RUNNING)
+        user = None
+        groups = []
+        if _cdb.exists(sock, f"{BACKGROUND_PATH}/user"):
+            user = str(_cdb.get(sock, f"{BACKGROUND_PATH}/user"))
+        if _cdb.exists(sock, f"{BACKGROUND_PATH}/group"):
+            groups = [
+                str(group)
+                for group in _cdb.get(sock, f"{BACKGROUND_PATH}/group").as_pyval()
+            ]
+        _cdb.end_session(sock)
+    finally:
+        sock.close()
+
+    if not user or not groups:
+        raise BackgroundUserError(
+            "netbox-background user and group must be set for webhooks and scheduled runs."
+        )
+    return user, groups
+
+
+# Device leaves read by read_devices, relative to /ncs:devices/device
+DEVICE_LEAVES = [
+    "name",
+    "address",
+    "port",
+    "description",
+    "authgroup",
+    "state/admin-state",
+    "device-type/cli/ned-id",
+    "device-type/generic/ned-id",
+    "device-type/cli/protocol",
+    "source/source",
+    "source/context",
+]
+
+# Number of devices returned by each MAAPI query result
+QUERY_CHUNK_SIZE = 1000
+
+# Number of device names matched by each MAAPI query of read_devices
+QUERY_NAMES = 100
+
+
+def get_users_groups(trans, uinfo):
+    # Get the maapi socket
+    s = trans.maapi.msock
+    auth = _maapi.get_authorization_info(s, uinfo.usid)
+    return list(auth.groups)
+
+
+def inventory_neds(netbox_inventory):
+    """Map the device-type models and vm-roles of an inventory to their NEDs"""
+    return {
+        "device_type": {
+            device_type.model: device_type.ned
+            for device_type in netbox_inventory.device_type
+        },
+        "vm_role": {vm_role.role: vm_role.ned for vm_role in netbox_inventory.vm_role},
+    }
+
+
+def resolve_ned_types(root, neds):
+    """Determine if each NED package is a "cli" or "generic" NED
+
+    Returns a dict of ned -> {"type", "ned_id"} and a list of error
+    messages for NEDs that could not be resolved.
+    """
+    ned_types = {}
+    errors = []
+    for ned in sorted(set(neds)):
+        try:
+            device_package = root.packages.package[ned]
+        except KeyError:
+            errors.append(
+                f"NED {ned} is configured for the inventory, but no package named {ned} is loaded in NSO."
+            )
+            continue
+
+        for component in device_package.component:
+            # Find the component that ties to the NED name
+            # Note: The cisco-iosxr ned uses cisco-ios-xr as the component name. Pulling out "-"'s for this test
+            if component.name.replace("-", "") not in ned.replace("-", ""):
+                continue
+            # component.ned.cli is an ncs.maagic.Container that can't be tested for "empty",
+            # reading the ned-id raises an Error when the NED is not of that type
+            for ned_type in ["cli", "generic"]:
+                try:
+                    ned_id = getattr(component.ned, ned_type).ned_id
+                    ned_types[ned] = {"type": ned_type, "ned_id": ned_id}
+                except Error:
+                    pass
+
+        if ned not in ned_types:
+            errors.append(
+                f"Package {ned} does not provide a cli or generic NED for the inventory."
+            )
+
+    return ned_types, errors
+
+
+def device_values(row):
+    """Convert one read_devices query row into a dict of device values"""
+    values = dict(zip(DEVICE_LEAVES, [value or None for value in row]))
+    device = {
+        "name": values["name"],
+        "address": values["address"],
+        "port": int(values["port"]) if values["port"] else None,
+        "description": values["description"],
+        "authgroup": values["authgroup"],
+        "admin_state": values["state/admin-state"],
+        "ned": None,
+        "ned_type": None,
+        "protocol": values["device-type/cli/protocol"],
+        "source": values["source/source"],
+        "context": values["source/context"],
+    }
+    for ned_type in ["cli", "generic"]:
+        ned_id = values[f"device-type/{ned_type}/ned-id"]
+        if ned_id:
+            device["ned"] = ned_id.split(":")[-1]
+            device["ned_type"] = ned_type
+    return device
+
+
+def safe_file_name(name):
+    """Quote a list key for use as a single file name under the run directory
+
+    Every character but letters, digits and "_.-~" is percent-encoded, so a
+    name like "../x" or "a/b" can't leave the directory it is joined to.
+    """
+    return quote(str(name), safe="")
+
+
+def xpath_literal(value):
+    """Quote a string for use in an XPath expression"""
+    value = str(value)
+    if "'" not in value:
+        return f"'{value}'"
+    if '"' not in value:
+        return f'"{value}"'
+    parts = ", \"'\", ".join(f"'{part}'" for part in value.split("'"))
+    return f"concat({parts})"
+
+
+def read_devices(trans, names=None):
+    """Read the leaves compared by verify-inventory and build plans for NSO devices
+
+    A MAAPI query returns the leaves of the devices in chunks, instead of
+    a maagic round trip per leaf. Every device is read, or when names is
+    given only those devices, QUERY_NAMES names per query. Returns a dict
+    of device name -> values.
+    """
+    if names is None:
+        expressions = ["/ncs:devices/device"]
+    else:
+        names = sorted(names)
+        expressions = [
+            "/ncs:devices/device["
+            + " or ".join(
+                f"name={xpath_literal(name)}"
+                for name in names[start : start + QUERY_NAMES]
+            )
+            + "]"
+            for start in range(0, len(names), QUERY_NAMES)
+        ]
+
+    sock = trans.maapi.msock
+    devices = {}
+    for expression in expressions:
+        query = _maapi.query_start(
+            sock,
+            trans.th,
+            expression,
+            None,
+            QUERY_CHUNK_SIZE,
+            1,
+            QUERY_STRING,
+            DEVICE_LEAVES,
+            [],
+        )
+        try:
+            while True:
+                result = _maapi.query_result(sock, query)
+                if result.nresults == 0:
+                    break
+                for row in result:
+                    device = device_values(row)
+                    devices[device["name"]] = device
+        finally:
+            _maapi.query_stop(sock, query)
+    return devices
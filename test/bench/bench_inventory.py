@@ -0,0 +1,288 @@
+"""Offline benchmarks for the nso-netbox inventory code paths
+
+Serves synthetic NetBox devices and VMs from a local stand-in and runs the
+NetBox queries and the build-inventory and verify-inventory loops against
+a fake NSO, reporting wall time, NetBox requests, bytes transferred and
+peak Python memory for each inventory size.
+
+    python3 bench_inventory.py --sizes 1000,10000,50000 --json results.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "python"))
+
+import fake_ncs  # noqa: E402
+
+fake_ncs.install()
+
+from fake_ncs import Enum, KeyedList, LeafList, NedComponent, Node  # noqa: E402
+from netbox_standin import StandinProcess, synthetic_object  # noqa: E402
+from nso_netbox.netbox_inventory_actions import NetboxInventoryAction  # noqa: E402
+from nso_netbox.netbox_inventory_plan import (  # noqa: E402
+    apply_device,
+    apply_groups,
+    inventory_groups,
+    inventory_settings,
+    plan_groups,
+    plan_inventory,
+)
+from nso_netbox.netbox_utilities import (  # noqa: E402
+    devicelist_netbox,
+    inventory_netbox,
+    vmlist_netbox,
+)
+from nso_netbox.nso_utilities import inventory_neds, resolve_ned_types  # noqa: E402
+
+# NetBox device type model or VM role -> NED package
+NEDS = {
+    "CSR1000v": "cisco-ios-cli-6.67",
+    "Nexus9000v": "cisco-nx-cli-5.20",
+    "firewall": "cisco-asa-cli-6.12",
+}
+
+# Share of the inventory that are VMs, and that already exist in NSO
+VM_SHARE = 0.1
+EXISTING_SHARE = 0.5
+
+INVENTORY_PATH = "/nso-netbox:netbox-inventory{bench}"
+
+
+class QuietLog(object):
+    def info(self, *args):
+        pass
+
+    debug = error = warning = info
+
+
+def netbox_server(url, page_size):
+    return Node(
+        name="bench",
+        url=url,
+        api_token="0123456789abcdef",
+        lookup_workers=4,
+        lookup_cache_ttl=0,
+        page_size=page_size,
+        query_backend=Enum("rest"),
+        connect_timeout=5,
+        read_timeout=60,
+        retries=3,
+        retry_backoff=0.5,
+        max_requests=16,
+    )
+
+
+def inventory_service():
+    return Node(
+        name="bench",
+        _path=INVENTORY_PATH,
+        netbox_server="bench",
+        additional_netbox_server=[],
+        name_collision=Enum("first-server"),
+        update_nso_devices=True,
+        auth_group="default",
+        connection_protocol=Enum("ssh"),
+        admin_state=None,
+        bypass_certificate_verification=False,
+        site=[],
+        tenant=[],
+        device_role=[],
+        device_type=[
+            Node(model=model, ned=NEDS[model]) for model in ["CSR1000v", "Nexus9000v"]
+        ],
+        vm_role=[Node(role="firewall", ned=NEDS["firewall"])],
+    )
+
+
+def nso_device(data, vm):
+    """Fake NSO device matching a synthetic NetBox object"""
+    role = data["role"]["name"] if vm else data["device_role"]["name"]
+    ned = NEDS[role if vm else data["device_type"]["model"]]
+    # Every tenth device has drifted from NetBox
+    description = "drifted" if data["id"] % 10 == 0 else role
+    return Node(
+        name=data["name"],
+        address=data["primary_ip"]["address"].split("/")[0],
+        port=22,
+        description=description,
+        authgroup="default",
+        state=Node(admin_state=Enum("unlocked")),
+        device_type=Node(
+            cli=Node(ned_id=f"{ned}:{ned}", protocol="ssh"),
+            generic=Node(ned_id=None),
+        ),
+        source=Node(source=INVENTORY_PATH),
+    )
+
+
+def nso_root(devices, vms):
+    """Fake NSO with the NED packages and part of the inventory already added"""
+    root = Node(
+        devices=Node(
+            device=KeyedList(),
+            device_group=KeyedList(
+                lambda name: Node(
+                    name=name, location=Node(name=None), device_name=LeafList()
+                )
+            ),
+        ),
+        packages=Node(package=KeyedList()),
+    )
+    for ned in NEDS.values():
+        root.packages.package[ned] = Node(
+            name=ned, component=[Node(name=ned, ned=NedComponent(f"{ned}:{ned}"))]
+        )
+
+    for number in range(1, devices + vms + 1):
+        if number % int(1 / EXISTING_SHARE):
+            continue
+        vm = number > devices
+        data = synthetic_object(number, vm)
+        root.devices.device[data["name"]] = nso_device(data, vm)
+    return root
+
+
+def count_devices(result):
+    return len(result["result"])
+
+
+def bench_devicelist(server, service, root):
+    return count_devices(devicelist_netbox(service, server))
+
+
+def bench_vmlist(server, service, root):
+    return count_devices(vmlist_netbox(service, server))
+
+
+def bench_inventory_stream(server, service, root):
+    return sum(1 for _ in inventory_netbox(service, server, stream=True)["result"])
+
+
+def bench_inventory_graphql(server, service, root):
+    server.query_backend = Enum("graphql")
+    return sum(1 for _ in inventory_netbox(service, server, stream=True)["result"])
+
+
+def bench_build(server, service, root):
+    """The build-inventory loop: plan, render device templates and set groups"""
+    settings = inventory_settings(service)
+    neds = inventory_neds(service)
+    ned_types, _ = resolve_ned_types(root, list(NEDS.values()))
+    devices = inventory_netbox(service, server, stream=True)["result"]
+    plan = plan_inventory(root, settings, devices, neds, ned_types, full=True)
+
+    template = fake_ncs.Template(None)
+    for record in plan["create"] + plan["update"]:
+        apply_device(template, settings, record)
+    groups = inventory_groups(root, settings["path"])
+    apply_groups(root, settings, plan_groups(plan, groups), groups)
+    return len(plan["create"]) + len(plan["update"]) + len(plan["unchanged"])
+
+
+def bench_verify(server, service, root):
+    """The verify-inventory action against the fake NSO"""
+    action = NetboxInventoryAction()
+    action.log = QuietLog()
+    action.clients = None
+    action_output = Node(device=KeyedList())
+    action.verify_inventory(
+        "bench",
+        service,
+        root,
+        server,
+        Node(report_file=False, snapshot=False),
+        action_output,
+    )
+    return len(action_output.device)
+
+
+BENCHMARKS = [
+    ("devicelist_netbox", bench_devicelist),
+    ("vmlist_netbox", bench_vmlist),
+    ("inventory_netbox stream", bench_inventory_stream),
+    ("inventory_netbox graphql", bench_inventory_graphql),
+    ("build_inventory loop", bench_build),
+    ("verify_inventory loop", bench_verify),
+]
+
+
+def measure(standin, call, size, page_size, memory):
+    """Run a benchmark once on a fresh fake NSO and return its measurements"""
+    devices = int(size * (1 - VM_SHARE))
+    server = netbox_server(standin.url, page_size)
+    service = inventory_service()
+    root = nso_root(devices, size - devices)
+
+    standin.reset()
+    if memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    processed = call(server, service, root)
+    elapsed = time.perf_counter() - started
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    counters = standin.counters()
+    return {
+        "processed": processed,
+        "seconds": elapsed,
+        "requests": counters["requests"],
+        "bytes": counters["bytes"],
+        "peak_memory": peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", default="1000,10000,50000", help="Comma separated inventory sizes"
+    )
+    parser.add_argument(
+        "--page-size", type=int, default=250, help="netbox-server page-size"
+    )
+    parser.add_argument(
+        "--only", help="Only run benchmarks whose name contains this text"
+    )
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        devices = int(size * (1 - VM_SHARE))
+        standin = StandinProcess(devices, size - devices)
+        try:
+            for name, call in BENCHMARKS:
+                if args.only and args.only not in name:
+                    continue
+                # Time and memory are measured in separate runs as tracing
+                # allocations slows the code down
+                result = measure(standin, call, size, args.page_size, False)
+                result["peak_memory"] = measure(
+                    standin, call, size, args.page_size, True
+                )["peak_memory"]
+                result.update({"benchmark": name, "size": size})
+                results.append(result)
+                print(
+                    f"{name:<26} {size:>7} devices  {result['seconds']:8.2f} s"
+                    f"  {result['requests']:>5} requests"
+                    f"  {result['bytes'] / 1e6:9.1f} MB sent"
+                    f"  {result['peak_memory'] / 1e6:8.1f} MB peak"
+                    f"  {result['processed']:>7} processed",
+                    flush=True,
+                )
+        finally:
+            standin.stop()
+
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
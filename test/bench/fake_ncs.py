@@ -0,0 +1,184 @@
+"""Minimal stand-in for the NSO Python API used by the benchmarks
+
+Only the parts of ncs and _ncs the nso_netbox modules touch are provided,
+backed by plain Python objects so the inventory code can run without NSO.
+Call install() before importing nso_netbox.
+"""
+
+import re
+import sys
+import types
+
+
+class Error(Exception):
+    """Stand-in for _ncs.error.Error"""
+
+
+class Node(object):
+    """Container node, children are set as attributes"""
+
+    def __init__(self, **children):
+        self.__dict__.update(children)
+
+
+class KeyedList(dict):
+    """List node keyed by name, iterating over the entries like maagic"""
+
+    def __init__(self, entry=None):
+        super().__init__()
+        self._entry = entry or Node
+
+    def __iter__(self):
+        return iter(list(self.values()))
+
+    def create(self, name):
+        if name not in self:
+            self[name] = self._entry(name=name)
+        return self[name]
+
+
+class LeafList(list):
+    def as_list(self):
+        return list(self)
+
+
+class Enum(str):
+    """Enumeration leaf value with the maagic string attribute"""
+
+    @property
+    def string(self):
+        return str(self)
+
+
+class NedComponent(object):
+    """packages/package/component/ned for a cli NED"""
+
+    def __init__(self, ned_id):
+        self.cli = Node(ned_id=ned_id)
+
+    @property
+    def generic(self):
+        raise Error("not a generic NED")
+
+
+class Template(object):
+    """Counts template applies instead of rendering XML"""
+
+    applied = 0
+
+    def __init__(self, node):
+        self.node = node
+
+    def apply(self, name, vars=None):
+        Template.applied += 1
+
+
+class Variables(list):
+    def add(self, name, value):
+        self.append((name, value))
+
+
+class Transaction(object):
+    def __init__(self, root):
+        self.root = root
+        self.th = 1
+        self.maapi = Node(msock=root)
+
+    def apply(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class QueryResult(list):
+    @property
+    def nresults(self):
+        return len(self)
+
+
+def device_row(device, select):
+    """Values of the selected leaves of a fake NSO device, as strings"""
+    values = {
+        "name": device.name,
+        "address": device.address,
+        "port": str(device.port),
+        "description": device.description,
+        "authgroup": getattr(device, "authgroup", None),
+        "state/admin-state": str(device.state.admin_state),
+        "device-type/cli/ned-id": device.device_type.cli.ned_id,
+        "device-type/generic/ned-id": device.device_type.generic.ned_id,
+        "device-type/cli/protocol": device.device_type.cli.protocol,
+        "source/source": device.source.source,
+        "source/context": getattr(device.source, "context", None),
+    }
+    return [values[leaf] for leaf in select]
+
+
+_queries = {}
+
+
+def query_start(sock, th, expr, context, chunk_size, offset, result_as, select, sort):
+    devices = sock.devices.device
+    if "[" in expr:
+        names = set(re.findall(r"name='([^']*)'", expr))
+        devices = [device for device in devices if device.name in names]
+    rows = [device_row(device, select) for device in devices]
+    handle = len(_queries) + 1
+    _queries[handle] = (rows, chunk_size)
+    return handle
+
+
+def query_result(sock, handle):
+    rows, chunk_size = _queries[handle]
+    chunk = QueryResult(rows[:chunk_size])
+    _queries[handle] = (rows[chunk_size:], chunk_size)
+    return chunk
+
+
+def query_stop(sock, handle):
+    _queries.pop(handle, None)
+
+
+def passthrough(function):
+    return function
+
+
+def install():
+    """Register the stand-in ncs and _ncs modules in sys.modules"""
+
+    def module(name, **attributes):
+        new = types.ModuleType(name)
+        new.__dict__.update(attributes)
+        sys.modules[name] = new
+        return new
+
+    _ncs = module(
+        "_ncs", decrypt=lambda value: value, QUERY_STRING=1, ADDR="127.0.0.1", PORT=4569
+    )
+    _ncs.error = module("_ncs.error", Error=Error)
+    _ncs.cdb = module("_ncs.cdb")
+    _ncs.maapi = module(
+        "_ncs.maapi",
+        query_start=query_start,
+        query_result=query_result,
+        query_stop=query_stop,
+    )
+
+    ncs = module("ncs", OPERATIONAL=2, ITER_STOP=1, ITER_CONTINUE=3, MOP_DELETED=2)
+    ncs.maagic = module(
+        "ncs.maagic",
+        get_root=lambda trans: trans.root,
+        get_trans=lambda root: Transaction(root),
+        get_node=lambda trans, path: trans.root,
+    )
+    ncs.template = module("ncs.template", Template=Template, Variables=Variables)
+    ncs.maapi = module("ncs.maapi")
+    ncs.cdb = module("ncs.cdb", Subscriber=object)
+    action = type("Action", (object,), {"action": staticmethod(passthrough)})
+    ncs.dp = module("ncs.dp", Action=action)
+    service = type("Service", (object,), {"create": staticmethod(passthrough)})
+    ncs.application = module("ncs.application", Application=object, Service=service)
@@ -0,0 +1,312 @@
+"""Local HTTP stand-in for the parts of the NetBox API used by nso-netbox
+
+Serves synthetic, paginated device and virtual machine JSON shaped like
+NetBox 3.x, including the fields nso-netbox never reads, and honours the
+fields parameter of NetBox 4.0. The GraphQL query nso-netbox sends is
+answered from the same objects, using its filter variables. Requests are
+counted so the benchmarks can report how many calls each code path makes.
+
+The stand-in runs in its own process so serializing JSON doesn't share
+the interpreter with the code being measured. /_bench/counters returns
+the request and byte counters and /_bench/reset clears them.
+"""
+
+import json
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib.request import urlopen
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+SITES = ["site-a", "site-b"]
+TENANTS = ["tenant-a", "tenant-b"]
+DEVICE_TYPES = ["CSR1000v", "Nexus9000v"]
+DEVICE_ROLES = ["edge", "core"]
+VM_ROLES = ["firewall"]
+
+
+def nested(object_id, **fields):
+    fields.update({"id": object_id, "url": f"http://netbox/api/x/{object_id}/"})
+    return fields
+
+
+def synthetic_object(number, vm):
+    """JSON of one synthetic device or VM"""
+    name = f"{'vm' if vm else 'device'}-{number:06d}"
+    data = {
+        "id": number,
+        "url": f"http://netbox/api/{'virtualization/virtual-machines' if vm else 'dcim/devices'}/{number}/",
+        "name": name,
+        "status": {"value": "active", "label": "Active"},
+        "site": nested(number % 2 + 1, name=SITES[number % 2]),
+        "tenant": nested(number % 2 + 1, name=TENANTS[number % 2]),
+        "primary_ip": nested(
+            number,
+            address=f"10.{number // 65536 % 256}.{number // 256 % 256}.{number % 256}/24",
+        ),
+        "primary_ip4": None,
+        "primary_ip6": None,
+        "platform": None,
+        "serial": f"SN{number:010d}",
+        "asset_tag": None,
+        "comments": "Synthetic benchmark object " * 4,
+        "tags": [],
+        "custom_fields": {"owner": "benchmark", "ticket": None},
+        "config_context": {"ntp": ["10.0.0.1", "10.0.0.2"], "snmp": {"ro": "bench"}},
+        "created": "2021-01-01",
+        "last_updated": f"2021-01-01T00:00:{number % 60:02d}.000000Z",
+    }
+    if vm:
+        data["role"] = nested(3, name=VM_ROLES[0])
+        data["cluster"] = nested(1, name="cluster-a")
+        data["vcpus"] = 2
+        data["memory"] = 4096
+    else:
+        data["device_type"] = nested(
+            number % 2 + 1, model=DEVICE_TYPES[number % 2], slug="x"
+        )
+        data["device_role"] = nested(number % 2 + 1, name=DEVICE_ROLES[number % 2])
+        data["rack"] = nested(1, name="rack-1")
+        data["position"] = number % 42
+        data["face"] = {"value": "front", "label": "Front"}
+    return data
+
+
+def lookup_objects():
+    """Sites, tenants, device types and roles for the name to ID lookups"""
+    return {
+        "dcim/sites": [{"id": i + 1, "name": name} for i, name in enumerate(SITES)],
+        "tenancy/tenants": [
+            {"id": i + 1, "name": name} for i, name in enumerate(TENANTS)
+        ],
+        "dcim/device-types": [
+            {"id": i + 1, "model": model} for i, model in enumerate(DEVICE_TYPES)
+        ],
+        "dcim/device-roles": [
+            {"id": i + 1, "name": name, "vm_role": False}
+            for i, name in enumerate(DEVICE_ROLES)
+        ]
+        + [{"id": 3, "name": VM_ROLES[0], "vm_role": True}],
+    }
+
+
+def matches(item, query):
+    """Apply the NetBox filters nso-netbox sends to one object"""
+    for key, values in query.items():
+        if key in ["limit", "offset", "fields", "brief"]:
+            continue
+        if key == "last_updated__gte":
+            if item["last_updated"] < values[0]:
+                return False
+        elif key == "vm_role":
+            if str(item.get("vm_role")).lower() != values[0].lower():
+                return False
+        elif key.endswith("_id"):
+            field = key[:-3]
+            if field == "role" and "role" not in item:
+                field = "device_role"
+            nested_item = item.get(field) or {}
+            if str(nested_item.get("id")) not in values:
+                return False
+        elif str(item.get(key)) not in values:
+            return False
+    return True
+
+
+def graphql_matches(item, filters):
+    """Apply the GraphQL filter variables nso-netbox sends to one object"""
+    for field, lookup in filters.items():
+        if field == "last_updated":
+            if item["last_updated"] < lookup["gte"]:
+                return False
+            continue
+        if field == "role" and "role" not in item:
+            field = "device_role"
+        ((name_field, values),) = lookup.items()
+        if (item.get(field) or {}).get(name_field) not in values["in_list"]:
+            return False
+    return True
+
+
+def graphql_object(item, vm):
+    """GraphQL shape of a synthetic device or VM with the fields nso-netbox reads"""
+    data = {
+        "id": str(item["id"]),
+        "name": item["name"],
+        "status": item["status"]["value"],
+        "primary_ip4": {"address": item["primary_ip"]["address"]},
+        "primary_ip6": None,
+        "site": {"name": item["site"]["name"]},
+        "tenant": {"name": item["tenant"]["name"]},
+        "role": {"name": item["role" if vm else "device_role"]["name"]},
+        "last_updated": item["last_updated"],
+    }
+    if not vm:
+        data["device_type"] = {"model": item["device_type"]["model"]}
+    return data
+
+
+class NetboxStandin(object):
+    """NetBox stand-in with a number of devices and virtual machines"""
+
+    def __init__(self, devices, vms):
+        self.objects = lookup_objects()
+        self.objects["dcim/devices"] = [
+            synthetic_object(number, False) for number in range(1, devices + 1)
+        ]
+        self.objects["virtualization/virtual-machines"] = [
+            synthetic_object(number, True)
+            for number in range(devices + 1, devices + vms + 1)
+        ]
+        self.requests = 0
+        self.bytes_sent = 0
+        self._filtered = {}
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.send(*standin.respond(self.path))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if urlparse(self.path).path.strip("/") == "graphql":
+                    self.send(*standin.graphql(request.get("variables") or {}))
+                else:
+                    self.send(405, {"detail": "Method not allowed."})
+
+            def send(self, status, body):
+                payload = json.dumps(body).encode()
+                if not self.path.startswith("/_bench/"):
+                    standin.requests += 1
+                    standin.bytes_sent += len(payload)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def filtered(self, endpoint, query):
+        """Objects of an endpoint matching a query, cached across pages"""
+        key = (
+            endpoint,
+            tuple(
+                sorted(
+                    (name, tuple(values))
+                    for name, values in query.items()
+                    if name not in ["limit", "offset", "fields", "brief"]
+                )
+            ),
+        )
+        if key not in self._filtered:
+            self._filtered[key] = [
+                item for item in self.objects[endpoint] if matches(item, query)
+            ]
+        return self._filtered[key]
+
+    def graphql(self, variables):
+        """Answer the inventory GraphQL query for its filter variables"""
+        data = {}
+        lists = [
+            ("device_list", "dcim/devices", "devices", "with_devices", False),
+            (
+                "virtual_machine_list",
+                "virtualization/virtual-machines",
+                "vms",
+                "with_vms",
+                True,
+            ),
+        ]
+        for field, endpoint, filters, include, vm in lists:
+            if variables.get(include):
+                data[field] = [
+                    graphql_object(item, vm)
+                    for item in self.objects[endpoint]
+                    if graphql_matches(item, variables.get(filters) or {})
+                ]
+        return 200, {"data": data}
+
+    def respond(self, path):
+        url = urlparse(path)
+        query = parse_qs(url.query)
+
+        if url.path == "/_bench/counters":
+            return 200, {"requests": self.requests, "bytes": self.bytes_sent}
+        if url.path == "/_bench/reset":
+            self.requests = 0
+            self.bytes_sent = 0
+            return 200, {}
+
+        endpoint = url.path.strip("/")[len("api/") :].strip("/")
+        if endpoint == "status":
+            return 200, {
+                "netbox-version": "3.7.0",
+                "python-version": "3.11",
+                "plugins": {},
+                "rq-workers-running": 1,
+            }
+        if endpoint not in self.objects:
+            return 404, {"detail": "Not found."}
+
+        results = self.filtered(endpoint, query)
+        limit = int(query.get("limit", [DEFAULT_PAGE_SIZE])[0]) or MAX_PAGE_SIZE
+        limit = min(limit, MAX_PAGE_SIZE)
+        offset = int(query.get("offset", [0])[0])
+        page = results[offset : offset + limit]
+        if "fields" in query:
+            fields = query["fields"][0].split(",")
+            page = [{key: item[key] for key in fields if key in item} for item in page]
+
+        next_url = None
+        if offset + limit < len(results):
+            next_query = dict(query)
+            next_query["limit"] = [str(limit)]
+            next_query["offset"] = [str(offset + limit)]
+            next_url = f"{self.url}/api/{endpoint}/?{urlencode(next_query, doseq=True)}"
+
+        return 200, {
+            "count": len(results),
+            "next": next_url,
+            "previous": None,
+            "results": page,
+        }
+
+
+def serve(devices, vms, urls):
+    """Run a stand-in until the process is terminated, sending its url back"""
+    standin = NetboxStandin(devices, vms)
+    urls.put(standin.url)
+    standin.server.serve_forever()
+
+
+class StandinProcess(object):
+    """A NetboxStandin running in a child process"""
+
+    def __init__(self, devices, vms):
+        urls = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=serve, args=(devices, vms, urls), daemon=True
+        )
+        self.process.start()
+        self.url = urls.get()
+
+    def counters(self):
+        with urlopen(f"{self.url}/_bench/counters") as response:
+            return json.loads(response.read())
+
+    def reset(self):
+        urlopen(f"{self.url}/_bench/reset").close()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
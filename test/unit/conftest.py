@@ -0,0 +1,15 @@
+"""Unit tests for the nso_netbox helpers, run against the fake NSO API
+
+python3 -m pytest -q
+"""
+
+import os
+import sys
+
+HERE = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(HERE, "..", "bench"))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "python"))
+
+import fake_ncs  # noqa: E402
+
+fake_ncs.install()
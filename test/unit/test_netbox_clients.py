@@ -0,0 +1,91 @@
+import pytest
+import requests
+
+from nso_netbox import netbox_clients
+from nso_netbox.netbox_clients import AdaptiveLimiter, NetboxLookupCache, NetboxSession
+
+
+def test_limiter_halves_and_grows():
+    limiter = AdaptiveLimiter(8)
+    limiter.acquire()
+    limiter.release(True)
+    assert limiter.limit == 4
+
+    # Failures sent together within DECREASE_INTERVAL only halve it once
+    limiter.acquire()
+    limiter.release(True)
+    assert limiter.limit == 4
+
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release(False)
+    assert 4.9 < limiter.limit < 5
+
+    limiter.acquire()
+    limiter.release(None)
+    assert 4.9 < limiter.limit < 5
+    assert limiter._active == 0
+
+
+def test_limiter_stays_between_one_and_maximum():
+    limiter = AdaptiveLimiter(2)
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(False)
+    assert limiter.limit == 2
+    limiter._decreased = float("-inf")
+    limiter.limit = 1.0
+    limiter.acquire()
+    limiter.release(True)
+    assert limiter.limit == 1
+
+
+class Response(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+
+@pytest.mark.parametrize(
+    "outcome, limit",
+    [
+        (Response(200), 4),
+        (Response(429), 2),
+        (Response(503), 2),
+        (Response(500), 4),
+        (requests.exceptions.ConnectTimeout(), 2),
+        (requests.exceptions.ConnectionError(), 2),
+        (ValueError(), 4),
+    ],
+)
+def test_send_once_halves_only_on_overload(monkeypatch, outcome, limit):
+    def request(self, method, url, **kwargs):
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(requests.Session, "request", request)
+    session = NetboxSession(max_requests=4)
+    try:
+        session.send_once("GET", "http://netbox/api/")
+    except ValueError:
+        pass
+    assert session.limiter.limit == limit
+    assert session.limiter._active == 0
+
+
+def test_lookup_cache_expires_and_evicts(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(netbox_clients.time, "monotonic", lambda: now[0])
+    cache = NetboxLookupCache(maxsize=2)
+    cache.put("nb", "site", "dc1", [1], 10)
+    cache.put("nb", "site", "dc2", [2], 10)
+    assert cache.get("nb", "site", "dc1") == [1]
+
+    cache.put("nb", "site", "dc3", [3], 10)
+    assert cache.get("nb", "site", "dc2") is None
+    assert cache.get("nb", "site", "dc3") == [3]
+
+    now[0] = 111.0
+    assert cache.get("nb", "site", "dc1") is None
+    assert cache.stats("nb") == {"hits": 2, "misses": 2, "entries": 1}
@@ -0,0 +1,75 @@
+from fake_ncs import KeyedList, Node
+
+from nso_netbox.netbox_device_cache import (
+    CACHE_FIELDS,
+    cached_devices,
+    held_admin_states,
+    write_cache,
+)
+from nso_netbox.netbox_devices import DeviceSnapshot
+
+
+class CacheEntry(Node):
+    """device-cache entry, unset and deleted leaves read as None like maagic"""
+
+    def __getattr__(self, name):
+        if name in CACHE_FIELDS or name == "admin_state":
+            return None
+        raise AttributeError(name)
+
+
+def device_cache():
+    return Node(device=KeyedList(CacheEntry), refreshed=None)
+
+
+def device(name, status="active", address="10.0.0.1"):
+    return DeviceSnapshot(
+        name=name,
+        kind="device",
+        address=address,
+        status=status,
+        model="CSR1000v",
+        site="dc1",
+        last_updated="2026-10-18T10:00:00Z",
+    )
+
+
+def test_write_cache_only_writes_changes():
+    cache = device_cache()
+    counts = write_cache(cache, [device("r1"), device("r2")], "t1")
+    assert counts == {"added": 2, "updated": 0, "removed": 0}
+    assert cache.refreshed == "t1"
+
+    counts = write_cache(cache, [device("r1", address="10.0.0.2"), device("r3")], "t2")
+    assert counts == {"added": 1, "updated": 1, "removed": 1}
+    assert sorted(entry.name for entry in cached_devices(cache)) == ["r1", "r3"]
+    assert cache.device["r1"].address == "10.0.0.2"
+
+
+def test_write_cache_keeps_unchanged_servers():
+    cache = device_cache()
+    write_cache(cache, [device("r1"), device("r2")], "t1")
+    counts = write_cache(cache, [device("r1")], "t2", keep=["r2"])
+    assert counts == {"added": 0, "updated": 0, "removed": 0}
+    assert "r2" in cache.device
+
+
+def test_write_cache_holds_admin_state_without_status_mapping():
+    cache = device_cache()
+    write_cache(cache, [device("r1")], "t1", admin_states={"r1": "unlocked"})
+    assert held_admin_states(cache) == {}
+
+    # The admin-state of the device when its status lost the mapping is kept
+    counts = write_cache(
+        cache, [device("r1", "custom")], "t2", admin_states={"r1": "unlocked"}
+    )
+    assert counts["updated"] == 1
+    assert held_admin_states(cache) == {"r1": "unlocked"}
+    counts = write_cache(
+        cache, [device("r1", "custom")], "t3", admin_states={"r1": "locked"}
+    )
+    assert counts["updated"] == 0
+    assert held_admin_states(cache) == {"r1": "unlocked"}
+
+    write_cache(cache, [device("r1")], "t4", admin_states={"r1": "unlocked"})
+    assert held_admin_states(cache) == {}
@@ -0,0 +1,72 @@
+from nso_netbox.netbox_devices import DeviceSnapshot, latest_updated, updated_time
+
+FILTERS = {
+    "site": ["dc1"],
+    "tenant": [],
+    "device_type": ["CSR1000v"],
+    "device_role": ["router"],
+    "vm_role": ["firewall"],
+}
+
+
+def device(**values):
+    data = {
+        "name": "r1",
+        "primary_ip": {"address": "10.0.0.1/24"},
+        "status": {"value": "active"},
+        "device_type": {"model": "CSR1000v"},
+        "role": {"name": "router"},
+        "site": {"name": "dc1"},
+        "tenant": None,
+        "url": "https://netbox/api/dcim/devices/1/",
+        "last_updated": "2026-10-18T10:00:00Z",
+    }
+    data.update(values)
+    return DeviceSnapshot.from_netbox("device", data)
+
+
+def test_from_netbox_parses_nested_fields():
+    snapshot = device(device_role={"name": "edge"})
+    assert snapshot.address == "10.0.0.1"
+    assert snapshot.status == "active"
+    assert snapshot.model == "CSR1000v"
+    assert snapshot.role == "edge"
+    assert snapshot.tenant is None
+    assert device(primary_ip=None).address is None
+
+
+def test_matches_device_filters():
+    assert device().matches(FILTERS)
+    assert not device(site={"name": "dc2"}).matches(FILTERS)
+    assert not device(device_type={"model": "Nexus9000v"}).matches(FILTERS)
+    assert not device(role={"name": "switch"}).matches(FILTERS)
+    assert device(role={"name": "switch"}).matches(dict(FILTERS, device_role=[]))
+
+
+def test_matches_vm_filters():
+    vm = DeviceSnapshot.from_netbox(
+        "vm", {"name": "fw1", "role": {"name": "firewall"}, "site": {"name": "dc1"}}
+    )
+    assert vm.model is None
+    assert vm.matches(FILTERS)
+    assert not vm.matches(dict(FILTERS, vm_role=["router"]))
+
+
+def test_updated_time_is_utc():
+    assert updated_time("2026-10-18T10:00:00Z") == updated_time(
+        "2026-10-18T10:00:00+00:00"
+    )
+    assert updated_time("2026-10-18T10:00:00") == updated_time("2026-10-18T10:00:00Z")
+
+
+def test_latest_updated_compares_times():
+    # NetBox leaves out the fraction of a second when it is zero
+    assert (
+        latest_updated("2026-10-18T10:00:01Z", "2026-10-18T10:00:01.500000Z")
+        == "2026-10-18T10:00:01.500000Z"
+    )
+    assert (
+        latest_updated(None, "2026-10-18T12:00:00+02:00", "2026-10-18T10:30:00Z")
+        == "2026-10-18T10:30:00Z"
+    )
+    assert latest_updated(None, "") is None
@@ -0,0 +1,39 @@
+import pytest
+
+from nso_netbox.netbox_devices import DeviceSnapshot
+from nso_netbox.netbox_federation import merge_devices
+
+
+def devices(*names):
+    return [DeviceSnapshot(name=name, kind="device") for name in names]
+
+
+RESULTS = [
+    ("nb-east", devices("r1", "r2")),
+    ("nb-west", devices("r2", "r3")),
+    ("nb-south", devices("r2")),
+]
+
+
+def test_merge_first_server_keeps_first_device():
+    merged, collisions = merge_devices(RESULTS, "first-server")
+    assert [device.name for device in merged] == ["r1", "r2", "r3"]
+    assert merged[1] is RESULTS[0][1][1]
+    assert collisions == {"r2": ["nb-east", "nb-west", "nb-south"]}
+
+
+def test_merge_skip_leaves_out_collisions():
+    merged, collisions = merge_devices(RESULTS, "skip")
+    assert [device.name for device in merged] == ["r1", "r3"]
+    assert list(collisions) == ["r2"]
+
+
+def test_merge_fail_raises():
+    with pytest.raises(Exception, match="r2 \\(nb-east, nb-west, nb-south\\)"):
+        merge_devices(RESULTS, "fail")
+
+
+def test_merge_without_collisions():
+    merged, collisions = merge_devices(RESULTS[:1], "fail")
+    assert [device.name for device in merged] == ["r1", "r2"]
+    assert collisions == {}
@@ -0,0 +1,64 @@
+from fake_ncs import Node
+
+from nso_netbox import netbox_metrics
+from nso_netbox.netbox_metrics import (
+    ActionMetrics,
+    label_value,
+    phase,
+    prometheus_text,
+    save_metrics,
+)
+
+
+class RecordingLog(object):
+    def __init__(self):
+        self.errors = []
+
+    def error(self, message):
+        self.errors.append(message)
+
+
+def test_nested_phases_are_counted_once():
+    metrics = ActionMetrics("build-inventory")
+    with phase(metrics, "plan"):
+        with phase(metrics, "device-fetch"):
+            pass
+    assert set(metrics.phases) == {"plan", "device-fetch"}
+    assert metrics.phases["plan"]["duration"] >= 0
+
+
+def test_label_values_are_escaped():
+    assert label_value('a\\b"c\nd') == 'a\\\\b\\"c\\nd'
+
+
+def test_prometheus_text():
+    entry = Node(
+        action="build-inventory",
+        name='odd "phase"',
+        duration="1.500",
+        requests=3,
+        devices=10,
+        errors=0,
+    )
+    root = Node(netbox_inventory=[Node(name="router", metrics=Node(phase=[entry]))])
+    text = prometheus_text(root)
+    assert (
+        'nso_netbox_phase_duration_seconds{inventory="router",action="build-inventory",phase="odd \\"phase\\""} 1.500'
+        in text
+    )
+    assert "# TYPE nso_netbox_phase_requests gauge" in text
+
+
+def test_save_metrics_logs_errors(monkeypatch):
+    def single_write_trans(*args, **kwargs):
+        raise RuntimeError("NSO is down")
+
+    monkeypatch.setattr(
+        netbox_metrics.ncs.maapi,
+        "single_write_trans",
+        single_write_trans,
+        raising=False,
+    )
+    log = RecordingLog()
+    save_metrics("admin", "system", [], "/path", ActionMetrics("verify"), log=log)
+    assert log.errors == ["Unable to save metrics of verify: NSO is down"]
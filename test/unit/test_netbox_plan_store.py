@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+
+from nso_netbox.netbox_plan_store import (
+    PLAN_DIRECTORY,
+    discard_plan,
+    load_plan,
+    plan_path,
+    store_plan,
+)
+
+PLAN = {"create": ["r1"], "update": [], "remove": ["r9"]}
+GROUPS = {"inventory-router": {"r2", "r1"}}
+
+
+@pytest.fixture(autouse=True)
+def run_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("NCS_RUN_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_stored_plan_loads(run_dir):
+    plan_id, _ = store_plan("router", PLAN, GROUPS, "since", "fp", 60)
+    loaded = load_plan("router", plan_id, "fp")
+    assert loaded["status"]
+    assert loaded["result"]["plan"] == PLAN
+    assert loaded["result"]["wanted_groups"] == GROUPS
+
+    discard_plan("router")
+    assert not load_plan("router", plan_id, "fp")["status"]
+
+
+def test_modified_plan_is_refused():
+    plan_id, _ = store_plan("router", PLAN, GROUPS, "since", "fp", 60)
+    with open(plan_path("router")) as plan_file:
+        content = json.load(plan_file)
+    content["plan"]["remove"].append("r10")
+    with open(plan_path("router"), "w") as plan_file:
+        json.dump(content, plan_file)
+
+    loaded = load_plan("router", plan_id, "fp")
+    assert not loaded["status"]
+    assert "modified" in loaded["result"]
+
+
+def test_replaced_expired_and_changed_plans_are_refused():
+    old_id, _ = store_plan("router", PLAN, GROUPS, "since", "fp", 60)
+    new_id, _ = store_plan("router", PLAN, GROUPS, "later", "fp", 60)
+    assert "not the latest plan" in load_plan("router", old_id, "fp")["result"]
+    assert "changed since" in load_plan("router", new_id, "other")["result"]
+
+    expired_id, _ = store_plan("router", PLAN, GROUPS, "since", "fp", -1)
+    assert "expired" in load_plan("router", expired_id, "fp")["result"]
+
+
+def test_plan_path_stays_in_plan_directory(run_dir):
+    directory = os.path.join(str(run_dir), PLAN_DIRECTORY)
+    for inventory in ["../escape", "a/b", ".."]:
+        path = plan_path(inventory)
+        assert os.path.dirname(path) == directory
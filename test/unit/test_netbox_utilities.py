@@ -0,0 +1,143 @@
+import threading
+import time
+
+from nso_netbox.netbox_clients import NetboxLookupCache
+from nso_netbox.netbox_utilities import (
+    abandoned_workers,
+    lookup_ids,
+    merge_filters,
+    run_with_deadlines,
+)
+
+
+def inventory_filters(**values):
+    filters = {
+        "site": [],
+        "tenant": [],
+        "device_type": [],
+        "device_role": [],
+        "vm_role": [],
+    }
+    filters.update(values)
+    return filters
+
+
+def test_merge_filters_joins_types_and_roles():
+    merged = merge_filters(
+        [
+            inventory_filters(site=["dc1"], device_type=["CSR1000v"]),
+            inventory_filters(
+                site=["dc2", "dc1"], device_type=["N9K"], vm_role=["firewall"]
+            ),
+        ]
+    )
+    assert merged == inventory_filters(
+        site=["dc1", "dc2"], device_type=["CSR1000v", "N9K"], vm_role=["firewall"]
+    )
+
+
+def test_merge_filters_drops_filters_not_set_everywhere():
+    # An inventory without a site or tenant filter matches any site or tenant
+    merged = merge_filters(
+        [
+            inventory_filters(site=["dc1"], tenant=["a"], device_role=["edge"]),
+            inventory_filters(tenant=["b"]),
+        ]
+    )
+    assert merged["site"] == []
+    assert merged["tenant"] == ["a", "b"]
+    assert merged["device_role"] == []
+
+
+class Item(object):
+    def __init__(self, id, model):
+        self.id = id
+        self.model = model
+
+
+class Endpoint(object):
+    def __init__(self, items):
+        self.items = items
+        self.queries = []
+
+    def filter(self, **query):
+        self.queries.append(query)
+        return [item for item in self.items if item.model in query["model"]]
+
+
+def test_lookup_ids_caches_every_id_of_a_name():
+    # Two manufacturers with a device type of the same model
+    endpoint = Endpoint([Item(1, "CSR1000v"), Item(2, "CSR1000v"), Item(3, "N9K")])
+    nb = type("Api", (object,), {})()
+    nb.dcim = type("App", (object,), {})()
+    nb.dcim.device_types = endpoint
+    cache = NetboxLookupCache()
+
+    for _ in range(2):
+        ids = lookup_ids(
+            nb, "device_type", ["CSR1000v"], cache=cache, server="nb", ttl=60
+        )
+        assert sorted(ids) == [1, 2]
+    assert len(endpoint.queries) == 1
+
+    ids = lookup_ids(
+        nb, "device_type", ["CSR1000v", "N9K"], cache=cache, server="nb", ttl=60
+    )
+    assert sorted(ids) == [1, 2, 3]
+    assert endpoint.queries[-1]["model"] == ["N9K"]
+
+
+def test_run_with_deadlines_outcomes():
+    release = threading.Event()
+
+    def call(item):
+        if item == "stuck":
+            release.wait(5)
+        if item == "broken":
+            raise ValueError(item)
+        return item.upper()
+
+    try:
+        results = run_with_deadlines(
+            ["ok", "stuck", "broken"], call, workers=3, timeout=0.2, key="outcomes"
+        )
+        assert results["ok"] == ("done", "OK")
+        assert results["stuck"] == ("timeout", None)
+        assert results["broken"][0] == "error"
+        assert abandoned_workers("outcomes") == 1
+    finally:
+        release.set()
+
+
+def test_abandoned_workers_are_counted_per_key():
+    release = threading.Event()
+    try:
+        run_with_deadlines(
+            [1, 2], lambda item: release.wait(5), workers=2, timeout=0.1, key="slow"
+        )
+        assert abandoned_workers("slow") == 2
+        assert abandoned_workers("other") == 0
+
+        # Another key keeps every worker slot
+        started = time.monotonic()
+        run_with_deadlines([1, 2], lambda item: time.sleep(0.2), workers=2, key="other")
+        assert time.monotonic() - started < 0.35
+    finally:
+        release.set()
+
+
+def test_abandoned_worker_slots_are_given_back():
+    release = threading.Event()
+    run_with_deadlines(
+        [1], lambda item: release.wait(5), workers=2, timeout=0.1, key="recover"
+    )
+    assert abandoned_workers("recover") == 1
+
+    # One slot is left while the worker runs, both once it finishes
+    threading.Timer(0.2, release.set).start()
+    started = time.monotonic()
+    run_with_deadlines(
+        range(6), lambda item: time.sleep(0.5), workers=2, timeout=5, key="recover"
+    )
+    assert time.monotonic() - started < 2.5
+    assert abandoned_workers("recover") == 0
@@ -0,0 +1,72 @@
+import fake_ncs
+from fake_ncs import Enum, KeyedList, Node, Transaction
+
+from nso_netbox import nso_utilities
+from nso_netbox.nso_utilities import read_devices, safe_file_name, xpath_literal
+
+
+def nso_device(name):
+    return Node(
+        name=name,
+        address="10.0.0.1",
+        port=22,
+        description=None,
+        authgroup="default",
+        state=Node(admin_state=Enum("unlocked")),
+        device_type=Node(
+            cli=Node(ned_id="cisco-ios-cli-6.67:cisco-ios-cli-6.67", protocol="ssh"),
+            generic=Node(ned_id=None),
+        ),
+        source=Node(source="/nso-netbox:netbox-inventory{router}", context=None),
+    )
+
+
+def nso_root(names):
+    root = Node(devices=Node(device=KeyedList()))
+    for name in names:
+        root.devices.device[name] = nso_device(name)
+    return root
+
+
+def test_read_devices_values():
+    devices = read_devices(Transaction(nso_root(["r1"])))
+    assert devices["r1"]["port"] == 22
+    assert devices["r1"]["admin_state"] == "unlocked"
+    assert devices["r1"]["ned"] == "cisco-ios-cli-6.67"
+    assert devices["r1"]["ned_type"] == "cli"
+    assert devices["r1"]["description"] is None
+
+
+def test_read_devices_only_queries_names(monkeypatch):
+    monkeypatch.setattr(nso_utilities, "QUERY_NAMES", 2)
+    expressions = []
+    query_start = fake_ncs.query_start
+
+    def recording_query_start(sock, th, expr, *args):
+        expressions.append(expr)
+        return query_start(sock, th, expr, *args)
+
+    monkeypatch.setattr(nso_utilities._maapi, "query_start", recording_query_start)
+    trans = Transaction(nso_root([f"r{number}" for number in range(10)]))
+
+    devices = read_devices(trans, ["r3", "r1", "r7", "missing"])
+    assert sorted(devices) == ["r1", "r3", "r7"]
+    assert expressions == [
+        "/ncs:devices/device[name='missing' or name='r1']",
+        "/ncs:devices/device[name='r3' or name='r7']",
+    ]
+
+    assert read_devices(trans, []) == {}
+    assert len(read_devices(trans)) == 10
+
+
+def test_xpath_literal_quotes():
+    assert xpath_literal("r1") == "'r1'"
+    assert xpath_literal("o'brien") == '"o\'brien"'
+    assert xpath_literal("a'b\"c") == "concat('a', \"'\", 'b\"c')"
+
+
+def test_safe_file_name_has_no_separators():
+    assert safe_file_name("router") == "router"
+    assert safe_file_name("../etc/passwd") == "..%2Fetc%2Fpasswd"
+    assert "/" not in safe_file_name("a/b\\c")